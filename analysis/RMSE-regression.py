@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Screen site covariates as drivers of the MiCASA vs FluxNet RMSE
+#
+# Joins the metrics of RMSE_calc.py (metrics_results.csv) with site
+# covariates (AmeriFlux metadata, MERRA-2 climatologies, extra CSVs) and fits
+# every univariate and one multivariate regression per variable and period,
+# with permutation p-values (see analysis/regression.py).
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import FLUX_METADATA, SITE_METADATA_CACHE, GRID_INDEX_PATH
+
+from utils.site_metadata import load_site_metadata
+from utils.manifest import atomic_write
+from utils.instrument import add_profiling_arguments, configure, stage, summary_report
+from analysis.regression import regress_sites
+import argparse
+import pandas as pd
+
+parser = argparse.ArgumentParser(description="User-specified parameters")
+parser.add_argument(
+    "--metrics", type=Path, default=Path("metrics_results.csv"), help="Metrics table written by RMSE_calc.py",
+)
+parser.add_argument("--target", type=str, default="rmse", help="Metric to explain (rmse, bias, mae, corr)")
+parser.add_argument(
+    "--covariates", type=Path, nargs="*", default=[],
+    help="Extra covariate CSVs with one row per site (site, SiteID or Site ID column)",
+)
+parser.add_argument(
+    "--merra", nargs="+", action="append", default=[], metavar=("STORE", "VAR"),
+    help="MERRA-2 store and variables to sample at the sites, e.g. M2store_tavgM_slv_1991_2021 T2M",
+)
+parser.add_argument(
+    "--multivariate", type=str, nargs="*", default=None,
+    help="Covariates of the multivariate fit (default all, no value for none)",
+)
+parser.add_argument("--permutations", type=int, default=1000, help="Permutations for the p-values")
+parser.add_argument("--seed", type=int, default=0, help="Permutation random seed")
+parser.add_argument("--output", type=Path, default=Path("regression_results.csv"), help="Output CSV")
+parser.add_argument("--plot-dir", type=Path, default=None, help="Also save the univariate fits as PNGs here")
+add_profiling_arguments(parser)
+args = parser.parse_args()
+configure(args.profile_log, args.cprofile_dir)
+
+#################### Site covariates ##############################
+fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+site_df = fluxnet_meta.frame().set_index("Site ID").rename(
+    columns={"Latitude (degrees)": "lat", "Longitude (degrees)": "lon"}
+)
+covariates = pd.DataFrame(index=site_df.index)
+covariates["lat"] = fluxnet_meta.lat
+covariates["abs_lat"] = abs(fluxnet_meta.lat)
+covariates["lon"] = fluxnet_meta.lon
+covariates["years_data"] = fluxnet_meta.n_years
+# Sites without an IGBP class stay NaN (left out of the IGBP fits) rather than a "nan" class
+covariates["IGBP"] = fluxnet_meta.igbp
+
+if args.merra:
+    from config import MERRA_DATA_PATH
+    from utils.merra import open_merra2_store, sample_merra2_sites
+
+    for store, *var_list in args.merra:
+        with stage("merra_covariates", store=store):
+            ds = open_merra2_store(MERRA_DATA_PATH / store, var_list)
+            sampled = sample_merra2_sites(ds, site_df, var_list, index_cache=GRID_INDEX_PATH)
+        new_cols = [col for col in sampled.columns if col not in site_df.columns]
+        covariates = covariates.join(sampled[new_cols])
+
+for path in args.covariates:
+    extra = pd.read_csv(path)
+    site_col = next(col for col in ("site", "SiteID", "Site ID") if col in extra.columns)
+    covariates = covariates.join(extra.set_index(site_col), rsuffix=f"_{path.stem}")
+
+#################### Regressions ##############################
+metrics = pd.read_csv(args.metrics)
+data = metrics[["site", "variable", "period", args.target]].merge(
+    covariates, left_on="site", right_index=True, how="inner"
+)
+with stage("regression", n_sites=data["site"].nunique(), n_covariates=covariates.shape[1]):
+    results = regress_sites(
+        data, target=args.target, covariates=list(covariates.columns),
+        multivariate=args.multivariate, n_permutations=args.permutations, seed=args.seed,
+    )
+
+with atomic_write(args.output) as tmp_path:
+    results.to_csv(tmp_path, index=False)
+print(f"CSV written to: {args.output}")
+
+if args.plot_dir is not None:
+    from utils.plotting import plot_regressions
+
+    args.plot_dir.mkdir(parents=True, exist_ok=True)
+    for key, fig in plot_regressions(data, results).items():
+        fname = args.plot_dir / f"regression_{'_'.join(map(str, key))}.png"
+        fig.savefig(fname, dpi=150)
+        print(f"Figure written to: {fname}")
+
+if args.profile_log is not None:
+    print(summary_report(args.profile_log))
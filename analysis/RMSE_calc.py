@@ -2,99 +2,138 @@
 # Calculating RMSE between MiCASA and FluxNet
 
 # Import config variables and functions
+import os
 import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import MICASA_PREPROCESSED_DATA, FLUX_METADATA
-
-from utils.functions import import_flux_metadata
-from plotting.plots_generator import import_flux_and_prep_data
+from config import MICASA_PREPROCESSED_DATA, FLUX_DATA_PATH, FLUX_METADATA, SITE_METADATA_CACHE, FLUX_CACHE_PATH, MANIFEST_PATH
+
+from utils.functions import flux_site_file
+from utils.site_metadata import load_site_metadata
+from utils.intermediates import intermediates_path, read_intermediates
+from utils.flux_cache import load_flux_sites, flux_cache_key
+from utils.manifest import open_manifest, stage_key, is_up_to_date, record_stage, atomic_write
+from utils.instrument import add_profiling_arguments, configure, stage, summary_report
+from analysis.metrics import PERIODS, align_sites, compute_metrics, rmse_table
+from analysis.bootstrap import bootstrap_rmse
 import argparse
-import numpy as np
 import pandas as pd
-import os
-from sklearn.metrics import root_mean_squared_error
 
 # Input arg
 parser = argparse.ArgumentParser(description="User-specified parameters")
 parser.add_argument(
-    "periodicity", metavar="P", type=str,
-    choices = ["GRW", "ANN"], help="GRW (growing) or ANN (annual)",
+    "periodicity", metavar="P", type=str, nargs="+",
+    choices = ["GRW", "ANN"], help="GRW (growing) and/or ANN (annual)",
+)
+parser.add_argument(
+    "--custom-period", nargs=2, action="append", default=[],
+    metavar=("NAME", "MONTHS"), help="Additional month set, e.g. MAM 3,4,5",
+)
+parser.add_argument(
+    "--changed-only", action="store_true",
+    help="Use the run manifest: only recompute sites whose inputs, periods or code changed",
 )
+parser.add_argument(
+    "--bootstrap", type=int, default=0, metavar="N",
+    help="Add block-bootstrap RMSE confidence intervals from N resamples (e.g. 1000)",
+)
+parser.add_argument("--block-length", type=int, default=30, help="Bootstrap block length (days)")
+parser.add_argument("--confidence", type=float, default=0.95, help="Bootstrap confidence level")
+parser.add_argument("--seed", type=int, default=0, help="Bootstrap random seed")
+parser.add_argument("--bootstrap-workers", type=int, default=None, help="Bootstrap worker processes")
+add_profiling_arguments(parser)
 args = parser.parse_args()
-period = args.periodicity
+configure(args.profile_log, args.cprofile_dir)
+
+periods = {period: PERIODS[period] for period in args.periodicity}
+for name, months in args.custom_period:
+    periods[name] = [int(month) for month in months.split(",")]
 
 # Define misc variables
 timedelta = "DD"
+bootstrap_params = {
+    "n_resamples": args.bootstrap, "block_length": args.block_length,
+    "confidence": args.confidence, "seed": args.seed,
+} if args.bootstrap else None
 
 #################### Import Flux Data ##############################
 # Import site metadata csv
-fluxnet_meta = import_flux_metadata(FLUX_METADATA)
-if period=="GRW":
-    # Only use NH
-    fluxnet_meta = fluxnet_meta[fluxnet_meta["Latitude (degrees)"]>0]
-
-ids_list = fluxnet_meta["Site ID"]
-
-results = []
-
-for site_ID in ids_list:
-    fluxnet_data = import_flux_and_prep_data(site_ID, timedelta)
+fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+ids_list = fluxnet_meta.select()
+# GRW only uses NH
+nh_ids_list = fluxnet_meta.select(hemisphere="N")
+
+fname = "metrics_results.csv"
+previous = None
+run_ids = ids_list
+if args.changed_only:
+    # Recompute only sites whose FluxNet CSV, cleaning, intermediates, periods or code changed
+    micasa_path = intermediates_path(MICASA_PREPROCESSED_DATA, timedelta)
+    with open_manifest(MANIFEST_PATH) as con:
+        site_keys = {
+            site_ID: stage_key(
+                con, "RMSE",
+                [flux_site_file(FLUX_DATA_PATH, site_ID, timedelta)]
+                + sorted((micasa_path / f"site={site_ID}").rglob("*.parquet")),
+                {
+                    "timedelta": timedelta, "periods": periods, "bootstrap": bootstrap_params,
+                    "clean_key": flux_cache_key(FLUX_DATA_PATH, site_ID, timedelta, FLUX_CACHE_PATH)[0],
+                },
+            )
+            for site_ID in ids_list
+        }
+        if os.path.exists(fname):
+            previous = pd.read_csv(fname)
+            run_ids = [
+                site_ID for site_ID in ids_list if not is_up_to_date(con, site_ID, "RMSE", site_keys[site_ID][0])
+            ]
+    print(f"Recomputing metrics for {len(run_ids)} of {len(ids_list)} sites")
+
+if run_ids:
+    flux_sites = load_flux_sites(FLUX_DATA_PATH, run_ids, timedelta, FLUX_CACHE_PATH)
 
     ############ Import Preprocessed Micasa Data ################
-    filename = f"{site_ID}_micasa_{timedelta}.csv"
-    path = os.path.join(MICASA_PREPROCESSED_DATA, filename)
-    micasa_ds = pd.read_csv(path, index_col=0, parse_dates=True)
-
-    ############## Append datasets #########################
-    # Make clean dataframe and append together
-    ## NEE
-    NEE_ds = pd.DataFrame()
-    NEE_ds["MiCASA"] = micasa_ds["MiCASA NEE (kg m-2 s-1)"]
-    NEE_ds["FluxNet"] = fluxnet_data["NEE (kgC m-2 s-1)"]
-
-    ## NPP
-    NPP_ds = pd.DataFrame()
-    NPP_ds["MiCASA"] = micasa_ds["MiCASA NPP (kg m-2 s-1)"]
-    NPP_ds["FluxNet DT GPP/2"] = fluxnet_data["GPP_DT (kgC m-2 s-1)"] / 2
-
-    if period=='GRW':
-        JJA = [6, 7, 8]
-        NEE_ds = NEE_ds[NEE_ds.index.month.isin(JJA)]
-        # print(NEE_ds)
-        NPP_ds = NPP_ds[NPP_ds.index.month.isin(JJA)]
-        # print(NPP_ds)
-
-    # Drop NA values and check if empty
-    NEE_ds_clean = NEE_ds.dropna(subset=['FluxNet'])
-    NPP_ds_clean = NPP_ds.dropna(subset=['FluxNet DT GPP/2'])
-
-    '''
-    # Skip if both datasets are empty
-    if NEE_ds_clean.empty and NPP_ds_clean.empty:
-        print(f'Skipping {site_ID}, NEE and NPP datasets for GRW are empty')
-        continue
-    '''
-
-    try: 
-        NEE_RMSE = root_mean_squared_error(NEE_ds_clean.MiCASA, NEE_ds_clean.FluxNet)
-    except ValueError: 
-        NEE_RMSE = np.nan
-
-    try:
-        NPP_RMSE = root_mean_squared_error(NPP_ds_clean.MiCASA, NPP_ds_clean["FluxNet DT GPP/2"])
-    except ValueError: 
-        NPP_RMSE = np.nan
-
-    # Write values out to a list
-    results.append({
-        'SiteID' : site_ID,
-        'NEE_RMSE': NEE_RMSE,
-        'NPP_RMSE': NPP_RMSE,
-    })
-
-ds = pd.DataFrame(results)
-fname = f"RMSE_results_{period}.csv"
-ds.to_csv(fname, index=False)
+    # Read only the needed sites and variables, all at once
+    with stage("read_intermediates", n_sites=len(run_ids)):
+        micasa_all = read_intermediates(
+            intermediates_path(MICASA_PREPROCESSED_DATA, timedelta),
+            sites=run_ids, variables=["NEE", "NPP"], wide=True,
+        )
+
+    ############## Compute metrics for all sites and periods #####################
+    with stage("RMSE", n_sites=len(run_ids), periods=list(periods)):
+        aligned = align_sites(micasa_all, flux_sites)
+        metrics = compute_metrics(aligned, periods)
+    if bootstrap_params is not None:
+        with stage("bootstrap", n_sites=len(run_ids), n_resamples=args.bootstrap):
+            intervals = bootstrap_rmse(aligned, periods, n_workers=args.bootstrap_workers, **bootstrap_params)
+        metrics = metrics.merge(intervals, on=["site", "variable", "period"], how="left")
+    metrics = metrics[(metrics["period"] != "GRW") | metrics["site"].isin(nh_ids_list)]
+
+    if previous is not None:
+        # Keep the results of the unchanged sites
+        metrics = pd.concat([previous[~previous["site"].isin(run_ids)], metrics], ignore_index=True)
+else:
+    # Every site is up to date, the tables are rewritten from the previous results
+    metrics = previous
+
+with atomic_write(fname) as tmp_path:
+    metrics.to_csv(tmp_path, index=False)
 print(f"CSV written to: {fname}")
+
+for period in periods:
+    site_list = nh_ids_list if period == "GRW" else ids_list
+    ds = rmse_table(metrics, period, site_list)
+    fname = f"RMSE_results_{period}.csv"
+    with atomic_write(fname) as tmp_path:
+        ds.to_csv(tmp_path, index=False)
+    print(f"CSV written to: {fname}")
+
+if args.changed_only:
+    with open_manifest(MANIFEST_PATH) as con:
+        for site_ID in run_ids:
+            record_stage(con, site_ID, "RMSE", *site_keys[site_ID], ["metrics_results.csv"])
+
+if args.profile_log is not None:
+    print(summary_report(args.profile_log))
@@ -0,0 +1,204 @@
+# Moving-block bootstrap confidence intervals of the site RMSEs
+#
+# All (site, variable, period) series are concatenated into one array of
+# squared errors. Every possible block of a series is reduced once to its sum
+# (a difference of cumulative sums), so a resample is just the sum of a few
+# block sums picked by integer index: a batch of resamples for all series is
+# one fancy-indexing operation and one sum, with no per-site Python loop.
+# Blocks (default 30 days) keep the autocorrelation within each block, so the
+# intervals are not too narrow for seasonally correlated errors. Blocks are
+# cut within each run of a period (e.g. each year's JJA), never across runs.
+
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from analysis.metrics import PERIODS
+
+# Block draws evaluated at once when no batch size is given (bounds memory)
+BATCH_ELEMENTS = 2**22
+
+# Worker state, set once per process by _init_worker
+_block_data = {}
+
+
+def period_runs(times, period_months):
+    """ Run number of each time within a period: times in the same run of
+    consecutive period months (e.g. one JJA, or one DJF across the new year)
+    share it
+
+    Args:
+        times (pd.Series): datetimes, all within the period months
+        period_months (list of int): months of the period
+
+    Returns:
+        np.ndarray: number of months outside the period up to each time
+    """
+    outside = ~np.isin(np.arange(1, 13), period_months)
+    outside_before = np.cumsum(outside)  # months outside the period from January to each month
+    return times.dt.year.to_numpy() * outside.sum() + outside_before[times.dt.month.to_numpy() - 1]
+
+
+def series_block_sums(aligned, periods=PERIODS, block_length=30):
+    """ Concatenated block sums of the squared errors of every series
+
+    Blocks never span two runs of the period (e.g. August of one year and
+    June of the next for JJA): each run is cut into its own blocks, shortened
+    for runs with fewer values than the block length.
+
+    Args:
+        aligned (pd.DataFrame): output of analysis.metrics.align_sites
+        periods (dict): {period name: list of months}
+        block_length (int): block length in time steps (shortened for
+            series with fewer values)
+
+    Returns:
+        tuple: (keys, data) with keys a DataFrame of site, variable, period
+            (one row per series) and data a dict of flat NumPy arrays:
+            block_sums (sum of each possible block), block_counts (values in
+            each block), offsets (first block of each series), n_starts
+            (possible blocks) and n_blocks (blocks per resample)
+    """
+    aligned = aligned.sort_values(["site", "variable", "time"])
+    d2 = ((aligned["model"] - aligned["obs"]) ** 2).to_numpy(dtype=np.float64)
+    months = aligned["time"].dt.month.to_numpy()
+
+    keys, values, segment_lengths, segment_series = [], [], [], []
+    n_series = 0
+    for name, period_months in periods.items():
+        in_period = np.isin(months, period_months)
+        period = aligned.loc[in_period, ["site", "variable", "time"]]
+        sizes = period.groupby(["site", "variable"], observed=True, sort=True).size()
+        keys.append(sizes.reset_index(name="n").assign(period=name))
+        values.append(d2[in_period])
+
+        # A new segment starts with each series and each run of the period
+        site, variable = period["site"].to_numpy(), period["variable"].to_numpy()
+        run = period_runs(period["time"], period_months)
+        new_series = np.ones(len(period), dtype=bool)
+        new_series[1:] = (site[1:] != site[:-1]) | (variable[1:] != variable[:-1])
+        new_segment = new_series.copy()
+        new_segment[1:] |= run[1:] != run[:-1]
+        segment_starts = np.flatnonzero(new_segment)
+        segment_lengths.append(np.diff(segment_starts, append=len(period)))
+        segment_series.append(n_series + np.cumsum(new_series)[segment_starts] - 1)
+        n_series += len(sizes)
+    keys = pd.concat(keys, ignore_index=True)
+    d2 = np.concatenate(values)
+    segment_lengths = np.concatenate(segment_lengths)
+    segment_series = np.concatenate(segment_series).astype(np.int64)
+
+    n = keys["n"].to_numpy()
+    lengths = np.minimum(block_length, n)
+    segment_block = np.minimum(lengths[segment_series], segment_lengths)
+    segment_n_starts = segment_lengths - segment_block + 1
+    segment_first = np.concatenate([[0], np.cumsum(segment_lengths)[:-1]])
+
+    # Sum of the block starting at every position of every segment
+    cumsum = np.concatenate([[0.0], np.cumsum(d2)])
+    segment = np.repeat(np.arange(len(segment_lengths)), segment_n_starts)
+    segment_offsets = np.cumsum(segment_n_starts) - segment_n_starts
+    position = np.arange(segment_n_starts.sum()) - np.repeat(segment_offsets, segment_n_starts)
+    first = segment_first[segment] + position
+    block_counts = segment_block[segment]
+    block_sums = cumsum[first + block_counts] - cumsum[first]
+
+    n_starts = np.bincount(segment_series, weights=segment_n_starts, minlength=len(n)).astype(np.int64)
+    data = {
+        "block_sums": block_sums,
+        "block_counts": block_counts,
+        "offsets": np.cumsum(n_starts) - n_starts,
+        "n_starts": n_starts,
+        "n_blocks": -(-n // lengths),  # ceil
+    }
+    return keys.drop(columns="n").assign(n=n), data
+
+
+def resample_rmse(data, n_resamples, seed, batch_size=100):
+    """ Bootstrap RMSEs of every series
+
+    Args:
+        data (dict): block data from series_block_sums
+        n_resamples (int): resamples per series
+        seed (int or np.random.SeedSequence): random seed
+        batch_size (int): resamples evaluated at once (bounds memory)
+
+    Returns:
+        np.ndarray: (series, n_resamples) resampled RMSEs
+    """
+    rng = np.random.default_rng(seed)
+    n_blocks = data["n_blocks"]
+    max_blocks = n_blocks.max()
+    # Only the first n_blocks draws of each series are used
+    used = np.arange(max_blocks) < n_blocks[:, None]
+
+    out = np.empty((len(n_blocks), n_resamples))
+    for start in range(0, n_resamples, batch_size):
+        size = min(batch_size, n_resamples - start)
+        draws = rng.random((len(n_blocks), size, max_blocks))
+        index = data["offsets"][:, None, None] + (draws * data["n_starts"][:, None, None]).astype(np.int64)
+        sums = np.where(used[:, None, :], data["block_sums"][index], 0.0).sum(axis=2)
+        n_values = np.where(used[:, None, :], data["block_counts"][index], 0).sum(axis=2)
+        out[:, start:start + size] = np.sqrt(sums / n_values)
+    return out
+
+
+def _init_worker(data):
+    _block_data.update(data)
+
+
+def _resample_task(n_resamples, seed, batch_size):
+    return resample_rmse(_block_data, n_resamples, seed, batch_size)
+
+
+def bootstrap_rmse(aligned, periods=PERIODS, n_resamples=1000, block_length=30, confidence=0.95,
+                   seed=0, batch_size=None, n_workers=None):
+    """ Moving-block bootstrap confidence intervals of the RMSE of every site
+
+    Resamples are split into batches with independent random streams spawned
+    from seed, so results only depend on the data, seed and batch_size, not
+    on the number of workers.
+
+    Args:
+        aligned (pd.DataFrame): output of analysis.metrics.align_sites
+        periods (dict): {period name: list of months}
+        n_resamples (int): bootstrap resamples per site, variable and period
+        block_length (int): block length in time steps
+        confidence (float): confidence level of the percentile intervals
+        seed (int): random seed
+        batch_size (int, optional): resamples evaluated at once (default:
+            about BATCH_ELEMENTS block draws per batch)
+        n_workers (int, optional): worker processes (None or 1: run in this
+            process)
+
+    Returns:
+        pd.DataFrame: site, variable, period, rmse_ci_low, rmse_ci_high and
+            rmse_se (bootstrap standard error) columns
+    """
+    if aligned.empty:
+        return pd.DataFrame(columns=["site", "variable", "period", "rmse_ci_low", "rmse_ci_high", "rmse_se"])
+    keys, data = series_block_sums(aligned, periods, block_length)
+    if batch_size is None:
+        batch_size = max(1, BATCH_ELEMENTS // (len(keys) * int(data["n_blocks"].max())))
+    batches = [min(batch_size, n_resamples - start) for start in range(0, n_resamples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+    if n_workers is None or n_workers <= 1:
+        results = [resample_rmse(data, size, batch_seed, batch_size) for size, batch_seed in zip(batches, seeds)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers, initializer=_init_worker, initargs=(data,)
+        ) as pool:
+            results = list(pool.map(_resample_task, batches, seeds, [batch_size] * len(batches)))
+    rmse = np.concatenate(results, axis=1)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(rmse, [alpha, 1 - alpha], axis=1)
+    return pd.DataFrame({
+        "site": keys["site"].astype(str),
+        "variable": keys["variable"].astype(str),
+        "period": keys["period"],
+        "rmse_ci_low": low,
+        "rmse_ci_high": high,
+        "rmse_se": rmse.std(axis=1, ddof=1),
+    })
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# Build the memory-mapped site x day x variable cube of MiCASA and cleaned FluxNet data
+# (open it with utils.cube.open_comparison_cube)
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import MICASA_PREPROCESSED_DATA, FLUX_DATA_PATH, FLUX_METADATA, SITE_METADATA_CACHE, FLUX_CACHE_PATH, COMPARISON_CUBE_PATH
+
+from utils.site_metadata import load_site_metadata
+from utils.flux_cache import load_flux_sites
+from utils.intermediates import intermediates_path, read_intermediates
+from utils.cube import build_comparison_cube
+
+import argparse
+
+parser = argparse.ArgumentParser(description="Build the comparison cube")
+parser.add_argument("--output", type=Path, default=COMPARISON_CUBE_PATH, help="Cube directory")
+args = parser.parse_args()
+
+timedelta = "DD"
+
+fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+ids_list = fluxnet_meta.select()
+
+flux_sites = load_flux_sites(
+    FLUX_DATA_PATH, ids_list, timedelta, FLUX_CACHE_PATH,
+    on_error=lambda site_ID, e: print(f"Skipping FluxNet data for {site_ID}: {e}"),
+)
+
+micasa_all = read_intermediates(
+    intermediates_path(MICASA_PREPROCESSED_DATA, timedelta),
+    sites=ids_list, variables=["NEE", "NPP"], wide=True,
+)
+
+cube_path = build_comparison_cube(args.output, micasa_all, flux_sites, site_meta=fluxnet_meta.frame())
+print(f"Cube written to: {cube_path}")
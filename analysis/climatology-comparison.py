@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Seasonal and monthly-climatology comparison of MiCASA and FluxNet (daily data)
+#
+# One pass over the aligned data gives the metrics of every period: annual,
+# growing season (JJA for NH sites, DJF for SH sites), meteorological seasons
+# and each calendar month, with the mean MiCASA and FluxNet values (per month,
+# the mean seasonal cycle). Everything goes into one tidy table,
+# metrics_climatology.csv, with a row per site, variable and period.
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import MICASA_PREPROCESSED_DATA, FLUX_DATA_PATH, FLUX_METADATA, SITE_METADATA_CACHE, FLUX_CACHE_PATH
+
+from utils.site_metadata import load_site_metadata
+from utils.intermediates import intermediates_path, read_intermediates
+from utils.flux_cache import load_flux_sites
+from utils.manifest import atomic_write
+from utils.instrument import add_profiling_arguments, configure, stage, summary_report
+from analysis.metrics import CLIMATOLOGY_PERIODS, PERIOD_TYPES, align_sites, compute_metrics
+import argparse
+
+parser = argparse.ArgumentParser(description="User-specified parameters")
+parser.add_argument(
+    "site_IDs", type=str, nargs="*",
+    help="FluxNet/AmeriFLUX Site Identifier(s) (XX-XXX), default all FLUXNET sites",
+)
+parser.add_argument(
+    "--output-dir", type=Path, default=Path("."), help="Directory of the output CSV",
+)
+add_profiling_arguments(parser)
+args = parser.parse_args()
+configure(args.profile_log, args.cprofile_dir)
+
+timedelta = "DD"
+
+fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+site_IDs = fluxnet_meta.select(sites=args.site_IDs or None)
+hemispheres = {site_ID: "N" if fluxnet_meta.location(site_ID)[0] > 0 else "S" for site_ID in site_IDs}
+
+flux_sites = load_flux_sites(
+    FLUX_DATA_PATH, site_IDs, timedelta, FLUX_CACHE_PATH,
+    on_error=lambda site_ID, e: print(f"Skipping {site_ID}: {e}"),
+)
+
+with stage("read_intermediates", n_sites=len(flux_sites)):
+    micasa_all = read_intermediates(
+        intermediates_path(MICASA_PREPROCESSED_DATA, timedelta),
+        sites=list(flux_sites), variables=["NEE", "NPP"], wide=True,
+    )
+
+with stage("climatology", n_sites=len(flux_sites), periods=list(CLIMATOLOGY_PERIODS)):
+    aligned = align_sites(micasa_all, flux_sites)
+    metrics = compute_metrics(aligned, CLIMATOLOGY_PERIODS, hemispheres=hemispheres, means=True)
+
+# Periods in calendar order, with their type and the months each site used
+order = {name: i for i, name in enumerate(CLIMATOLOGY_PERIODS)}
+metrics.insert(3, "period_type", metrics["period"].map(PERIOD_TYPES))
+metrics.insert(4, "hemisphere", metrics["site"].map(hemispheres))
+metrics.insert(5, "months", [
+    ",".join(map(str, months[hemisphere] if isinstance(months, dict) else months))
+    for months, hemisphere in zip(metrics["period"].map(CLIMATOLOGY_PERIODS), metrics["hemisphere"])
+])
+metrics = metrics.sort_values(
+    ["site", "variable", "period"], key=lambda col: col.map(order) if col.name == "period" else col,
+    ignore_index=True,
+)
+
+args.output_dir.mkdir(parents=True, exist_ok=True)
+fname = args.output_dir / "metrics_climatology.csv"
+with atomic_write(fname) as tmp_path:
+    metrics.to_csv(tmp_path, index=False)
+print(f"CSV written to: {fname}")
+
+if args.profile_log is not None:
+    print(summary_report(args.profile_log))
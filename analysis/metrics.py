@@ -0,0 +1,192 @@
+# Vectorized MiCASA vs FluxNet comparison metrics for all sites at once
+
+import numpy as np
+import pandas as pd
+
+# Named month sets for each periodicity
+PERIODS = {
+    "ANN": list(range(1, 13)),  # annual
+    "GRW": [6, 7, 8],  # NH growing season (JJA)
+}
+
+# Meteorological seasons
+SEASONS = {
+    "DJF": [12, 1, 2],
+    "MAM": [3, 4, 5],
+    "JJA": [6, 7, 8],
+    "SON": [9, 10, 11],
+}
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Hemisphere-dependent periods map "N"/"S" to their month sets
+GROWING_SEASON = {"N": [6, 7, 8], "S": [12, 1, 2]}
+
+# Periods of the climatology mode: annual, growing season (JJA north, DJF
+# south), seasons and single months (the mean seasonal cycle), with their type
+CLIMATOLOGY_PERIODS = {
+    "ANN": list(range(1, 13)),
+    "GRW": GROWING_SEASON,
+    **SEASONS,
+    **{name: [month] for month, name in enumerate(MONTH_NAMES, start=1)},
+}
+PERIOD_TYPES = {
+    "ANN": "annual",
+    "GRW": "growing_season",
+    **{name: "season" for name in SEASONS},
+    **{name: "month" for name in MONTH_NAMES},
+}
+
+# Compared variables: (MiCASA column, FluxNet column, FluxNet scale factor)
+COMPARISONS = {
+    "NEE": ("MiCASA NEE (kg m-2 s-1)", "NEE (kgC m-2 s-1)", 1.0),
+    "NPP": ("MiCASA NPP (kg m-2 s-1)", "GPP_DT (kgC m-2 s-1)", 0.5),  # NPP ~ GPP/2
+}
+
+
+def align_sites(micasa_wide, flux_sites, comparisons=COMPARISONS):
+    """ Align MiCASA and FluxNet data for all sites into one long table
+
+    Args:
+        micasa_wide (pd.DataFrame): MiCASA intermediates indexed by (site, time),
+            e.g. read_intermediates(..., wide=True)
+        flux_sites (dict): {site ID: cleaned FluxNet DataFrame indexed by time}
+        comparisons (dict): compared variables, see COMPARISONS
+
+    Returns:
+        pd.DataFrame: site, time, variable, model (MiCASA), obs (FluxNet) columns,
+            only rows where both values are present
+    """
+    micasa = micasa_wide.reset_index()
+    micasa["site"] = micasa["site"].astype(str)
+
+    flux_cols = list({flux_col for _, flux_col, _ in comparisons.values()})
+    flux = pd.concat(
+        {site: df[flux_cols] for site, df in flux_sites.items()}, names=["site", "time"]
+    ).reset_index()
+
+    # Keep MiCASA time steps, as in the per-site comparison
+    joined = micasa.merge(flux, on=["site", "time"], how="left")
+
+    frames = []
+    for var, (micasa_col, flux_col, scale) in comparisons.items():
+        frames.append(pd.DataFrame({
+            "site": joined["site"],
+            "time": joined["time"],
+            "variable": var,
+            "model": joined[micasa_col].to_numpy(dtype=np.float64),
+            "obs": joined[flux_col].to_numpy(dtype=np.float64) * scale,
+        }))
+    aligned = pd.concat(frames, ignore_index=True).dropna(subset=["model", "obs"])
+    aligned["site"] = aligned["site"].astype("category")
+    aligned["variable"] = aligned["variable"].astype("category")
+    return aligned.reset_index(drop=True)
+
+
+def _period_mask(months, sites, period_months, hemispheres):
+    """ Rows of the monthly sums in a period, per site hemisphere for dict periods """
+    if not isinstance(period_months, dict):
+        return months.isin(period_months)
+    if hemispheres is None:
+        raise ValueError("Hemisphere-dependent periods need the site hemispheres")
+    site_hemisphere = sites.map(hemispheres)
+    mask = np.zeros(len(months), dtype=bool)
+    for hemisphere, hemisphere_months in period_months.items():
+        mask |= (site_hemisphere == hemisphere) & months.isin(hemisphere_months)
+    return mask
+
+
+def compute_metrics(aligned, periods=PERIODS, hemispheres=None, means=False):
+    """ RMSE, bias, MAE, correlation and counts per site, variable and period
+
+    The data are reduced once to per-month sums for every (site, variable);
+    each period is then just a sum over its months, so any number of periods
+    costs about the same as one.
+
+    Args:
+        aligned (pd.DataFrame): output of align_sites
+        periods (dict): {period name: list of months, or {"N": months, "S":
+            months} for hemisphere-dependent periods, e.g. GROWING_SEASON}
+        hemispheres (dict, optional): {site ID: "N" or "S"}, needed for
+            hemisphere-dependent periods (sites not listed are left out of them)
+        means (bool): also return the mean MiCASA and FluxNet values
+            (model_mean, obs_mean; per month, the mean seasonal cycle)
+
+    Returns:
+        pd.DataFrame: tidy table with site, variable, period, n, rmse, bias
+            (MiCASA - FluxNet), mae and corr columns (and model_mean, obs_mean)
+    """
+    keys = ["site", "variable"]
+    grouped = aligned.groupby(keys, observed=True)
+    # Center per site/variable so the correlation sums are well conditioned
+    x = aligned["model"] - grouped["model"].transform("mean")
+    y = aligned["obs"] - grouped["obs"].transform("mean")
+    diff = aligned["model"] - aligned["obs"]
+
+    terms = pd.DataFrame({
+        "site": aligned["site"],
+        "variable": aligned["variable"],
+        "month": aligned["time"].dt.month,
+        "n": 1,
+        "d": diff,
+        "d2": diff**2,
+        "ad": diff.abs(),
+        "x": x,
+        "y": y,
+        "x2": x**2,
+        "y2": y**2,
+        "xy": x * y,
+        "m": aligned["model"],
+        "o": aligned["obs"],
+    })
+    monthly = terms.groupby(keys + ["month"], observed=True).sum()
+
+    frames = []
+    months = monthly.index.get_level_values("month")
+    sites = monthly.index.get_level_values("site").astype(str)
+    for name, period_months in periods.items():
+        in_period = _period_mask(months, sites, period_months, hemispheres)
+        sums = monthly[in_period].groupby(level=keys, observed=True).sum()
+        sums["period"] = name
+        frames.append(sums)
+    sums = pd.concat(frames).reset_index()
+
+    n = sums["n"]
+    cov = n * sums["xy"] - sums["x"] * sums["y"]
+    var_x = n * sums["x2"] - sums["x"] ** 2
+    var_y = n * sums["y2"] - sums["y"] ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics = pd.DataFrame({
+            "site": sums["site"].astype(str),
+            "variable": sums["variable"].astype(str),
+            "period": sums["period"],
+            "n": n.astype(int),
+            "rmse": np.sqrt(sums["d2"] / n),
+            "bias": sums["d"] / n,
+            "mae": sums["ad"] / n,
+            "corr": cov / np.sqrt(var_x * var_y),
+        })
+        if means:
+            metrics["model_mean"] = sums["m"] / n
+            metrics["obs_mean"] = sums["o"] / n
+    return metrics.sort_values(["period", "site", "variable"], ignore_index=True)
+
+
+def rmse_table(metrics, period, site_list):
+    """ Per-site RMSE table for one period, in the RMSE_results_{period}.csv format
+
+    Args:
+        metrics (pd.DataFrame): output of compute_metrics
+        period (str): period name
+        site_list (list of str): sites to include (NaN where no data)
+
+    Returns:
+        pd.DataFrame: SiteID, {variable}_RMSE columns
+    """
+    table = metrics[metrics["period"] == period].pivot(
+        index="site", columns="variable", values="rmse"
+    )
+    table = table.reindex(index=list(site_list), columns=list(COMPARISONS))
+    table.columns = [f"{var}_RMSE" for var in table.columns]
+    table.index.name = "SiteID"
+    return table.reset_index()
@@ -0,0 +1,246 @@
+# Batch regressions of the site metrics (e.g. RMSE) on site covariates
+#
+# For every group (variable x period) of a site table, fits in one call:
+#  - the univariate regression on every numeric covariate at once, from
+#    column sums (one matrix product for all covariates, each using the sites
+#    where it is present),
+#  - a one-way fit on every categorical covariate (e.g. IGBP class dummies),
+#  - one multivariate least-squares fit on all the covariates (complete cases).
+# Significance comes from permutation tests: the target is shuffled across
+# sites n_permutations times, and the shuffled fits are again matrix products
+# against the same design, so screening dozens of covariates takes seconds.
+# Plotting is separate (utils.plotting.plot_regressions).
+
+import numpy as np
+import pandas as pd
+
+# Groups of the tidy metrics table fitted separately
+GROUPS = ["variable", "period"]
+
+RESULT_COLUMNS = [
+    "model", "predictors", "term", "n", "coef", "intercept", "r2", "adj_r2", "p_value", "coef_p_value",
+]
+
+
+def _permutation_p(stat, perm_stats):
+    """ One-sided permutation p-value, (1 + #{perm >= stat}) / (1 + n_permutations) """
+    # Relative tolerance so ties with the observed statistic count as exceedances
+    exceed = perm_stats >= stat - 1e-12 * np.abs(stat)
+    return (1 + exceed.sum(axis=0)) / (1 + len(perm_stats))
+
+
+def univariate_fits(X, y, perms, min_n=3):
+    """ Simple linear regression of y on each column of X, with NaNs per column
+
+    Args:
+        X (np.ndarray): (site, covariate) values, NaN where missing
+        y (np.ndarray): (site,) target, no NaNs
+        perms (np.ndarray): (permutation, site) shuffled site indices
+        min_n (int): fewest sites for a fit (NaN results otherwise)
+
+    Returns:
+        dict: (covariate,) arrays n, slope, intercept, r2 and p_value
+            (permutation test of r2, i.e. two-sided on the slope)
+    """
+    valid = ~np.isnan(X)
+    Xz = np.where(valid, X, 0.0)
+    M = valid.astype(np.float64)
+    n = M.sum(axis=0)
+    sx, sxx = Xz.sum(axis=0), (Xz**2).sum(axis=0)
+
+    def r2_stats(Y):
+        # Y: (..., site) targets -> sums over each covariate's sites
+        sy, syy, sxy = Y @ M, (Y**2) @ M, Y @ Xz
+        cov = n * sxy - sx * sy
+        var_x = n * sxx - sx**2
+        var_y = n * syy - sy**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return cov, var_x, sy, cov**2 / (var_x * var_y)
+
+    # Center y so the sums stay well conditioned (slopes and r2 are unchanged)
+    y_mean = y.mean()
+    yc = y - y_mean
+    cov, var_x, sy, r2 = r2_stats(yc)
+    perm_r2 = r2_stats(yc[perms])[3]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = cov / var_x
+        intercept = (sy - slope * sx) / n + y_mean
+    ok = (n >= min_n) & (var_x > 0)
+    nan = np.full(len(n), np.nan)
+    return {
+        "n": n.astype(int),
+        "slope": np.where(ok, slope, nan),
+        "intercept": np.where(ok, intercept, nan),
+        "r2": np.where(ok, r2, nan),
+        "p_value": np.where(ok, _permutation_p(np.where(ok, r2, 0.0), np.nan_to_num(perm_r2)), nan),
+    }
+
+
+def least_squares_fit(X, y, perms):
+    """ Least-squares fit of y on a design matrix, with permutation p-values
+
+    The coefficient p-values shuffle y as a whole, so they test each
+    coefficient against the global null of no association.
+
+    Args:
+        X (np.ndarray): (site, term) design matrix, first column the intercept
+        y (np.ndarray): (site,) target
+        perms (np.ndarray): (permutation, site) shuffled site indices
+
+    Returns:
+        dict: coef and coef_p_value (term,) arrays, r2, adj_r2 and p_value
+            (permutation test of r2)
+    """
+    n, k = X.shape
+    pinv = np.linalg.pinv(X)
+    ss_tot = ((y - y.mean()) ** 2).sum()
+
+    def fit(Y):
+        # Y: (..., site) targets -> coefficients and r2 of each
+        coef = Y @ pinv.T
+        ss_res = ((Y - coef @ X.T) ** 2).sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return coef, 1 - ss_res / ss_tot
+
+    coef, r2 = fit(y)
+    perm_coef, perm_r2 = fit(y[perms])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adj_r2 = 1 - (1 - r2) * (n - 1) / (n - k) if n > k else np.nan
+    return {
+        "coef": coef,
+        "coef_p_value": _permutation_p(np.abs(coef), np.abs(perm_coef)),
+        "r2": r2,
+        "adj_r2": adj_r2,
+        "p_value": _permutation_p(r2, perm_r2),
+    }
+
+
+def _design(df, covariates):
+    """ Intercept + numeric covariates + categorical dummies (first level dropped) """
+    # Levels absent from these rows would give all-zero dummy columns
+    columns = df[covariates].apply(
+        lambda col: col.cat.remove_unused_categories() if isinstance(col.dtype, pd.CategoricalDtype) else col
+    )
+    design = pd.get_dummies(columns, drop_first=True, dtype=np.float64)
+    design.insert(0, "intercept", 1.0)
+    return design
+
+
+def _categorical_term(covariate, column):
+    # get_dummies names a level as "{covariate}_{level}"
+    return f"{covariate}[{column[len(covariate) + 1:]}]" if column.startswith(f"{covariate}_") else column
+
+
+def regress_group(df, target, covariates, multivariate=None, n_permutations=1000, rng=None, min_n=3):
+    """ All regressions of one target on the covariates of one site table
+
+    Args:
+        df (pd.DataFrame): one row per site with target and covariate columns
+        target (str): target column (e.g. rmse)
+        covariates (list of str): covariate columns; non-numeric ones are
+            categorical
+        multivariate (list of str, optional): covariates of the multivariate
+            fit (default all, [] for none)
+        n_permutations (int): permutations of the target for the p-values
+        rng (np.random.Generator, optional): random generator
+        min_n (int): fewest sites for a fit
+
+    Returns:
+        pd.DataFrame: one row per fitted term, see regress_sites
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    df = df[df[target].notna()].reset_index(drop=True)
+    y = df[target].to_numpy(dtype=np.float64)
+    # Same permutations for every model of the group
+    perms = rng.permuted(np.tile(np.arange(len(y)), (n_permutations, 1)), axis=1)
+
+    numeric = [col for col in covariates if pd.api.types.is_numeric_dtype(df[col])]
+    categorical = [col for col in covariates if col not in numeric]
+    frames = []
+
+    if numeric:
+        fits = univariate_fits(df[numeric].to_numpy(dtype=np.float64), y, perms, min_n)
+        frames.append(pd.DataFrame({
+            "model": "univariate",
+            "predictors": numeric,
+            "term": numeric,
+            "n": fits["n"],
+            "coef": fits["slope"],
+            "intercept": fits["intercept"],
+            "r2": fits["r2"],
+            "adj_r2": np.nan,
+            "p_value": fits["p_value"],
+            "coef_p_value": fits["p_value"],
+        }))
+
+    models = [("univariate", [col]) for col in categorical]
+    multivariate = covariates if multivariate is None else multivariate
+    if multivariate:
+        models.append(("multivariate", list(multivariate)))
+    for model, predictors in models:
+        rows = df[predictors].notna().all(axis=1).to_numpy()
+        design = _design(df.loc[rows], predictors)
+        if rows.sum() < max(min_n, design.shape[1] + 1):
+            continue
+        # Shuffle within the complete cases
+        n_rows = int(rows.sum())
+        sub_perms = perms if n_rows == len(y) else rng.permuted(np.tile(np.arange(n_rows), (n_permutations, 1)), axis=1)
+        fit = least_squares_fit(design.to_numpy(), y[rows], sub_perms)
+        terms = list(design.columns[1:])
+        for predictor in predictors:
+            if predictor in categorical:
+                terms = [_categorical_term(predictor, term) for term in terms]
+        frames.append(pd.DataFrame({
+            "model": model,
+            "predictors": "+".join(predictors),
+            "term": terms,
+            "n": n_rows,
+            "coef": fit["coef"][1:],
+            "intercept": fit["coef"][0],
+            "r2": fit["r2"],
+            "adj_r2": fit["adj_r2"],
+            "p_value": fit["p_value"],
+            "coef_p_value": fit["coef_p_value"][1:],
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def regress_sites(data, target="rmse", covariates=None, groups=GROUPS, multivariate=None,
+                  n_permutations=1000, seed=0, min_n=3):
+    """ Regress a site metric on many covariates, for every group at once
+
+    Args:
+        data (pd.DataFrame): tidy metrics (e.g. metrics_results.csv) joined
+            with the site covariates, one row per site and group
+        target (str): metric column to explain
+        covariates (list of str, optional): covariate columns (default all
+            columns except site, the groups and the metric columns)
+        groups (list of str): columns fitted separately (e.g. variable, period)
+        multivariate (list of str, optional): covariates of the multivariate
+            fit (default all, [] for none)
+        n_permutations (int): permutations for the p-values
+        seed (int): random seed of the permutations
+        min_n (int): fewest sites for a fit
+
+    Returns:
+        pd.DataFrame: groups, target, model (univariate/multivariate),
+            predictors, term (covariate, or covariate[level] for categorical
+            dummies), n, coef (slope), intercept, r2, adj_r2, p_value
+            (permutation p-value of r2) and coef_p_value
+    """
+    if covariates is None:
+        metric_columns = {"n", "rmse", "bias", "mae", "corr", "rmse_ci_low", "rmse_ci_high", "rmse_se"}
+        covariates = [col for col in data.columns if col not in {"site", target, *groups} | metric_columns]
+    rng = np.random.default_rng(seed)
+
+    frames = []
+    for key, df in data.groupby(groups, sort=True) if groups else [((), data)]:
+        key = key if isinstance(key, tuple) else (key,)
+        results = regress_group(df, target, covariates, multivariate, n_permutations, rng, min_n)
+        frames.append(results.assign(**dict(zip(groups, key)), target=target))
+    results = pd.concat(frames, ignore_index=True)
+    return results[list(groups) + ["target"] + RESULT_COLUMNS]
@@ -0,0 +1,210 @@
+# One-pass multi-resolution comparison of 3-hourly MiCASA and FluxNet data
+#
+# OnlineResampler is fed aligned 3-hourly pairs (align_sites output) in any
+# number of chunks, e.g. one site at a time, and only keeps running sums per
+# (site, variable, day) and per (site, variable, hour of day). Everything else
+# is derived from those sums without going back to the 3-hourly data:
+#   3h       metrics of the native 3-hourly pairs
+#   daily    means of the 3-hourly pairs in each day
+#   monthly  means of the daily means
+#   annual   means of the monthly means
+#   diurnal  mean diurnal cycle (model and obs mean per hour of day)
+
+import numpy as np
+import pandas as pd
+
+RESOLUTIONS = ("3h", "daily", "monthly", "annual", "diurnal")
+
+# Running sums kept for each group (n, model, obs, products and errors)
+MOMENTS = ["n", "m", "o", "m2", "o2", "mo", "d2", "ad"]
+
+
+def moment_sums(aligned, keys):
+    """ Sums of the pair moments of an aligned table per group
+
+    Args:
+        aligned (pd.DataFrame): site, variable, model and obs columns plus keys
+        keys (list of str): grouping columns
+
+    Returns:
+        pd.DataFrame: MOMENTS columns indexed by keys
+    """
+    model = aligned["model"].to_numpy(dtype=np.float64)
+    obs = aligned["obs"].to_numpy(dtype=np.float64)
+    diff = model - obs
+    terms = pd.DataFrame({
+        **{key: aligned[key] for key in keys},
+        "n": 1,
+        "m": model,
+        "o": obs,
+        "m2": model**2,
+        "o2": obs**2,
+        "mo": model * obs,
+        "d2": diff**2,
+        "ad": np.abs(diff),
+    })
+    return terms.groupby(keys, observed=True).sum()
+
+
+def moment_metrics(sums):
+    """ n, RMSE, bias, MAE and correlation from moment sums (as compute_metrics) """
+    n = sums["n"]
+    cov = n * sums["mo"] - sums["m"] * sums["o"]
+    var_m = n * sums["m2"] - sums["m"] ** 2
+    var_o = n * sums["o2"] - sums["o"] ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame({
+            "n": n.astype(int),
+            "rmse": np.sqrt(sums["d2"] / n),
+            "bias": (sums["m"] - sums["o"]) / n,
+            "mae": sums["ad"] / n,
+            "corr": cov / np.sqrt(var_m * var_o),
+        }, index=sums.index)
+
+
+def _coverage_means(sums, min_count):
+    """ model/obs means of groups with at least min_count values (array or scalar) """
+    keep = sums["n"] >= min_count
+    sums = sums[keep]
+    return pd.DataFrame({
+        "n": sums["n"].astype(int),
+        "model": sums["m"] / sums["n"],
+        "obs": sums["o"] / sums["n"],
+    }, index=sums.index)
+
+
+class OnlineResampler:
+    """ Accumulate 3-hourly MiCASA/FluxNet pairs and resample them in one pass
+
+        resampler = OnlineResampler()
+        for site_ID in sites:
+            resampler.update(align_sites(micasa_site, {site_ID: flux_site}), {site_ID: utc_offset})
+        metrics = resampler.metrics()
+        cycle = resampler.diurnal_cycle()
+
+    Args:
+        min_coverage (float): fraction of the sub-periods needed for a mean
+            (3-hourly windows in a day, days in a month, months in a year)
+        windows_per_day (int): 3-hourly windows in a day
+    """
+
+    def __init__(self, min_coverage=0.75, windows_per_day=8):
+        self.min_coverage = min_coverage
+        self.windows_per_day = windows_per_day
+        self._daily = []
+        self._hourly = []
+
+    def update(self, aligned, utc_offsets=None):
+        """ Add a chunk of aligned 3-hourly pairs
+
+        Args:
+            aligned (pd.DataFrame): align_sites output (site, time, variable,
+                model, obs), times in UTC
+            utc_offsets (dict, optional): {site ID: pd.Timedelta} local standard
+                time offsets (see utils.functions.site_utc_offset). Diurnal
+                cycles and days are in local standard time when given, in UTC
+                otherwise.
+        """
+        if not len(aligned):
+            return
+        time = aligned["time"]
+        if utc_offsets is not None:
+            offsets = aligned["site"].astype(str).map(utc_offsets)
+            time = time + pd.to_timedelta(offsets.fillna(pd.Timedelta(0)))
+        chunk = aligned.assign(day=time.dt.floor("D"), hour=time.dt.hour)
+
+        self._daily.append(moment_sums(chunk, ["site", "variable", "day"]))
+        self._hourly.append(moment_sums(chunk, ["site", "variable", "hour"]))
+
+    @staticmethod
+    def _combine(partials, keys):
+        """ Sums of partial sums (groups split across chunks are added up) """
+        if not partials:
+            return pd.DataFrame(columns=MOMENTS, index=pd.MultiIndex.from_tuples([], names=keys))
+        return pd.concat(partials).groupby(level=keys, observed=True).sum()
+
+    def daily_sums(self):
+        return self._combine(self._daily, ["site", "variable", "day"])
+
+    def hourly_sums(self):
+        return self._combine(self._hourly, ["site", "variable", "hour"])
+
+    def resample(self, resolution):
+        """ Paired means at a resolution, in the align_sites layout
+
+        Args:
+            resolution (str): daily, monthly or annual
+
+        Returns:
+            pd.DataFrame: site, time (period start), variable, n (sub-periods
+                averaged), model and obs columns
+        """
+        daily = _coverage_means(self.daily_sums(), self.min_coverage * self.windows_per_day)
+        daily.index = daily.index.rename("time", level="day")
+        if resolution == "daily":
+            return daily.reset_index()
+
+        # Mean of daily means, needing min_coverage of the days in the month
+        time = daily.index.get_level_values("time")
+        month = time.to_period("M").to_timestamp()
+        grouped = daily[["model", "obs"]].groupby(
+            [daily.index.get_level_values("site"), daily.index.get_level_values("variable"), month],
+            observed=True,
+        )
+        monthly = grouped.mean().assign(n=grouped.size())
+        monthly.index.names = ["site", "variable", "time"]
+        days_in_month = monthly.index.get_level_values("time").days_in_month
+        monthly = monthly[monthly["n"] >= self.min_coverage * np.asarray(days_in_month)]
+        if resolution == "monthly":
+            return monthly.reset_index()[["site", "time", "variable", "n", "model", "obs"]]
+
+        if resolution == "annual":
+            time = monthly.index.get_level_values("time")
+            grouped = monthly[["model", "obs"]].groupby(
+                [monthly.index.get_level_values("site"), monthly.index.get_level_values("variable"),
+                 time.to_period("Y").to_timestamp()],
+                observed=True,
+            )
+            annual = grouped.mean().assign(n=grouped.size())
+            annual.index.names = ["site", "variable", "time"]
+            annual = annual[annual["n"] >= self.min_coverage * 12]
+            return annual.reset_index()[["site", "time", "variable", "n", "model", "obs"]]
+
+        raise ValueError(f"Resolution {resolution} invalid")
+
+    def diurnal_cycle(self):
+        """ Mean diurnal cycle and per-hour errors of each site and variable
+
+        Returns:
+            pd.DataFrame: site, variable, hour, n, model and obs (mean over
+                all days), rmse, bias, mae and corr of the 3-hourly pairs at
+                that hour
+        """
+        sums = self.hourly_sums()
+        cycle = _coverage_means(sums, 1)[["model", "obs"]].join(moment_metrics(sums))
+        return cycle.reset_index()
+
+    def metrics(self):
+        """ Metrics of every resolution, in one tidy table
+
+        The diurnal row compares the mean diurnal cycles (one value per hour).
+
+        Returns:
+            pd.DataFrame: site, variable, resolution, n, rmse, bias, mae, corr
+        """
+        keys = ["site", "variable"]
+        frames = {"3h": moment_metrics(self.daily_sums().groupby(level=keys, observed=True).sum())}
+        for resolution in ("daily", "monthly", "annual"):
+            frames[resolution] = moment_metrics(moment_sums(self.resample(resolution), keys))
+        cycle = self.diurnal_cycle()
+        frames["diurnal"] = moment_metrics(moment_sums(cycle, keys))
+
+        metrics = pd.concat(frames, names=["resolution"]).reset_index()
+        metrics["site"] = metrics["site"].astype(str)
+        metrics["variable"] = metrics["variable"].astype(str)
+        order = {resolution: i for i, resolution in enumerate(RESOLUTIONS)}
+        metrics = metrics.sort_values(
+            ["site", "variable", "resolution"], key=lambda col: col.map(order) if col.name == "resolution" else col,
+            ignore_index=True,
+        )
+        return metrics[["site", "variable", "resolution", "n", "rmse", "bias", "mae", "corr"]]
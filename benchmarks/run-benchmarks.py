@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Benchmark the preprocessing -> RMSE -> plotting pipeline on synthetic data
+#
+# Generates a synthetic archive (sites x years x cadence), runs every stage in
+# a fresh process and writes wall time, peak RSS, bytes read and files opened
+# as JSON. Exits non-zero if a stage fails or, with --baseline, if a stage got
+# slower than allowed.
+#
+# Example:
+#   python benchmarks/run-benchmarks.py --sites 20 --years 2 --output bench.json
+#   python benchmarks/run-benchmarks.py --sites 20 --years 2 --baseline bench.json
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic import make_synthetic_archive
+from benchmarks.stages import STAGES, DD_ONLY_STAGES, run_stage, stage_environment
+
+# Import other modules
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+
+
+def run_isolated(stage, archive, work_dir, timedelta):
+    """ Run one stage in a fresh process so imports and peak RSS are its own
+
+    The process is started with the environment of stage_environment, so
+    config.py points at the synthetic archive from the first import.
+    """
+    saved_environ = dict(os.environ)
+    os.environ.update(stage_environment(archive, work_dir))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            return pool.submit(run_stage, stage, archive, work_dir, timedelta).result()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """ Stages whose mean wall time exceeds the baseline by more than tolerance """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def mean_times(records):
+        times = {}
+        for record in records:
+            if "error" not in record:
+                times.setdefault(record["stage"], []).append(record["wall_time_s"])
+        return {stage: sum(values) / len(values) for stage, values in times.items()}
+
+    old, new = mean_times(baseline["results"]), mean_times(results)
+    regressions = {}
+    for stage in old.keys() & new.keys():
+        if new[stage] > old[stage] * (1 + tolerance):
+            regressions[stage] = {"baseline_s": old[stage], "current_s": new[stage]}
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    parser.add_argument("--sites", type=int, default=10, help="Number of sites")
+    parser.add_argument("--years", type=int, default=2, help="Years of data per site")
+    parser.add_argument("--timedelta", type=str, default="DD", choices=["DD", "HH"], help="FLUXNET time step")
+    parser.add_argument("--resolution", type=float, default=1.0, help="MiCASA grid spacing (degrees)")
+    parser.add_argument("--extra-columns", type=int, default=40, help="Unused FLUXNET CSV columns")
+    parser.add_argument(
+        "--stages", type=str, nargs="+", default=list(STAGES), choices=list(STAGES),
+        help="Stages to run, in pipeline order (RMSE and plot need extract)",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per stage")
+    parser.add_argument("--work-dir", type=Path, default=None, help="Directory for data and outputs (default: temporary)")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    parser.add_argument("--output", type=Path, default=None, help="JSON results file (default: stdout)")
+    parser.add_argument("--baseline", type=Path, default=None, help="Previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown vs the baseline (fraction)")
+    args = parser.parse_args()
+
+    work_root = Path(args.work_dir or tempfile.mkdtemp(prefix="fluxnet-bench-"))
+    work_root.mkdir(parents=True, exist_ok=True)
+    stages = [stage for stage in STAGES if stage in args.stages]
+    if args.timedelta != "DD":
+        stages = [stage for stage in stages if stage not in DD_ONLY_STAGES]
+
+    try:
+        print(f"Generating synthetic archive in {work_root}", file=sys.stderr)
+        archive = make_synthetic_archive(
+            work_root / "archive", n_sites=args.sites, n_years=args.years,
+            timedelta=args.timedelta, resolution=args.resolution, extra_columns=args.extra_columns,
+        )
+
+        results = []
+        for repeat in range(args.repeat):
+            # Fresh outputs for each repeat (the drivers skip sites already done)
+            run_dir = work_root / f"run-{repeat}"
+            shutil.rmtree(run_dir, ignore_errors=True)
+            run_dir.mkdir()
+            for stage in stages:
+                record = run_isolated(stage, archive, run_dir, args.timedelta)
+                record["repeat"] = repeat
+                results.append(record)
+                status = record.get("error", f"{record['wall_time_s']:.2f} s, {record['peak_rss_bytes'] / 2**20:.0f} MiB")
+                print(f"[{repeat}] {stage}: {status}", file=sys.stderr)
+
+        report = {
+            "config": {
+                "sites": args.sites, "years": args.years, "timedelta": args.timedelta,
+                "resolution": args.resolution, "extra_columns": args.extra_columns,
+                "n_micasa_files": archive["n_micasa_files"], "repeat": args.repeat,
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "results": results,
+        }
+
+        regressions = {}
+        if args.baseline is not None:
+            regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+            report["regressions"] = regressions
+
+        if args.output is None:
+            print(json.dumps(report, indent=2, default=str))
+        else:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2, default=str)
+            print(f"Results written to: {args.output}", file=sys.stderr)
+
+    finally:
+        if not args.keep and args.work_dir is None:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    errors = {record["stage"]: record["error"] for record in results if "error" in record}
+    if errors:
+        print(f"Failed stages: {errors}", file=sys.stderr)
+    if regressions:
+        print(f"Regressions beyond {args.tolerance:.0%}: {regressions}", file=sys.stderr)
+    if errors or regressions:
+        sys.exit(1)
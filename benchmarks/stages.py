@@ -0,0 +1,167 @@
+# Pipeline stages timed by run-benchmarks.py, each run in a fresh process
+#
+# The stages call the same code as the drivers, pointed at a synthetic archive
+# (see benchmarks/synthetic.py) through the FLUXNET_* settings of config.py:
+# run_stage must run in a process started with stage_environment, so every
+# module sees the benchmark paths from its first config import.
+
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+from config import (
+    ENV_PREFIX, SETTINGS, FLUX_DATA_PATH, FLUX_METADATA, FLUX_CACHE_PATH,
+    MICASA_DATA_PATH, MICASA_INDEX, MICASA_PREPROCESSED_DATA,
+)
+from utils.functions import import_flux_metadata, import_flux_site_data, build_micasa_index
+from utils.flux_cache import load_flux_sites
+from utils.intermediates import intermediates_path, read_intermediates
+from analysis.metrics import PERIODS, align_sites, compute_metrics, rmse_table
+import preprocessing.tasks as tasks
+
+
+def stage_settings(archive, work_dir):
+    """ config.py settings of the stages: inputs from the archive, outputs in work_dir """
+    work_dir = Path(work_dir)
+    return {
+        "DATA_FILEPATH": work_dir / "data",
+        "MICASA_DATA_PATH": Path(archive["micasa"]),
+        "MICASA_INDEX": work_dir / "micasa-file-index.sqlite",
+        "MICASA_STORE_PATH": work_dir / "MiCASA_data",
+        "MICASA_PREPROCESSED_DATA": work_dir / "intermediates",
+        "COMPARISON_CUBE_PATH": work_dir / "comparison-cube",
+        "GRID_INDEX_PATH": work_dir / "grid-index",
+        "TASK_STATUS_PATH": work_dir / "task-status.sqlite",
+        "MANIFEST_PATH": work_dir / "run-manifest.sqlite",
+        "FLUX_DATA_PATH": Path(archive["flux"]),
+        "FLUX_METADATA": Path(archive["metadata"]),
+        "SITE_METADATA_CACHE": work_dir / "site-metadata",
+        "FLUX_CACHE_PATH": work_dir / "flux-cache",
+    }
+
+
+def stage_environment(archive, work_dir):
+    """ Environment variables overriding config.py with stage_settings """
+    env = {ENV_PREFIX + name: str(path) for name, path in stage_settings(archive, work_dir).items()}
+    # Ignore the user's fluxnet.toml (there is no config file in work_dir)
+    env["FLUXNET_CONFIG"] = str(Path(work_dir) / "fluxnet.toml")
+    return env
+
+
+def site_rows():
+    """ (site ID, lat, lon) of every site in the archive metadata """
+    fluxnet_meta = import_flux_metadata(FLUX_METADATA)
+    return list(fluxnet_meta[["Site ID", "Latitude (degrees)", "Longitude (degrees)"]].itertuples(index=False))
+
+
+def stage_import_flux(archive, work_dir, timedelta):
+    """ import_flux_site_data for every site """
+    rows = site_rows()
+    n_records = 0
+    for site_ID, site_lat, site_lon in rows:
+        n_records += len(import_flux_site_data(FLUX_DATA_PATH, site_ID, timedelta, site_lat, site_lon))
+    return {"n_sites": len(rows), "n_records": n_records}
+
+
+def stage_extract(archive, work_dir, timedelta):
+    """ Per-site MiCASA extraction as run by data-preprocessing.py """
+    # The controller refreshes the index once before running the sites
+    build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX, cadences=(tasks.MICASA_CADENCES[timedelta],))
+    rows = site_rows()
+    for site_ID, site_lat, site_lon in rows:
+        tasks.preprocess_site(site_ID, site_lat, site_lon, timedelta)
+    return {"n_sites": len(rows), "n_micasa_files": archive["n_micasa_files"]}
+
+
+def stage_RMSE(archive, work_dir, timedelta):
+    """ Metrics for all sites and periods as run by RMSE_calc.py """
+    ids_list = [row[0] for row in site_rows()]
+    flux_sites = load_flux_sites(FLUX_DATA_PATH, ids_list, timedelta, FLUX_CACHE_PATH)
+    micasa_all = read_intermediates(
+        intermediates_path(MICASA_PREPROCESSED_DATA, timedelta),
+        sites=ids_list, variables=["NEE", "NPP"], wide=True,
+    )
+    metrics = compute_metrics(align_sites(micasa_all, flux_sites), PERIODS)
+    for period in PERIODS:
+        rmse_table(metrics, period, ids_list).to_csv(Path(work_dir) / f"RMSE_results_{period}.csv", index=False)
+    return {"n_sites": len(ids_list), "n_metrics": len(metrics)}
+
+
+def stage_plot(archive, work_dir, timedelta):
+    """ Site figures as rendered by plots-generator-wrapper.py (one worker) """
+    import plotting.site_plots as site_plots
+
+    rows = site_rows()
+    for site_ID, site_lat, site_lon in rows:
+        site_plots.render_site_plot(site_ID, site_lat, site_lon, timedelta, Path(work_dir) / "plots")
+    return {"n_sites": len(rows)}
+
+
+STAGES = {
+    "import_flux": stage_import_flux,
+    "extract": stage_extract,
+    "RMSE": stage_RMSE,
+    "plot": stage_plot,
+}
+
+# Stages that only exist for daily data
+DD_ONLY_STAGES = ("RMSE", "plot")
+
+
+def read_bytes():
+    """ Bytes read by this process, including reads by C libraries (Linux only) """
+    try:
+        with open("/proc/self/io") as f:
+            return int(next(line for line in f if line.startswith("rchar:")).split()[1])
+    except OSError:
+        return None
+
+
+def run_stage(stage, archive, work_dir, timedelta):
+    """ Run a stage, measuring wall time, peak RSS, bytes read and files opened
+
+    Files opened are counted through the "open" audit event, restricted to the
+    archive and work directories. Files opened from C (e.g. netCDF4) are not
+    seen there; their reads are still included in read_bytes.
+
+    Returns:
+        dict: measurements and stage details ("error" if the stage failed)
+
+    Raises:
+        RuntimeError: config.py was not overridden with stage_environment
+    """
+    # Refuse to run against the paths of a real configuration
+    unset = [name for name, path in stage_settings(archive, work_dir).items() if SETTINGS[name] != path]
+    if unset:
+        raise RuntimeError(f"config.py settings not pointed at the benchmark (see stage_environment): {', '.join(unset)}")
+
+    roots = tuple(str(Path(root).resolve()) for root in (archive["flux"], archive["micasa"], work_dir))
+    opened = set()
+
+    def audit(event, args):
+        if event == "open" and isinstance(args[0], (str, bytes, os.PathLike)):
+            path = os.path.abspath(os.fsdecode(args[0]))
+            if path.startswith(roots):
+                opened.add(path)
+
+    sys.addaudithook(audit)
+    bytes_before = read_bytes()
+    start = time.perf_counter()
+    try:
+        details = STAGES[stage](archive, work_dir, timedelta)
+    except Exception as e:
+        details = {"error": repr(e)}
+    wall_time = time.perf_counter() - start
+    bytes_after = read_bytes()
+
+    return {
+        "stage": stage,
+        "wall_time_s": round(wall_time, 4),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "read_bytes": None if bytes_before is None else bytes_after - bytes_before,
+        "files_opened": len(opened),
+        **details,
+    }
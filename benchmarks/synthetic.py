@@ -0,0 +1,173 @@
+# Synthetic MiCASA and AmeriFlux data for the benchmarks
+#
+# Files follow the layout and naming of the real archives so the pipeline code
+# runs on them unchanged:
+#   micasa/{daily,3hrly}/YYYY/MM/MiCASA_v1_flux_x{nx}_y{ny}_{cadence}_YYYYMMDD.nc4
+#   flux/AMF_{site}_FLUXNET_SUBSET_{years}/AMF_{site}_FLUXNET_SUBSET_{DD,HH}_{years}.csv
+#   AmeriFlux-site-search-results.tsv
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+
+# MiCASA cadence directory for each FluxNet timedelta (as preprocessing.tasks.MICASA_CADENCES)
+CADENCES = {"DD": "daily", "HH": "3hrly"}
+
+
+def synthetic_sites(n_sites, seed=0):
+    """ Random site IDs and locations over the Americas
+
+    Returns:
+        pd.DataFrame: Site ID, Latitude (degrees), Longitude (degrees)
+    """
+    rng = np.random.default_rng(seed)
+    lats = np.concatenate([
+        rng.uniform(25, 70, n_sites - n_sites // 5),  # mostly North America
+        rng.uniform(-40, 15, n_sites // 5),
+    ])
+    return pd.DataFrame({
+        "Site ID": [f"XX-{i:03d}" for i in range(n_sites)],
+        "Latitude (degrees)": np.round(lats, 4),
+        "Longitude (degrees)": np.round(rng.uniform(-125, -60, n_sites), 4),
+    })
+
+
+def write_metadata(out_dir, sites, years):
+    """ AmeriFlux site search TSV with every site flagged as FLUXNET """
+    meta = sites.copy()
+    meta["Name"] = "Synthetic site " + meta["Site ID"]
+    meta["AmeriFlux FLUXNET Data"] = "Yes"
+    meta["Years of AmeriFlux FLUXNET Data"] = ", ".join(str(year) for year in years)
+    meta["Vegetation Abbreviation (IGBP)"] = "GRA"
+    path = Path(out_dir) / "AmeriFlux-site-search-results.tsv"
+    meta.to_csv(path, sep="\t", index=False)
+    return path
+
+
+def write_flux_csv(out_dir, site_ID, years, timedelta="DD", extra_columns=40, seed=0):
+    """ AmeriFlux FLUXNET SUBSET CSV for one site
+
+    Args:
+        out_dir (Path object): flux data root
+        site_ID (str): site ID
+        years (list of int): consecutive years of data
+        timedelta (str): DD (gC m-2 d-1) or HH (umolCO2 m-2 s-1)
+        extra_columns (int): unused columns added to match the real file width
+        seed (int): random seed
+
+    Returns:
+        Path object: CSV path
+    """
+    rng = np.random.default_rng(seed)
+    span = f"{years[0]}-{years[-1]}"
+    site_dir = Path(out_dir) / f"AMF_{site_ID}_FLUXNET_SUBSET_{span}_3-5"
+    site_dir.mkdir(parents=True, exist_ok=True)
+    path = site_dir / f"AMF_{site_ID}_FLUXNET_SUBSET_{timedelta}_{span}_3-5.csv"
+
+    if timedelta == "DD":
+        time = pd.date_range(f"{years[0]}-01-01", f"{years[-1]}-12-31", freq="D")
+        df = pd.DataFrame({"TIMESTAMP": time.strftime("%Y%m%d")})
+        scale, qc = 5.0, rng.choice([0.5, 1.0], len(time), p=[0.1, 0.9])
+    else:
+        time = pd.date_range(f"{years[0]}-01-01", f"{years[-1]}-12-31 23:30", freq="30min")
+        df = pd.DataFrame({
+            "TIMESTAMP_START": time.strftime("%Y%m%d%H%M"),
+            "TIMESTAMP_END": (time + pd.Timedelta("30min")).strftime("%Y%m%d%H%M"),
+        })
+        scale, qc = 10.0, rng.choice([0, 1, 2, 3], len(time), p=[0.5, 0.3, 0.1, 0.1])
+
+    season = np.sin(2 * np.pi * (time.dayofyear.values - 100) / 365)
+    gpp = np.clip(scale * (1 + season) + rng.normal(0, 1, len(time)), 0, None)
+    df["NEE_VUT_REF"] = -0.6 * gpp + rng.normal(0, 1, len(time))
+    df["NEE_VUT_REF_QC"] = qc
+    df["GPP_NT_VUT_REF"] = gpp + rng.normal(0, 0.5, len(time))
+    df["GPP_DT_VUT_REF"] = gpp
+    for i in range(extra_columns):
+        df[f"EXTRA_{i}"] = rng.normal(0, 1, len(time)).round(3)
+
+    # Gaps as in the real files
+    gaps = rng.random(len(time)) < 0.02
+    df.loc[gaps, ["NEE_VUT_REF", "NEE_VUT_REF_QC"]] = -9999
+    df.to_csv(path, index=False, float_format="%.5f")
+    return path
+
+
+def write_micasa_files(out_dir, years, cadence="daily", resolution=1.0, seed=0):
+    """ One MiCASA-shaped NetCDF file per day (8 time steps per file for 3hrly)
+
+    Args:
+        out_dir (Path object): MiCASA data root
+        years (list of int): years of files
+        cadence (str): daily or 3hrly
+        resolution (float): grid spacing in degrees (MiCASA is 0.1)
+        seed (int): random seed
+
+    Returns:
+        int: number of files written
+    """
+    rng = np.random.default_rng(seed)
+    lat = np.arange(-90 + resolution / 2, 90, resolution)
+    lon = np.arange(-180 + resolution / 2, 180, resolution)
+    steps = 8 if cadence == "3hrly" else 1
+
+    n_files = 0
+    for day in pd.date_range(f"{years[0]}-01-01", f"{years[-1]}-12-31", freq="D"):
+        month_dir = Path(out_dir) / cadence / f"{day:%Y}" / f"{day:%m}"
+        month_dir.mkdir(parents=True, exist_ok=True)
+        time = day + pd.to_timedelta(np.arange(steps) * 3, unit="h")
+        shape = (steps, len(lat), len(lon))
+        ds = xr.Dataset(
+            {
+                "NEE": (("time", "lat", "lon"), rng.normal(0, 1e-8, shape).astype(np.float32)),
+                "NPP": (("time", "lat", "lon"), rng.uniform(0, 5e-8, shape).astype(np.float32)),
+            },
+            coords={"time": time, "lat": lat, "lon": lon},
+        )
+        for var in ds.data_vars:
+            ds[var].attrs["units"] = "kg m-2 s-1"
+        name = f"MiCASA_v1_flux_x{len(lon)}_y{len(lat)}_{cadence}_{day:%Y%m%d}.nc4"
+        ds.to_netcdf(
+            month_dir / name,
+            encoding={var: {"zlib": True, "complevel": 1} for var in ds.data_vars},
+        )
+        n_files += 1
+    return n_files
+
+
+def make_synthetic_archive(out_dir, n_sites=10, n_years=2, timedelta="DD", resolution=1.0,
+                           start_year=2001, extra_columns=40, seed=0):
+    """ Write a complete synthetic archive (metadata, FLUXNET CSVs, MiCASA files)
+
+    Args:
+        out_dir (Path object): archive root
+        n_sites (int): number of sites
+        n_years (int): years of data per site
+        timedelta (str): DD or HH (FLUXNET CSVs and the matching MiCASA cadence)
+        resolution (float): MiCASA grid spacing in degrees
+        start_year (int): first year
+        extra_columns (int): unused FLUXNET columns
+        seed (int): random seed
+
+    Returns:
+        dict: paths of the archive parts (metadata, flux, micasa) and file counts
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    years = list(range(start_year, start_year + n_years))
+    sites = synthetic_sites(n_sites, seed)
+
+    flux_path = out_dir / "flux"
+    micasa_path = out_dir / "micasa"
+    metadata = write_metadata(out_dir, sites, years)
+    for i, site_ID in enumerate(sites["Site ID"]):
+        write_flux_csv(flux_path, site_ID, years, timedelta, extra_columns, seed + i)
+    n_files = write_micasa_files(micasa_path, years, CADENCES[timedelta], resolution, seed)
+
+    return {
+        "metadata": metadata,
+        "flux": flux_path,
+        "micasa": micasa_path,
+        "n_sites": n_sites,
+        "n_micasa_files": n_files,
+    }
@@ -1,29 +1,76 @@
- # =============================================================================
+# =============================================================================
 # DATA CONFIGURATION
 # =============================================================================
 # The datasets used in this repository are note included in this repo but are publicly available.
-# 
+#
 # Instructions:
 #FIX: add the directions to download the dataset
-# 2. Update DATASET_PATH below to point to your file
+# 2. Point the paths below to your copy of the data, either with environment
+#    variables (FLUXNET_<SETTING>, e.g. FLUXNET_DATA_FILEPATH=/path/to/data) or
+#    in a TOML file (fluxnet.toml in the repo, or the file named by
+#    FLUXNET_CONFIG), see fluxnet.example.toml. Environment variables win over
+#    the file; unset settings default to the locations below.
 
 # =============================================================================
+import os
+import tomllib
 from pathlib import Path
 
+ENV_PREFIX = "FLUXNET_"
+CONFIG_FILE = Path(os.environ.get("FLUXNET_CONFIG", Path(__file__).resolve().parent / "fluxnet.toml"))
+
+
+def _load_config_file(config_file):
+    """ [paths] table of the TOML config file (empty if there is no file) """
+    if not config_file.is_file():
+        return {}
+    with open(config_file, "rb") as f:
+        return {key.upper(): value for key, value in tomllib.load(f).get("paths", {}).items()}
+
+
+_file_settings = _load_config_file(CONFIG_FILE)
+
+# Resolved settings, {name: Path}, in definition order
+SETTINGS = {}
+
+
+def _path_setting(name, default):
+    """ Path setting from the environment, else the config file, else default """
+    value = os.environ.get(ENV_PREFIX + name, _file_settings.get(name))
+    SETTINGS[name] = Path(value).expanduser() if value is not None else Path(default)
+    return SETTINGS[name]
+
+
 # Set repo and dataset filepaths
-REPO_FILEPATH = Path("/discover/nobackup/hzafar/ghgc/micasa/FLUXNET-Model-comparison/")
-DATA_FILEPATH = Path("/discover/nobackup/hzafar/ghgc/micasa/FLUXNET-Model-comparison/data/")
+REPO_FILEPATH = _path_setting("REPO_FILEPATH", Path(__file__).resolve().parent)
+DATA_FILEPATH = _path_setting("DATA_FILEPATH", REPO_FILEPATH / "data")
 
 # Micasa data directory
-MICASA_DATA_PATH = DATA_FILEPATH / "micasa-data"
+MICASA_DATA_PATH = _path_setting("MICASA_DATA_PATH", DATA_FILEPATH / "micasa-data")
+# Micasa file index (generated by build_micasa_index)
+MICASA_INDEX = _path_setting("MICASA_INDEX", DATA_FILEPATH / "micasa-file-index.sqlite")
+# Micasa virtual/rechunked stores (generated by data/MiCASA_data/make_virtual_dataset.py)
+MICASA_STORE_PATH = _path_setting("MICASA_STORE_PATH", DATA_FILEPATH / "MiCASA_data")
 # Micasa preprocessed data (generated by data-preprocessing.py)
-MICASA_PREPROCESSED_DATA = REPO_FILEPATH / "preprocessing" / "intermediates"
+MICASA_PREPROCESSED_DATA = _path_setting("MICASA_PREPROCESSED_DATA", REPO_FILEPATH / "preprocessing" / "intermediates")
+# Memory-mapped site x day x variable cube (generated by analysis/build-cube.py)
+COMPARISON_CUBE_PATH = _path_setting("COMPARISON_CUBE_PATH", REPO_FILEPATH / "preprocessing" / "comparison-cube")
+# Site -> grid cell indexes of the model grids (see utils/grid_index.py)
+GRID_INDEX_PATH = _path_setting("GRID_INDEX_PATH", REPO_FILEPATH / "preprocessing" / "grid-index")
+# Status of the per-site tasks of batch runs, for --resume (see preprocessing/task_status.py)
+TASK_STATUS_PATH = _path_setting("TASK_STATUS_PATH", REPO_FILEPATH / "preprocessing" / "task-status.sqlite")
+# Run manifest of completed pipeline stages (see utils/manifest.py)
+MANIFEST_PATH = _path_setting("MANIFEST_PATH", REPO_FILEPATH / "preprocessing" / "run-manifest.sqlite")
 
 
 # Flux data directory
-FLUX_DATA_PATH = DATA_FILEPATH / "ameriflux-data/"
+FLUX_DATA_PATH = _path_setting("FLUX_DATA_PATH", DATA_FILEPATH / "ameriflux-data")
 # Flux metadata file
-FLUX_METADATA = FLUX_DATA_PATH / "AmeriFlux-site-search-results-202410071335.tsv"
+FLUX_METADATA = _path_setting("FLUX_METADATA", FLUX_DATA_PATH / "AmeriFlux-site-search-results-202410071335.tsv")
+# Parsed flux metadata cache (see utils/site_metadata.py)
+SITE_METADATA_CACHE = _path_setting("SITE_METADATA_CACHE", REPO_FILEPATH / "preprocessing" / "site-metadata")
+# Cleaned flux data cache (generated by utils/flux_cache.py)
+FLUX_CACHE_PATH = _path_setting("FLUX_CACHE_PATH", REPO_FILEPATH / "preprocessing" / "flux-cache")
 
 # MERRA-2 Dataset Virtual Stores
-MERRA_DATA_PATH = DATA_FILEPATH / "MERRA_data/"
+MERRA_DATA_PATH = _path_setting("MERRA_DATA_PATH", DATA_FILEPATH / "MERRA_data")
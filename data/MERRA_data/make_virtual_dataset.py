@@ -1,44 +1,55 @@
 #!/usr/bin/env python
-# Process MERRA-2 data for fluxnet analysis
+# Process MERRA-2 data for fluxnet analysis: build one virtual reference store
+# over any number of variables/collections
+#
+# Per-file references are built in parallel and checkpointed under
+# MERRA_DATA_PATH/references, so rerunning after an interruption resumes.
 
-from merra2_tools import MERRA2_ROOT, find_MERRA2_files, create_vzarr_store
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from config import MERRA_DATA_PATH
+
+from utils.merra import (
+    MERRA2_COLLECTIONS,
+    build_file_references,
+    combine_merra2_references,
+    write_reference_store,
+)
+from merra2_tools import MERRA2_ROOT, find_MERRA2_files
 import argparse
 
-# NOTE: How am I going to select years, if Amerflux years varies across sites?
-# AmeriFlux FLUXNET spans 1991-2021 across all the sites, individual sites vary, let's just start with that
+# AmeriFlux FLUXNET spans 1991-2021 across all the sites, individual sites vary
+# (per-site year windows are applied when sampling, see utils.merra.sample_merra2_sites)
 parser = argparse.ArgumentParser(description="Dataset selection")
-varlist = ["T2M", "PRECTOTCORR"]
 parser.add_argument(
-    "var",
-    metavar="var",
-    type=str,
-    choices=varlist,
-    help=f"Data variable choice: {', '.join(varlist)}",
-)
-var = parser.parse_args().var
-
-start_yr, end_yr = [1991, 2021]
-if var == "T2M":
-    freq1 = "tavg"
-    freq2 = "M"
-    group = "slv"
-
-if var == "PRECTOTCORR":
-    freq1 = "tavg"
-    freq2 = "M"
-    group = "flx"
-
-else:
-    print("var not yet supported")
-    sys.exit()
-
-details, fileslist = find_MERRA2_files(
-    MERRA2_ROOT, freq1, freq2, group, start_yr, end_yr
+    "var", metavar="var", type=str, nargs="+", choices=list(MERRA2_COLLECTIONS),
+    help=f"Data variable choice(s): {', '.join(MERRA2_COLLECTIONS)}",
 )
-print(details)
-import sys
-
-sys.exit()
-
-vstore_loc = create_vzarr_store(details, fileslist)
-print(vstore_loc)
+parser.add_argument("--start-yr", type=int, default=1991, help="First year to include")
+parser.add_argument("--end-yr", type=int, default=2021, help="Last year to include")
+parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+parser.add_argument("--name", type=str, default=None, help="Store name (default from variables and years)")
+args = parser.parse_args()
+
+# Group the requested variables by collection, each collection's files are scanned once
+collections = {}
+for var in args.var:
+    collections.setdefault(MERRA2_COLLECTIONS[var], []).append(var)
+
+ref_lists = {}
+for (freq1, freq2, group), var_list in collections.items():
+    details, fileslist = find_MERRA2_files(
+        MERRA2_ROOT, freq1, freq2, group, args.start_yr, args.end_yr
+    )
+    print(details)
+    checkpoint_dir = MERRA_DATA_PATH / "references" / f"{freq1}{freq2}_{group}"
+    ref_lists[tuple(var_list)] = build_file_references(fileslist, checkpoint_dir, args.workers)
+
+# One consolidated store with the fill value declared as _FillValue
+store_name = args.name or f"M2store_{'_'.join(args.var)}_{args.start_yr}_{args.end_yr}"
+refs = combine_merra2_references(ref_lists)
+vstore_loc = write_reference_store(refs, MERRA_DATA_PATH / f"{store_name}.parquet")
+print(f"Reference store written to: {vstore_loc}")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Build a virtual reference store over the MiCASA archive for fluxnet analysis,
+# plus an optional copy rechunked for long time series at a few points
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from config import MICASA_DATA_PATH, MICASA_INDEX, MICASA_STORE_PATH
+
+from utils.functions import build_micasa_index, micasa_file_list
+from utils.micasa import build_micasa_references, open_micasa_store, rechunk_micasa_store
+
+import argparse
+import json
+import pandas as pd
+
+parser = argparse.ArgumentParser(description="Dataset selection")
+parser.add_argument("cadence", type=str, choices=["daily", "3hrly"], help="MiCASA cadence")
+parser.add_argument("--start-yr", type=int, default=2001, help="First year to include")
+parser.add_argument("--end-yr", type=int, default=2023, help="Last year to include")
+parser.add_argument(
+    "--rechunk", action="store_true",
+    help="Also write a Zarr copy with chunks long in time and small in lat/lon",
+)
+parser.add_argument("--time-chunk", type=int, default=-1, help="Rechunked time chunk length (-1: full record)")
+parser.add_argument("--space-chunk", type=int, default=25, help="Rechunked lat/lon chunk size")
+parser.add_argument(
+    "--bbox", type=float, nargs=4, metavar=("MIN_LON", "MAX_LON", "MIN_LAT", "MAX_LAT"),
+    help="Only rechunk this region (e.g. -170 -30 -60 75 for the Americas)",
+)
+args = parser.parse_args()
+
+store_name = f"micasa_{args.cadence}_{args.start_yr}_{args.end_yr}"
+MICASA_STORE_PATH.mkdir(parents=True, exist_ok=True)
+
+# Find every file in the year range from the MiCASA file index
+build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX, cadences=(args.cadence,))
+dates = pd.date_range(f"{args.start_yr}-01-01", f"{args.end_yr}-12-31").date
+path_list = micasa_file_list(MICASA_INDEX, args.cadence, dates)
+print(f"Building references for {len(path_list)} files")
+
+# Virtual reference store (no data is copied)
+refs = build_micasa_references(path_list)
+vstore_loc = MICASA_STORE_PATH / f"{store_name}.json"
+with open(vstore_loc, "w") as f:
+    json.dump(refs, f)
+print(f"Reference store written to: {vstore_loc}")
+
+if args.rechunk:
+    ds = open_micasa_store(vstore_loc)
+    if args.bbox:
+        min_lon, max_lon, min_lat, max_lat = args.bbox
+        ds = ds.sel(lon=slice(min_lon, max_lon), lat=slice(min_lat, max_lat))
+    zarr_loc = rechunk_micasa_store(
+        ds, MICASA_STORE_PATH / f"{store_name}.zarr",
+        time_chunk=args.time_chunk, space_chunk=args.space_chunk,
+    )
+    print(f"Rechunked store written to: {zarr_loc}")
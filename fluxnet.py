@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Single entry point for the pipeline scripts
+#
+#   python fluxnet.py <command> [args...]     (python fluxnet.py <command> -h for its options)
+#
+# Each command runs its script in this process and only imports what that
+# script uses (e.g. "rmse" never loads matplotlib/cartopy, "config" loads
+# nothing beyond config.py). Paths come from config.py (environment variables
+# or fluxnet.toml).
+
+import runpy
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent
+
+# command: (script, description)
+COMMANDS = {
+    "index": (None, "Build/refresh the MiCASA file index"),
+    "preprocess": ("preprocessing/mp-controller-preprocessing.py", "Extract MiCASA at all sites (worker pool/dask/slurm)"),
+    "preprocess-batch": ("preprocessing/batch-preprocessing.py", "Extract MiCASA at all sites in one pass over the archive"),
+    "preprocess-site": ("preprocessing/data-preprocessing.py", "Extract MiCASA at one site"),
+    "rmse": ("analysis/RMSE_calc.py", "Compute RMSE/metrics for all sites"),
+    "climatology": ("analysis/climatology-comparison.py", "Seasonal/monthly climatology metrics (hemisphere-aware seasons) in one table"),
+    "regression": ("analysis/RMSE-regression.py", "Regress the site RMSEs on site covariates (permutation p-values)"),
+    "subdaily": ("analysis/subdaily-comparison.py", "3-hourly comparison: 3h/daily/monthly/annual/diurnal metrics in one pass"),
+    "cube": ("analysis/build-cube.py", "Build the memory-mapped site x day x variable cube"),
+    "plot": ("plotting/plots-generator-wrapper.py", "Plot all sites"),
+    "plot-site": ("plotting/plots_generator.py", "Plot one site"),
+    "micasa-store": ("data/MiCASA_data/make_virtual_dataset.py", "Build the MiCASA virtual/rechunked store"),
+    "merra-store": ("data/MERRA_data/make_virtual_dataset.py", "Build a MERRA-2 virtual store"),
+    "benchmark": ("benchmarks/run-benchmarks.py", "Benchmark the pipeline on synthetic data"),
+    "profile-report": (None, "Summarize a --profile-log JSONL file"),
+    "config": (None, "Show the resolved configuration"),
+}
+
+
+def usage():
+    lines = ["usage: fluxnet.py <command> [args...]", "", "commands:"]
+    lines += [f"  {name:<18}{description}" for name, (_, description) in COMMANDS.items()]
+    return "\n".join(lines)
+
+
+def run_index(args):
+    import argparse
+    from config import MICASA_DATA_PATH, MICASA_INDEX
+    from utils.functions import build_micasa_index
+
+    parser = argparse.ArgumentParser(prog="fluxnet.py index", description=COMMANDS["index"][1])
+    parser.add_argument("--cadence", type=str, nargs="+", default=["daily", "3hrly"], help="Cadences to index")
+    args = parser.parse_args(args)
+    n_scanned = build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX, cadences=tuple(args.cadence))
+    print(f"MiCASA file index refreshed ({n_scanned} directories rescanned): {MICASA_INDEX}")
+
+
+def run_profile_report(args):
+    import argparse
+    from utils.instrument import summary_report
+
+    parser = argparse.ArgumentParser(prog="fluxnet.py profile-report", description=COMMANDS["profile-report"][1])
+    parser.add_argument("log", type=Path, help="JSONL log written with --profile-log")
+    parser.add_argument("--top", type=int, default=5, help="Slowest sites listed per stage")
+    args = parser.parse_args(args)
+    print(summary_report(args.log, top=args.top))
+
+
+def run_config(args):
+    import config
+
+    print(f"Config file: {config.CONFIG_FILE} ({'found' if config.CONFIG_FILE.is_file() else 'not found'})")
+    for name, value in config.SETTINGS.items():
+        print(f"{name:<26}{value}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        sys.exit(0)
+
+    command, args = sys.argv[1], sys.argv[2:]
+    if command not in COMMANDS:
+        print(f"Unknown command {command}\n\n{usage()}", file=sys.stderr)
+        sys.exit(2)
+
+    sys.path.insert(0, str(REPO_ROOT))
+    script = COMMANDS[command][0]
+    if script is None:
+        {"index": run_index, "profile-report": run_profile_report, "config": run_config}[command](args)
+    else:
+        # Run the script as if called directly (its own argparse sees the remaining args)
+        sys.argv = [str(REPO_ROOT / script)] + args
+        runpy.run_path(sys.argv[0], run_name="__main__")
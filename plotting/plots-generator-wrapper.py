@@ -1,33 +1,72 @@
 #!/usr/bin/env python
-# Wrapper script to run plots-generator.py for all the sites in the Fluxnet list
-#FIX: ???# (without multiprocessing, not necessary due to performance)
+# Wrapper script to generate the plots of all the sites in the Fluxnet list
+# Plots are rendered in-process on a worker pool (see plotting/site_plots.py);
+# --backend subprocess runs plots_generator.py once per site (old behaviour)
 
 # Import config variables and functions
 import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import FLUX_METADATA
+from config import FLUX_METADATA, SITE_METADATA_CACHE, MANIFEST_PATH, TASK_STATUS_PATH
 
-# Import other modules
-import pandas as pd
-import importlib
+from preprocessing.executors import BACKENDS, add_runner_arguments, run_script, run_site_tasks
+from preprocessing.tasks import estimate_site_size
+from utils.site_metadata import load_site_metadata
+from utils.instrument import add_profiling_arguments, configure, summary_report
 
-# Import workaround for file with dashes in name
-#FIX: I'm stupid I should have named these all with underscores..., rename eventually
-mp_controller = importlib.import_module("mp-controller-preprocessing")
-# from mp_controller import run_py_script
+# Import other modules
+import argparse
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the plots of all FLUXNET sites")
+    parser.add_argument(
+        "--backend", type=str, default="local", choices=["subprocess"] + BACKENDS,
+        help="subprocess: one plots_generator.py per site; local/dask-local/slurm: worker pool",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Number of workers")
+    parser.add_argument("--output-dir", type=str, default="plots", help="Directory of the plots")
+    parser.add_argument(
+        "--changed-only", action="store_true",
+        help="Use the run manifest: only replot sites whose inputs or plotting code changed",
+    )
+    add_runner_arguments(parser)
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    configure(args.profile_log, args.cprofile_dir)
+
     # Import/format the list of paths
-    ameriflux_meta = pd.read_csv(FLUX_METADATA, sep="\t")
-    fluxnet_meta = ameriflux_meta.loc[
-        ameriflux_meta["AmeriFlux FLUXNET Data"] == "Yes"
-    ]  # use FLUXNET only
-    fluxnet_list = fluxnet_meta["Site ID"].to_list()
+    fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)  # FLUXNET only
+    fluxnet_list = fluxnet_meta.select()
+    timedelta = "DD"
+
+    if args.backend == "subprocess":
+        # One plots_generator.py per site, run (and timed out/retried) by local workers
+        script = Path(__file__).resolve().parent / "plots_generator.py"
+        task_func, backend = run_script, "local"
+        script_args = ("--output-dir", args.output_dir) + (("--changed-only",) if args.changed_only else ())
+        task_args = {site_ID: (script, site_ID, *script_args) for site_ID in fluxnet_list}
+    else:
+        from plotting.site_plots import render_site_plot
 
-    script = "plots-generator.py"
+        task_func, backend = render_site_plot, args.backend
+        task_args = {
+            site_ID: (
+                site_ID, *fluxnet_meta.location(site_ID),
+                timedelta, args.output_dir, MANIFEST_PATH if args.changed_only else None,
+            )
+            for site_ID in fluxnet_list
+        }
+    sizes = {site_ID: estimate_site_size(site_ID, timedelta) for site_ID in task_args}
+    results = run_site_tasks(
+        task_func, task_args, backend=backend, sizes=sizes, n_workers=args.workers,
+        retries=args.retries, timeout=args.timeout, backoff=args.backoff,
+        status_path=TASK_STATUS_PATH, run_name=f"plot-{timedelta}",
+        resume=args.resume, retry_failed=args.retry_failed,
+    )
+    failed = [site_ID for site_ID, result in results.items() if str(result).startswith("FAILED")]
+    print(f"Finished {len(results)} sites, {len(failed)} failed: {failed}")
 
-    for fluxnet_item in fluxnet_list:
-        mp_controller.run_py_script(script, fluxnet_item)
+    if args.profile_log is not None:
+        print(summary_report(args.profile_log))
@@ -0,0 +1,199 @@
+# Render the per-site map + NEE/NPP comparison figures in-process
+#
+# Used by plots_generator.py (one site) and plots-generator-wrapper.py (all
+# sites on a worker pool). matplotlib and cartopy are imported once per worker,
+# and the two map backgrounds (North/South America coastlines) are rendered
+# once per worker and reused as images for every site.
+
+import os
+import numpy as np
+import pandas as pd
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+
+from config import MICASA_PREPROCESSED_DATA, FLUX_DATA_PATH, FLUX_CACHE_PATH
+from utils.functions import flux_site_file
+from utils.flux_cache import load_flux_site_data, flux_cache_key
+from utils.intermediates import intermediates_path, read_intermediates
+from utils.manifest import open_manifest, stage_key, is_up_to_date, record_stage, atomic_write
+from utils.instrument import instrumented
+
+# Map extents [min_lon, max_lon, min_lat, max_lat], picked by site latitude
+BASEMAP_EXTENTS = {
+    "North America": [-170, -57, 25, 74],
+    "South America": [-90, -30, -60, 12],
+}
+
+# Rendered backgrounds, built on first use in each process
+_basemaps = {}
+
+
+def basemap_region(site_lat):
+    """ Map region for a site: North America for sites at or above 20N """
+    return "North America" if site_lat >= 20 else "South America"
+
+
+def render_basemap(region, width=10, dpi=150):
+    """ Render the coastlines of a region once to an RGBA image
+
+    Args:
+        region (str): key of BASEMAP_EXTENTS
+        width (float): image width (inches)
+        dpi (int): image resolution
+
+    Returns:
+        np.ndarray: RGBA image covering exactly the region's extent
+    """
+    import cartopy.crs as ccrs
+
+    min_lon, max_lon, min_lat, max_lat = BASEMAP_EXTENTS[region]
+    height = width * (max_lat - min_lat) / (max_lon - min_lon)
+    fig = plt.figure(figsize=(width, height), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree(), frameon=False)
+    ax.set_extent([min_lon, max_lon, min_lat, max_lat], crs=ccrs.PlateCarree())
+    ax.coastlines()
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    plt.close(fig)
+    return image
+
+
+def get_basemap(region):
+    """ Cached background image for a region (rendered once per process) """
+    if region not in _basemaps:
+        _basemaps[region] = render_basemap(region)
+    return _basemaps[region]
+
+
+def load_site_series(site_ID, timedelta="DD"):
+    """ Load the MiCASA and FluxNet series plotted for a site
+
+    FluxNet data come from the cleaned-data cache (memory-mapped) and MiCASA
+    data from the site's partition of the intermediates dataset.
+
+    Args:
+        site_ID (str): FluxNet Site ID
+        timedelta (str): FluxNet time step (HH or DD)
+
+    Returns:
+        tuple: (NEE_ds, NPP_ds) DataFrames with MiCASA and FluxNet columns
+    """
+    fluxnet_data = load_flux_site_data(FLUX_DATA_PATH, site_ID, timedelta, FLUX_CACHE_PATH)
+    micasa_ds = read_intermediates(
+        intermediates_path(MICASA_PREPROCESSED_DATA, timedelta),
+        sites=[site_ID], variables=["NEE", "NPP"], wide=True,
+    ).loc[site_ID]
+
+    # Make clean dataframe and append together
+    ## NEE
+    NEE_ds = pd.DataFrame()
+    NEE_ds["MiCASA"] = micasa_ds["MiCASA NEE (kg m-2 s-1)"]
+    NEE_ds["FluxNet"] = fluxnet_data["NEE (kgC m-2 s-1)"]
+
+    ## NPP
+    NPP_ds = pd.DataFrame()
+    NPP_ds["MiCASA"] = micasa_ds["MiCASA NPP (kg m-2 s-1)"]
+    NPP_ds["FluxNet DT GPP/2"] = fluxnet_data["GPP_DT (kgC m-2 s-1)"] / 2
+
+    return NEE_ds, NPP_ds
+
+
+def make_site_figure(site_ID, site_lat, site_lon, NEE_ds, NPP_ds):
+    """ Map of the site location above its NEE and NPP time series
+
+    Returns:
+        matplotlib Figure
+    """
+    # Create a subplot grid with specific width ratios
+    fig, axs = plt.subplots(
+        4,
+        1,
+        gridspec_kw={"height_ratios": [1.2, 2, 0.25, 2], "hspace": 0.01},
+        figsize=(10, 12),
+    )
+
+    # Site location on the pre-rendered background of its region
+    region = basemap_region(site_lat)
+    min_lon, max_lon, min_lat, max_lat = BASEMAP_EXTENTS[region]
+    axs[0].axis("off")
+    axs[0] = fig.add_subplot(4, 1, 1, frameon=False)
+    axs[0].imshow(get_basemap(region), extent=[min_lon, max_lon, min_lat, max_lat], aspect="equal")
+    axs[0].set_axis_off()
+    axs[0].scatter(
+        site_lon, site_lat, marker="*", s=300, color="yellow", edgecolor="black", zorder=3
+    )
+
+    NEE_ds.plot(ax=axs[1], ylabel="NEE\n(kgC m$^{-2}$ s$^{-1}$)")
+    # Format x-axis labels
+    axs[1].xaxis.set_major_locator(mdates.AutoDateLocator())
+    # Disable minor ticks completely
+    axs[1].tick_params(axis="x", which="minor", labelsize=0, labelcolor="none")
+
+    axs[2].set_visible(False)
+
+    NPP_ds.plot(ax=axs[3], ylabel="NPP\n(kgC m$^{-2}$ s$^{-1}$)")
+    # Format x-axis labels
+    axs[3].xaxis.set_major_locator(mdates.AutoDateLocator())
+    # Disable minor ticks completely
+    axs[3].tick_params(axis="x", which="minor", labelsize=0, labelcolor="none")
+
+    date_format = mdates.DateFormatter("%b %Y")
+    for i in range(1, 4, 2):
+        axs[i].xaxis.set_major_formatter(date_format)
+        axs[i].set_xlabel("")
+    fig.suptitle(f"{site_ID}", y=0.9, fontsize=14)
+
+    return fig
+
+
+@instrumented("plot")
+def render_site_plot(site_ID, site_lat, site_lon, timedelta="DD", output_dir="plots", manifest_path=None):
+    """ Write the comparison figure of a site to {output_dir}/{site_ID}_NEE_NPP.png
+
+    By default a site is skipped if its plot exists. With a run manifest, it is
+    instead skipped only if its inputs (FluxNet CSV, intermediates) and the
+    plotting code are unchanged since the last completed run.
+
+    Args:
+        site_ID (str): FluxNet Site ID
+        site_lat, site_lon (float): site location
+        timedelta (str): FluxNet time step (HH or DD)
+        output_dir (str): directory of the plots
+        manifest_path (Path object, optional): run manifest for --changed-only runs
+
+    Returns:
+        str: status message
+    """
+    output_path = os.path.join(output_dir, f"{site_ID}_NEE_NPP.png")
+
+    if manifest_path is not None:
+        site_inputs = [flux_site_file(FLUX_DATA_PATH, site_ID, timedelta)] + sorted(
+            (intermediates_path(MICASA_PREPROCESSED_DATA, timedelta) / f"site={site_ID}").rglob("*.parquet")
+        )
+        with open_manifest(manifest_path) as con:
+            key, record = stage_key(con, "plot", site_inputs, {
+                "timedelta": timedelta,
+                "clean_key": flux_cache_key(FLUX_DATA_PATH, site_ID, timedelta, FLUX_CACHE_PATH)[0],
+            })
+            if is_up_to_date(con, site_ID, "plot", key):
+                return f"Plot for site {site_ID} is up to date: {output_path}."
+    elif os.path.exists(output_path):
+        return f"File for site {site_ID} already exists: {output_path}."
+
+    NEE_ds, NPP_ds = load_site_series(site_ID, timedelta)
+    fig = make_site_figure(site_ID, float(site_lat), float(site_lon), NEE_ds, NPP_ds)
+
+    # Written to a temporary file first so an interrupted run leaves no partial plot
+    try:
+        with atomic_write(output_path) as tmp_path:
+            fig.savefig(tmp_path)
+    finally:
+        plt.close(fig)
+
+    if manifest_path is not None:
+        with open_manifest(manifest_path) as con:
+            record_stage(con, site_ID, "plot", key, record, [output_path])
+    return f"Plot written to: {output_path}"
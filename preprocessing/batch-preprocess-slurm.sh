@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+#SBATCH --job-name=batch_preprocess
+#SBATCH --output=slurm-%j.out      # Capture both stdout and stderr
+#SBATCH --error=slurm-%j.out       # Same log file for errors
+#SBATCH --account=s1460
+#SBATCH --time=1:00:00
+
+# Preprocess all sites in a single pass over the MiCASA archive on a compute node
+
+pixi run $NOBACKUP/ghgc/micasa/FLUXNET-Model-comparison/preprocessing/batch-preprocessing.py
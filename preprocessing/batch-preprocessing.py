@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# Extract micasa data for all fluxnet sites to the intermediates dataset in a single pass
+# (batch alternative to running data-preprocessing.py once per site)
+
+# Import config variables and functions
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import MICASA_DATA_PATH, MICASA_INDEX, FLUX_DATA_PATH, FLUX_METADATA, SITE_METADATA_CACHE, MICASA_PREPROCESSED_DATA, MANIFEST_PATH, GRID_INDEX_PATH
+
+from utils.functions import import_flux_site_data, micasa_file_list, build_micasa_index
+from utils.site_metadata import load_site_metadata
+from utils.micasa import extract_micasa_points, extract_micasa_store_points, open_micasa_store, micasa_points_to_site_df
+from utils.intermediates import intermediates_path, site_intermediates_exist, write_site_intermediates
+from utils.manifest import open_manifest, is_up_to_date, record_stage, file_fingerprint
+from preprocessing.tasks import MICASA_CADENCES, extract_stage_key
+from utils.instrument import add_profiling_arguments, configure, stage, summary_report
+
+# Import other modules
+import argparse
+
+
+parser = argparse.ArgumentParser(description="User-specified parameters")
+parser.add_argument(
+    "site_IDs", type=str, nargs="*",
+    help="FluxNet/AmeriFLUX Site Identifier(s) (XX-XXX), default all FLUXNET sites",
+)
+parser.add_argument(
+    "--store", type=Path, default=None,
+    help="Read MiCASA from a virtual/rechunked store instead of the daily files",
+)
+parser.add_argument(
+    "--changed-only", action="store_true",
+    help="Use the run manifest: only redo sites whose inputs, parameters or code changed",
+)
+parser.add_argument(
+    "--timedelta", type=str, default="DD", choices=["DD", "HH"],
+    help="FluxNet time step: DD (daily MiCASA) or HH (3-hourly MiCASA, FluxNet averaged to 3 h UTC windows)",
+)
+parser.add_argument(
+    "--footprint", type=int, default=1, metavar="K",
+    help="Also extract the area-weighted K x K cell mean around each site (e.g. 3)",
+)
+parser.add_argument(
+    "--years-per-chunk", type=int, default=None,
+    help="Read the MiCASA store this many years at a time (bounds memory for long records)",
+)
+add_profiling_arguments(parser)
+args = parser.parse_args()
+configure(args.profile_log, args.cprofile_dir)
+
+timedelta = args.timedelta
+micasa_var_list = ["NEE", "NPP"]
+output_path = intermediates_path(MICASA_PREPROCESSED_DATA, timedelta)
+
+# Site list and coordinates
+fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+run_ids = fluxnet_meta.select(sites=args.site_IDs or None)
+
+cadence = MICASA_CADENCES[timedelta]
+if args.store is None:
+    # Refresh the MiCASA file index (only rescans new/changed month directories)
+    build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX, cadences=(cadence,))
+
+# Collect the dates needed by each site (skip sites already processed/up to date)
+site_dates = {}
+site_keys = {}
+for site_ID in run_ids:
+    site_lat, site_lon = fluxnet_meta.location(site_ID)
+    if not args.changed_only and site_intermediates_exist(output_path, site_ID):
+        print(f"Output for site {site_ID} already exists in {output_path}. Skipping.")
+        continue
+    try:
+        fluxnet_sel = import_flux_site_data(FLUX_DATA_PATH, site_ID, timedelta, site_lat, site_lon)
+    except ValueError as e:
+        print(f"Skipping {site_ID}: {e}")
+        continue
+    dates = sorted({dt.date() for dt in fluxnet_sel.index})
+
+    if args.changed_only:
+        if args.store is None:
+            fingerprints = [file_fingerprint(path) for path in micasa_file_list(MICASA_INDEX, cadence, dates)]
+        else:
+            fingerprints = [file_fingerprint(args.store)]
+        with open_manifest(MANIFEST_PATH) as con:
+            key, record = extract_stage_key(
+                con, site_ID, site_lat, site_lon, timedelta, micasa_var_list, args.store, fingerprints,
+                args.footprint,
+            )
+            if is_up_to_date(con, site_ID, "extract", key):
+                print(f"Output for site {site_ID} is up to date in {output_path}. Skipping.")
+                continue
+        site_keys[site_ID] = (key, record)
+
+    site_dates[site_ID] = dates
+
+if not site_dates:
+    print("No sites to process. Exiting.")
+    sys.exit()
+
+site_meta = fluxnet_meta.frame(list(site_dates)).set_index("Site ID")
+
+# Union of dates across all sites, each MiCASA file is only read once
+dates_unique = sorted(set().union(*site_dates.values()))
+
+site_lats = site_meta["Latitude (degrees)"].values
+site_lons = site_meta["Longitude (degrees)"].values
+
+with stage("extract_all", n_sites=len(site_dates)):
+    if args.store is not None:
+        print(f"Extracting {len(site_dates)} sites from {args.store}")
+        ds_points = extract_micasa_store_points(
+            open_micasa_store(args.store), site_meta.index, site_lats, site_lons,
+            micasa_var_list, dates_unique, args.footprint, GRID_INDEX_PATH, args.years_per_chunk,
+        )
+    else:
+        path_list = micasa_file_list(MICASA_INDEX, cadence, dates_unique)
+        print(f"Extracting {len(site_dates)} sites from {len(path_list)} MiCASA files")
+
+        ds_points = extract_micasa_points(
+            path_list, site_meta.index, site_lats, site_lons, micasa_var_list, args.footprint, GRID_INDEX_PATH,
+        )
+
+# Write all variables for each site to the intermediates dataset
+for site_ID, dates in site_dates.items():
+    with stage("write_intermediates", site=site_ID):
+        ds_out = micasa_points_to_site_df(ds_points, site_ID, dates)
+        write_site_intermediates(output_path, site_ID, ds_out)
+    if site_ID in site_keys:
+        with open_manifest(MANIFEST_PATH) as con:
+            record_stage(con, site_ID, "extract", *site_keys[site_ID], [output_path / f"site={site_ID}"])
+    print(f"Intermediates for site {site_ID} written to: {output_path}")
+
+if args.profile_log is not None:
+    print(summary_report(args.profile_log))
@@ -0,0 +1,475 @@
+# Pluggable execution backends for running per-site tasks in-process
+#
+# Backends:
+#   local       worker processes on this node (per-task timeouts, retries with backoff)
+#   dask-local  dask.distributed LocalCluster (stand-in for slurm when testing)
+#   slurm       dask-jobqueue SLURMCluster spread over several nodes
+
+import collections
+import contextlib
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import resource
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from pathlib import Path
+
+BACKENDS = ["local", "dask-local", "slurm"]
+
+REPO_ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+def parse_memory(memory):
+    """ Parse a memory size such as "4GB", "64G", "512MiB" or 1e9 to bytes
+
+    Single-letter units are decimal, as in dask ("64G" is 64e9 bytes).
+    """
+    if memory is None or isinstance(memory, (int, float)):
+        return memory
+    units = {"": 1, "b": 1, "k": 1e3, "m": 1e6, "g": 1e9, "t": 1e12,
+             "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12,
+             "ki": 2**10, "mi": 2**20, "gi": 2**30, "ti": 2**40,
+             "kib": 2**10, "mib": 2**20, "gib": 2**30, "tib": 2**40}
+    text = str(memory).strip().lower().replace(" ", "")
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz")
+    unit = text[len(number):]
+    if unit not in units:
+        raise ValueError(f"Memory size {memory!r} invalid, unknown unit {unit!r}")
+    try:
+        return int(float(number) * units[unit])
+    except ValueError:
+        raise ValueError(f"Memory size {memory!r} invalid") from None
+
+
+def available_memory(fraction=0.9):
+    """ Memory available for new work on this node (bytes), from /proc/meminfo (Linux)
+
+    Falls back to the total physical memory elsewhere.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            kib = int(next(line for line in f if line.startswith("MemAvailable:")).split()[1])
+        return int(kib * 1024 * fraction)
+    except (OSError, StopIteration):
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * fraction)
+
+
+def parse_memory_budget(budget):
+    """ Memory budget option: a size (e.g. "64GB") or "auto" (available memory) """
+    if budget is None:
+        return None
+    return available_memory() if str(budget).lower() == "auto" else parse_memory(budget)
+
+
+def limit_worker_memory(memory_limit):
+    """ Process pool initializer: cap the worker's heap so a runaway site raises
+    MemoryError instead of getting the whole node OOM-killed """
+    if memory_limit:
+        # RLIMIT_DATA excludes file-backed mmaps (e.g. the flux cache)
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+
+
+def _worker_loop(conn, memory_limit):
+    """ Worker process: run (func, args) tasks received on conn until None """
+    if hasattr(os, "setpgrp"):
+        # Own process group, so a timed-out task is killed with any subprocesses it started
+        os.setpgrp()
+    limit_worker_memory(memory_limit)
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        func, args = task
+        try:
+            conn.send(("ok", func(*args)))
+        except Exception as e:
+            conn.send(("error", f"{e!r}\n{traceback.format_exc(limit=-5)}"))
+
+
+class _Worker:
+    """ One worker process of run_local, restarted when a task times out or crashes """
+
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.task = None
+        self._start()
+
+    def _start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_loop, args=(child_conn, self.memory_limit), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def submit(self, func, key, args, attempt):
+        self.task = (key, attempt, time.monotonic())
+        self.conn.send((func, args))
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def restart(self):
+        self.kill()
+        self._start()
+        self.task = None
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+
+
+def run_local(func, task_args, n_workers, memory_limit, retries, report,
+              timeout=None, backoff=0, started=None, memory_budget=None, task_memory=None):
+    """ Run tasks on local worker processes, with timeouts and retries
+
+    Tasks are handed out one at a time, so results stream back as they finish.
+    A task running longer than timeout has its worker (and any subprocesses)
+    killed and replaced; failed, timed-out and crashed tasks are retried up to
+    retries times, waiting backoff * 2**attempt seconds before each retry.
+
+    With a memory budget, a task is only started when its estimated memory
+    (task_memory) fits in the budget left by the running tasks; the first
+    waiting task that fits is started (a task larger than the whole budget
+    runs alone).
+    """
+    n_workers = min(n_workers or os.cpu_count() or 1, len(task_args)) or 1
+    queue = collections.deque((key, 0, 0.0) for key in task_args)  # (key, attempt, not before)
+    workers = [_Worker(memory_limit) for _ in range(n_workers)]
+
+    def failed(task, error):
+        key, attempt, _ = task
+        summary = error.splitlines()[0][:200]
+        if attempt < retries:
+            delay = backoff * 2**attempt
+            print(f"Retrying {key} ({attempt + 1}/{retries}) in {delay:g} s after error: {summary}")
+            queue.append((key, attempt + 1, time.monotonic() + delay))
+        else:
+            report(key, f"FAILED: {key} ({summary})", error=error, attempts=attempt + 1)
+
+    task_memory = task_memory or {}
+
+    def admissible(item, now, in_use, running):
+        if item[2] > now:
+            return False
+        if memory_budget is None or not running:
+            return True
+        return in_use + task_memory.get(item[0], 0) <= memory_budget
+
+    try:
+        while queue or any(worker.task for worker in workers):
+            now = time.monotonic()
+            for worker in workers:
+                if worker.task is None and queue:
+                    running = [w.task[0] for w in workers if w.task]
+                    in_use = sum(task_memory.get(key, 0) for key in running)
+                    ready = next((item for item in queue if admissible(item, now, in_use, running)), None)
+                    if ready is None:
+                        break
+                    queue.remove(ready)
+                    key, attempt, _ = ready
+                    worker.submit(func, key, task_args[key], attempt)
+                    if started is not None:
+                        started(key, attempt + 1)
+
+            # Wake up for the next result, timeout or retry
+            wake = [item[2] for item in queue]
+            if timeout:
+                wake += [worker.task[2] + timeout for worker in workers if worker.task]
+            wait = min([max(t - now, 0) for t in wake] + [1.0])
+            busy = {worker.conn: worker for worker in workers if worker.task}
+            for conn in multiprocessing.connection.wait(list(busy), timeout=wait):
+                worker = busy[conn]
+                try:
+                    status, value = conn.recv()
+                except EOFError:
+                    # Worker died (e.g. killed by the OOM killer or a segfault)
+                    task = worker.task
+                    worker.process.join(timeout=1)
+                    code = worker.process.exitcode
+                    worker.restart()
+                    failed(task, f"Worker exited with code {code}")
+                    continue
+                task, worker.task = worker.task, None
+                if status == "ok":
+                    report(task[0], value, attempts=task[1] + 1)
+                else:
+                    failed(task, value)
+
+            if timeout:
+                for worker in workers:
+                    if worker.task and time.monotonic() - worker.task[2] > timeout:
+                        task = worker.task
+                        worker.restart()
+                        failed(task, f"Timed out after {timeout} s")
+    finally:
+        for worker in workers:
+            if worker.task:
+                worker.kill()
+            else:
+                worker.stop()
+
+
+# Worker event topic announcing that a task attempt started
+TASK_STARTED_TOPIC = "site-task-started"
+
+
+def _dask_task(func, key, *args):
+    """ Run a task on a dask worker, first announcing its start to the client """
+    from distributed import get_worker
+
+    get_worker().log_event(TASK_STARTED_TOPIC, key)
+    return func(*args)
+
+
+def run_dask(func, task_args, sizes, cluster, n_workers, retries, report, started=None, task_memory=None):
+    """ Run tasks on a dask cluster, largest tasks first (retried by dask, no timeouts)
+
+    With task_memory, each task claims its estimated memory from the workers'
+    MEMORY resource (see make_dask_cluster), so a worker only runs tasks that
+    fit together. Tasks are reported as started when a worker begins them,
+    not when they are submitted (queued tasks stay pending).
+    """
+    from dask.distributed import Client, wait
+
+    if n_workers:
+        cluster.scale(n_workers)
+    with Client(cluster) as client:
+        print(f"Dask dashboard: {client.dashboard_link}")
+        # Start events arrive on the client's event loop, they are handled here in the main thread
+        start_events = queue.SimpleQueue()
+        client.subscribe_topic(TASK_STARTED_TOPIC, lambda event: start_events.put(event[1]))
+
+        futures = {}
+        for key, args in task_args.items():
+            future = client.submit(
+                _dask_task, func, key, *args,
+                key=f"{func.__name__}-{key}",
+                priority=sizes.get(key, 0),
+                retries=retries,
+                pure=False,
+                **({"resources": {"MEMORY": task_memory[key]}} if task_memory else {}),
+            )
+            futures[future] = key
+
+        attempts = collections.Counter()
+        finished = set()
+        not_done = set(futures)
+        while not_done:
+            try:
+                done, not_done = wait(not_done, timeout=1, return_when="FIRST_COMPLETED")
+            except TimeoutError:
+                done = set()
+            while not start_events.empty():
+                key = start_events.get()
+                attempts[key] += 1
+                if started is not None and key not in finished:
+                    started(key, attempts[key])
+            for future in done:
+                key = futures[future]
+                finished.add(key)
+                try:
+                    report(key, future.result())
+                except Exception as e:
+                    report(key, f"FAILED: {key} ({e!r})", error=f"{e!r}", attempts=retries + 1)
+
+
+def make_dask_cluster(backend, n_workers=None, memory_limit=None, slurm_kwargs=None, memory_resource=None):
+    """ Create a LocalCluster or SLURMCluster for the dask backends
+
+    Args:
+        backend (str): "dask-local" or "slurm"
+        n_workers (int, optional): number of local workers
+        memory_limit (str or int, optional): memory per worker
+        slurm_kwargs (dict, optional): extra SLURMCluster arguments
+            (account, walltime, cores, processes, memory, ...)
+        memory_resource (int, optional): bytes of the MEMORY resource of each
+            worker, claimed by tasks submitted with their memory estimate
+
+    Returns:
+        dask cluster
+    """
+    # Workers need the repo on their path to import the task function
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        [REPO_ROOT] + [p for p in [os.environ.get("PYTHONPATH")] if p]
+    )
+
+    if backend == "dask-local":
+        from dask.distributed import LocalCluster
+        return LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=1,
+            memory_limit=memory_limit or "auto",
+            **({"resources": {"MEMORY": memory_resource}} if memory_resource else {}),
+        )
+
+    elif backend == "slurm":
+        from dask_jobqueue import SLURMCluster
+        slurm_kwargs = dict(slurm_kwargs or {})
+        slurm_kwargs.setdefault("cores", 1)
+        slurm_kwargs.setdefault("processes", 1)
+        slurm_kwargs.setdefault("memory", memory_limit or "8GB")
+        slurm_kwargs.setdefault("job_script_prologue", []).append(
+            f"export PYTHONPATH={REPO_ROOT}:$PYTHONPATH"
+        )
+        if memory_resource:
+            slurm_kwargs.setdefault("worker_extra_args", []).extend(["--resources", f"MEMORY={memory_resource}"])
+        return SLURMCluster(**slurm_kwargs)
+
+    else:
+        raise ValueError(f"Backend {backend} is not a dask backend")
+
+
+def run_script(script, *args, timeout=None):
+    """ Run a python script with arguments, raising on failure (subprocess backend task)
+
+    Returns:
+        str: the script's standard output
+    """
+    cmd = [sys.executable, str(script), *map(str, args)]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} exited with {result.returncode}:\n{result.stderr.strip()[-2000:]}")
+    return result.stdout.strip()
+
+
+def add_runner_arguments(parser):
+    """ Add the retry/timeout/resume options shared by the batch drivers """
+    parser.add_argument("--retries", type=int, default=1, help="Retries per failed site")
+    parser.add_argument(
+        "--timeout", type=float, default=None,
+        help="Seconds before a site's task is killed and retried (local/subprocess backends)",
+    )
+    parser.add_argument(
+        "--backoff", type=float, default=30,
+        help="Seconds before the first retry, doubled for each further retry (local/subprocess backends)",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Skip sites already done in the last run (see the task status store)",
+    )
+    parser.add_argument("--retry-failed", action="store_true", help="With --resume, also rerun failed sites")
+
+
+def run_site_tasks(func, task_args, backend="local", sizes=None, n_workers=None,
+                   memory_limit=None, retries=0, slurm_kwargs=None, timeout=None, backoff=0,
+                   status_path=None, run_name=None, resume=False, retry_failed=False,
+                   memory_budget=None, task_memory=None):
+    """ Run func(*args) for every site on the selected backend
+
+    Tasks are submitted largest first (by estimated size) so long sites do not
+    end up running alone at the end of the job. Progress is printed as each
+    task completes. With a status store every task is recorded as pending,
+    running, done or failed (with the error) as the run goes, so a killed run
+    can be resumed.
+
+    Args:
+        func (callable): importable (picklable) task function
+        task_args (dict): {site ID: tuple of arguments to func}
+        backend (str): one of BACKENDS
+        sizes (dict, optional): {site ID: estimated size} used for ordering
+        n_workers (int, optional): number of workers (default: all cores / cluster default)
+        memory_limit (str or int, optional): memory limit per worker
+        retries (int): number of times a failed task is retried
+        slurm_kwargs (dict, optional): extra SLURMCluster arguments
+        timeout (float, optional): seconds before a task is killed (local backend)
+        backoff (float): seconds before the first retry, doubled for each
+            further retry (local backend)
+        status_path (Path object, optional): task status store (see
+            preprocessing/task_status.py)
+        run_name (str, optional): name of the run in the status store
+            (default: func name)
+        resume (bool): skip tasks done in the last run of run_name
+        retry_failed (bool): with resume, also rerun failed tasks
+        memory_budget (str or int, optional): memory of the node shared by
+            the local or dask-local workers ("auto": available memory), or of
+            each slurm worker; capped by memory_limit per worker. Tasks only
+            start when their estimated memory fits
+        task_memory (dict, optional): {site ID: estimated peak memory (bytes)}
+
+    Returns:
+        dict: {site ID: result or "FAILED: ..." message} of the tasks run
+    """
+    sizes = sizes or {}
+    task_args = dict(sorted(task_args.items(), key=lambda item: -sizes.get(item[0], 0)))
+    results = {}
+
+    with contextlib.ExitStack() as stack:
+        con = None
+        if status_path is not None:
+            from preprocessing.task_status import open_status_store, start_run, set_task_status, run_summary
+
+            run_name = run_name or func.__name__
+            con = stack.enter_context(open_status_store(status_path))
+            todo = start_run(con, run_name, list(task_args), resume=resume, retry_failed=retry_failed)
+            if len(todo) < len(task_args):
+                print(f"Resuming {run_name}: {len(task_args) - len(todo)} of {len(task_args)} sites skipped")
+            task_args = {key: task_args[key] for key in todo}
+            stack.callback(lambda: print(f"Task status ({run_name}): {run_summary(con, run_name)}"))
+
+        def started(key, attempt):
+            if con is not None:
+                set_task_status(con, run_name, key, "running", attempts=attempt)
+
+        def report(key, result, error=None, attempts=None):
+            results[key] = result
+            if con is not None:
+                status = "failed" if error is not None else "done"
+                set_task_status(con, run_name, key, status, attempts=attempts, error=error, result=result)
+            print(f"[{len(results)}/{len(task_args)}] {key}: {result}")
+            sys.stdout.flush()
+
+        if not task_args:
+            return results
+        if backend == "slurm" and str(memory_budget).lower() == "auto":
+            raise ValueError("Memory budget auto is the memory of this node, give the memory of each slurm worker")
+        memory_budget = parse_memory_budget(memory_budget)
+        if memory_budget is not None and task_memory:
+            print(f"Memory budget {memory_budget / 2**30:.1f} GiB, largest task estimate "
+                  f"{max(task_memory.values()) / 2**30:.1f} GiB")
+        if backend == "local":
+            run_local(
+                func, task_args, n_workers, parse_memory(memory_limit), retries, report,
+                timeout=timeout, backoff=backoff, started=started,
+                memory_budget=memory_budget, task_memory=task_memory,
+            )
+        elif backend in ("dask-local", "slurm"):
+            # Each worker offers its memory as a MEMORY resource claimed by the tasks
+            memory_resource = None
+            if task_memory:
+                if memory_budget is not None and backend == "dask-local":
+                    # The node budget is shared by the local workers
+                    n_workers = n_workers or os.cpu_count()
+                    memory_resource = memory_budget // n_workers
+                elif memory_budget is not None:
+                    memory_resource = memory_budget
+                if memory_limit is not None:
+                    memory_resource = min(memory_resource or math.inf, parse_memory(memory_limit))
+            if memory_resource:
+                task_memory = {key: min(task_memory.get(key, 0), memory_resource) for key in task_args}
+            cluster = make_dask_cluster(backend, n_workers, memory_limit, slurm_kwargs, memory_resource)
+            with cluster:
+                run_dask(
+                    func, task_args, sizes, cluster, n_workers, retries, report, started=started,
+                    task_memory=task_memory if memory_resource else None,
+                )
+        else:
+            raise ValueError(f"Backend {backend} invalid, choose from {BACKENDS}")
+
+    return results
@@ -6,56 +6,121 @@ import sys
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import FLUX_METADATA
+from config import FLUX_METADATA, SITE_METADATA_CACHE, MICASA_DATA_PATH, MICASA_INDEX, MANIFEST_PATH, TASK_STATUS_PATH
+
+from utils.functions import build_micasa_index
+from utils.site_metadata import load_site_metadata
+from preprocessing.executors import BACKENDS, add_runner_arguments, run_script, run_site_tasks
+from preprocessing.tasks import preprocess_site, estimate_site_size, estimate_site_memory
+from utils.instrument import add_profiling_arguments, configure, summary_report
 
 # Import other modules
-import pandas as pd
-import subprocess
-import multiprocessing
-from functools import partial
-
-
-def run_py_script(script, arg):
-    """
-    This function runs a python script with one argument via subprocess
-    and returns a subprocess error if it occurs
-    """
-    cmd = ["python", script, arg]
-    try:
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, check=True
-        )  # check=True will crash if error
-        print(result.stdout.strip())
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {' '.join(cmd)}")
-        print("STDOUT:", e.stdout)
-        print("STDERR:", e.stderr)
-        return f"FAILED: {arg}"
-
-
-def run_multiprocessing(script, arg_list):
-    """
-    This function runs run_py_script over a list of input arguments via multiprocessing
-    """
-    run_script_with_arg = partial(
-        run_py_script, script
-    )  # create a partial function to input script to
-
-    with (
-        multiprocessing.Pool() as pool
-    ):  # should be fine to not specify pool size as long as no mem issues
-        results = pool.map(run_script_with_arg, arg_list)
-    return results
+import argparse
 
 
 if __name__ == "__main__":  # Guard preventing future import issues
+    parser = argparse.ArgumentParser(description="Preprocess all FLUXNET sites")
+    parser.add_argument(
+        "--backend", type=str, default="local", choices=["subprocess"] + BACKENDS,
+        help="subprocess: one data-preprocessing.py per site (old behaviour); "
+             "local/dask-local/slurm: in-process tasks on a pool or dask cluster",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Number of workers")
+    parser.add_argument("--memory-limit", type=str, default=None, help="Memory per worker, e.g. 8GB")
+    parser.add_argument(
+        "--memory-budget", type=str, default=None,
+        help="Memory shared by the local/dask-local workers (e.g. 64GB, or auto for the available memory), "
+             "or of each slurm worker; "
+             "sites start only when their estimated memory fits, and stores are read a year at a time",
+    )
+    parser.add_argument(
+        "--years-per-chunk", type=int, default=None,
+        help="Read the MiCASA store this many years at a time (default 1 with --memory-budget)",
+    )
+    parser.add_argument(
+        "--timedelta", type=str, default="DD", choices=["DD", "HH"],
+        help="FluxNet time step: DD (daily MiCASA) or HH (3-hourly MiCASA, FluxNet averaged to 3 h UTC windows)",
+    )
+    parser.add_argument(
+        "--footprint", type=int, default=1, metavar="K",
+        help="Also extract the area-weighted K x K cell mean around each site (e.g. 3)",
+    )
+    parser.add_argument("--store", type=Path, default=None, help="MiCASA virtual/rechunked store")
+    parser.add_argument(
+        "--changed-only", action="store_true",
+        help="Use the run manifest: only redo sites whose inputs, parameters or code changed",
+    )
+    parser.add_argument("--slurm-account", type=str, default="s1460", help="SLURM account (slurm backend)")
+    parser.add_argument("--slurm-walltime", type=str, default="01:00:00", help="SLURM walltime per worker job")
+    add_runner_arguments(parser)
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    # Workers (and subprocesses) inherit the profiling settings through the environment
+    configure(args.profile_log, args.cprofile_dir)
+
     # Import/format the list of paths (for large data, put inside the guard)
-    ameriflux_meta = pd.read_csv(FLUX_METADATA, sep="\t")
-    fluxnet_meta = ameriflux_meta.loc[ameriflux_meta["AmeriFlux FLUXNET Data"] == "Yes"]
-    fluxnet_list = fluxnet_meta["Site ID"].to_list()
+    # Parsed once and cached, the per-site subprocesses read the same cache
+    fluxnet_meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+    fluxnet_list = fluxnet_meta.select()
 
-    script = "data-preprocessing.py"
+    script = Path(__file__).resolve().parent / "data-preprocessing.py"
+    timedelta = args.timedelta
+    years_per_chunk = args.years_per_chunk
+    if years_per_chunk is None and args.memory_budget is not None:
+        years_per_chunk = 1
+
+    # Refresh the MiCASA file index once so the workers only query it
+    n_scanned = build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX)
+    print(f"MiCASA file index refreshed ({n_scanned} directories rescanned)")
 
     # Initialize run
-    results = run_multiprocessing(script, fluxnet_list)
+    if args.backend == "subprocess":
+        # One script per site, run (and timed out/retried) by local workers
+        task_func, backend = run_script, "local"
+        task_args = {
+            site_ID: (script, site_ID, "--timedelta", timedelta, "--footprint", args.footprint)
+            + (("--store", args.store) if args.store else ())
+            + (("--changed-only",) if args.changed_only else ())
+            + (("--years-per-chunk", years_per_chunk) if years_per_chunk else ())
+            for site_ID in fluxnet_list
+        }
+    else:
+        # Metadata is read once here and passed to the tasks
+        task_func, backend = preprocess_site, args.backend
+        task_args = {
+            site_ID: (
+                site_ID, *fluxnet_meta.location(site_ID),
+                timedelta, ["NEE", "NPP"], args.store,
+                MANIFEST_PATH if args.changed_only else None, args.footprint, years_per_chunk,
+            )
+            for site_ID in fluxnet_list
+        }
+    sizes = {site_ID: estimate_site_size(site_ID, timedelta) for site_ID in task_args}
+    task_memory = None
+    if args.memory_budget is not None:
+        task_memory = {
+            site_ID: estimate_site_memory(site_ID, timedelta, footprint=args.footprint, years_per_chunk=years_per_chunk)
+            for site_ID in task_args
+        }
+    results = run_site_tasks(
+        task_func, task_args,
+        backend=backend,
+        sizes=sizes,
+        n_workers=args.workers,
+        memory_limit=args.memory_limit,
+        retries=args.retries,
+        slurm_kwargs={"account": args.slurm_account, "walltime": args.slurm_walltime},
+        timeout=args.timeout,
+        backoff=args.backoff,
+        status_path=TASK_STATUS_PATH,
+        run_name=f"preprocess-{timedelta}",
+        resume=args.resume,
+        retry_failed=args.retry_failed,
+        memory_budget=args.memory_budget,
+        task_memory=task_memory,
+    )
+    failed = [site_ID for site_ID, result in results.items() if str(result).startswith("FAILED")]
+    print(f"Finished {len(results)} sites, {len(failed)} failed: {failed}")
+
+    if args.profile_log is not None:
+        print(summary_report(args.profile_log))
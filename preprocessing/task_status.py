@@ -0,0 +1,89 @@
+# Persistent status of the per-site tasks of a batch run
+#
+# One row per (run, task key): pending, running, done or failed, with the
+# number of attempts and the error text of the last failure. The batch runner
+# (preprocessing/executors.py) updates it as tasks start and finish and
+# commits every change, so after a job is killed (e.g. at the SLURM walltime)
+# a run started with resume=True only redoes the unfinished tasks.
+
+import contextlib
+import sqlite3
+import time
+
+STATUSES = ["pending", "running", "done", "failed"]
+
+STATUS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    run TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result TEXT,
+    updated REAL,
+    PRIMARY KEY (run, key)
+);
+"""
+
+
+@contextlib.contextmanager
+def open_status_store(status_path):
+    """ Open (creating if needed) the SQLite task status store """
+    con = sqlite3.connect(status_path, timeout=60)
+    try:
+        con.executescript(STATUS_SCHEMA)
+        yield con
+        con.commit()
+    finally:
+        con.close()
+
+
+def task_statuses(con, run):
+    """ {task key: (status, attempts, error)} of a run """
+    rows = con.execute("SELECT key, status, attempts, error FROM tasks WHERE run = ?", (run,))
+    return {key: (status, attempts, error) for key, status, attempts, error in rows}
+
+
+def start_run(con, run, keys, resume=False, retry_failed=False):
+    """ Register the tasks of a run and pick the ones to run
+
+    Args:
+        con (sqlite3.Connection): open status store
+        run (str): run name, e.g. "preprocess-DD"
+        keys (list of str): task keys (site IDs)
+        resume (bool): skip tasks already done in this run (tasks left running
+            by a killed job are run again); otherwise all tasks start over
+        retry_failed (bool): with resume, also run the tasks that failed
+
+    Returns:
+        list of str: keys to run, in the order of keys
+    """
+    known = task_statuses(con, run) if resume else {}
+    skip = {"done", "failed"} if resume and not retry_failed else {"done"}
+    todo = [key for key in keys if known.get(key, ("pending",))[0] not in skip]
+
+    now = time.time()
+    con.executemany(
+        "INSERT INTO tasks (run, key, status, attempts, updated) VALUES (?, ?, 'pending', 0, ?) "
+        "ON CONFLICT (run, key) DO UPDATE SET status = 'pending', attempts = 0, error = NULL, "
+        "result = NULL, updated = excluded.updated",
+        [(run, key, now) for key in todo],
+    )
+    con.commit()
+    return todo
+
+
+def set_task_status(con, run, key, status, attempts=None, error=None, result=None):
+    """ Update (and commit) the status of one task """
+    con.execute(
+        "UPDATE tasks SET status = ?, attempts = COALESCE(?, attempts), error = ?, result = ?, updated = ? "
+        "WHERE run = ? AND key = ?",
+        (status, attempts, error, None if result is None else str(result), time.time(), run, key),
+    )
+    con.commit()
+
+
+def run_summary(con, run):
+    """ Number of tasks of a run in each status """
+    counts = dict(con.execute("SELECT status, COUNT(*) FROM tasks WHERE run = ? GROUP BY status", (run,)).fetchall())
+    return {status: counts.get(status, 0) for status in STATUSES}
@@ -0,0 +1,170 @@
+# Per-site preprocessing task, runnable in-process by the preprocessing drivers
+
+import os
+
+from config import MICASA_DATA_PATH, MICASA_INDEX, FLUX_DATA_PATH, MICASA_PREPROCESSED_DATA
+
+from utils.functions import import_flux_site_data, flux_site_file, micasa_file_list, micasa_index_has_cadence, build_micasa_index
+from utils.intermediates import intermediates_path, site_intermediates_exist, write_site_intermediates
+from utils.manifest import open_manifest, stage_key, is_up_to_date, record_stage, file_fingerprint
+from utils.instrument import instrumented
+
+# MiCASA cadence directory for each FluxNet timedelta
+MICASA_CADENCES = {"HH": "3hrly", "DD": "daily"}
+
+
+# Memory model of a preprocessing task (see estimate_site_memory)
+WORKER_BASE_MEMORY = 500 * 2**20  # interpreter + pandas/xarray/netCDF imports
+MICASA_READ_MEMORY = 256 * 2**20  # buffers of the MiCASA file/chunk being read
+FLUX_ROW_MEMORY = 5 * 8 * 4  # used columns x float64 x parsing copies
+HH_CHUNK_ROWS = 500_000  # rows held at once by the streamed HH import
+MICASA_STEPS_PER_DAY = {"DD": 1, "HH": 8}
+
+
+def estimate_site_size(site_ID, timedelta="DD"):
+    """ Estimate the work for a site from the size of its FluxNet CSV (bytes, 0 if missing) """
+    try:
+        return os.path.getsize(flux_site_file(FLUX_DATA_PATH, site_ID, timedelta))
+    except ValueError:
+        return 0
+
+
+def estimate_csv_rows(path, sample_bytes=1 << 16):
+    """ Estimate the rows of a CSV from the line length of its first sample_bytes """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        sample = f.read(sample_bytes)
+    return int(size * sample.count(b"\n") / max(len(sample), 1))
+
+
+def estimate_site_memory(site_ID, timedelta="DD", n_vars=2, footprint=1, years_per_chunk=None):
+    """ Estimate the peak memory of preprocess_site for a site (bytes)
+
+    A simple model: worker baseline + parsed FluxNet columns (HH is streamed
+    in bounded chunks) + extracted MiCASA points (per chunk of years when
+    chunked) + read buffers. Used to admit tasks within a node memory budget.
+
+    Args:
+        site_ID (str): FluxNet Site ID
+        timedelta (str): FluxNet time step (HH or DD)
+        n_vars (int): MiCASA variables extracted
+        footprint (int): footprint width in cells
+        years_per_chunk (int, optional): years of MiCASA read at a time
+
+    Returns:
+        int: estimated bytes (the baseline if the site has no FluxNet file)
+    """
+    try:
+        rows = estimate_csv_rows(flux_site_file(FLUX_DATA_PATH, site_ID, timedelta))
+    except ValueError:
+        return WORKER_BASE_MEMORY
+    flux_rows = min(rows, HH_CHUNK_ROWS) if timedelta == "HH" else rows
+
+    # Days of record (HH rows are half-hours) and MiCASA values held at once
+    days = rows / 48 if timedelta == "HH" else rows
+    if years_per_chunk is not None:
+        days = min(days, 366 * years_per_chunk)
+    micasa_values = days * MICASA_STEPS_PER_DAY[timedelta] * n_vars * (footprint**2 + 1)
+
+    return int(
+        WORKER_BASE_MEMORY + MICASA_READ_MEMORY
+        + flux_rows * FLUX_ROW_MEMORY
+        + micasa_values * 8 * 3  # float64, concat + DataFrame copies
+    )
+
+
+def extract_stage_key(con, site_ID, site_lat, site_lon, timedelta, micasa_var_list, store, fingerprints, footprint=1):
+    """ Run manifest key for the extract stage of a site (see utils.manifest.stage_key) """
+    return stage_key(
+        con, "extract",
+        inputs=[flux_site_file(FLUX_DATA_PATH, site_ID, timedelta)],
+        params={
+            "timedelta": timedelta, "micasa_var_list": list(micasa_var_list),
+            "site_lat": site_lat, "site_lon": site_lon, "store": store, "footprint": footprint,
+        },
+        fingerprints=fingerprints,
+    )
+
+
+@instrumented("extract")
+def preprocess_site(site_ID, site_lat, site_lon, timedelta="DD", micasa_var_list=("NEE", "NPP"),
+                    store=None, manifest_path=None, footprint=1, years_per_chunk=None):
+    """ Extract MiCASA data at a FluxNet site to the intermediates dataset
+
+    By default a site is skipped if it has any output. With a run manifest, the
+    site is instead skipped only if its inputs (FluxNet CSV contents, MiCASA
+    file fingerprints), parameters and code are unchanged since the last
+    completed run, and it is recorded in the manifest once fully written.
+
+    Args:
+        site_ID (str): FluxNet Site ID
+        site_lat, site_lon (float): site location
+        timedelta (str): FluxNet time step (HH or DD)
+        micasa_var_list (list of str): MiCASA variables to extract
+        store (Path object, optional): read MiCASA from a virtual/rechunked
+            store instead of the individual files
+        manifest_path (Path object, optional): run manifest for --changed-only runs
+        footprint (int): also extract the footprint x footprint cell mean of
+            each variable ("{var}_{footprint}x{footprint}", see utils.micasa.site_points)
+        years_per_chunk (int, optional): read a MiCASA store this many years at
+            a time (bounds the dask graph and memory of long records)
+
+    Returns:
+        str: status message
+    """
+    # xarray is only imported by the workers that extract
+    from utils.micasa import open_micasa_store, extract_micasa_points, extract_micasa_store_points, micasa_points_to_site_df
+
+    if timedelta not in MICASA_CADENCES:
+        raise ValueError(f"Timedelta {timedelta} invalid")
+    cadence = MICASA_CADENCES[timedelta]
+    micasa_var_list = list(micasa_var_list)
+
+    # Check if output for the site already exists
+    output_path = intermediates_path(MICASA_PREPROCESSED_DATA, timedelta)
+    if manifest_path is None and site_intermediates_exist(output_path, site_ID):
+        return f"Output for site {site_ID} already exists in {output_path}."
+
+    # Open site data
+    fluxnet_sel = import_flux_site_data(FLUX_DATA_PATH, site_ID, timedelta, site_lat, site_lon)
+    dates_unique = sorted({dt.date() for dt in fluxnet_sel.index})
+
+    if store is None:
+        # Build the MiCASA file index if it lacks this cadence (normally refreshed once by the controller)
+        if not micasa_index_has_cadence(MICASA_INDEX, cadence):
+            build_micasa_index(MICASA_DATA_PATH, MICASA_INDEX, cadences=(cadence,))
+        path_list = micasa_file_list(MICASA_INDEX, cadence, dates_unique)
+        fingerprints = [file_fingerprint(path) for path in path_list]
+    else:
+        fingerprints = [file_fingerprint(store)]
+
+    if manifest_path is not None:
+        with open_manifest(manifest_path) as con:
+            key, record = extract_stage_key(
+                con, site_ID, site_lat, site_lon, timedelta, micasa_var_list, store, fingerprints, footprint
+            )
+            if is_up_to_date(con, site_ID, "extract", key):
+                return f"Output for site {site_ID} is up to date in {output_path}."
+
+    # A one-site grid index is cheap to build, so it is not cached (one file per site otherwise)
+    if store is not None:
+        # Single store covering the whole archive, read only the site's date range
+        ds_points = extract_micasa_store_points(
+            open_micasa_store(store), [site_ID], [site_lat], [site_lon],
+            micasa_var_list, dates_unique, footprint, years_per_chunk=years_per_chunk,
+        )
+
+    else:
+        # Select grid closest to selected site
+        ds_points = extract_micasa_points(
+            path_list, [site_ID], [site_lat], [site_lon], micasa_var_list, footprint,
+        )
+
+    # Output all variables for the site to the intermediates dataset
+    ds_out = micasa_points_to_site_df(ds_points, site_ID, dates_unique)
+    write_site_intermediates(output_path, site_ID, ds_out)
+
+    if manifest_path is not None:
+        with open_manifest(manifest_path) as con:
+            record_stage(con, site_ID, "extract", key, record, [output_path / f"site={site_ID}"])
+    return f"Intermediates for site {site_ID} written to: {output_path}"
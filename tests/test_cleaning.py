@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.cleaning import clean_flux_sites, default_rules
+
+GPP = "GPP_DT (kgC m-2 s-1)"
+
+
+def three_hourly_site(n_days=60, seed=0):
+    """ 3-hourly site with a strong diurnal GPP cycle (zero at night, peak at midday) """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2020-06-01", periods=8 * n_days, freq="3h", name="TIMESTAMP")
+    diurnal = np.array([0.0, 0.0, 0.0, 1.0, 10.0, 1.0, 0.0, 0.0])
+    gpp = np.tile(diurnal, n_days) + rng.normal(0, 0.2, len(index))
+    return pd.DataFrame({
+        "NEE_VUT_REF": -gpp / 2,
+        "GPP_DT_VUT_REF": gpp,
+        "NEE_VUT_REF_QC": 1.0,
+    }, index=index)
+
+
+def test_hh_default_rules_keep_midday_peaks():
+    site = three_hourly_site()
+    midday = site.index.hour == 12
+
+    cleaned, _ = clean_flux_sites({"site": site}, "HH", default_rules(timedelta="HH"))
+    assert cleaned["site"].loc[midday, GPP].notna().all()
+
+    # Global quartiles (the daily rules) would mask them
+    cleaned, _ = clean_flux_sites({"site": site}, "HH", default_rules(timedelta="DD"))
+    assert cleaned["site"].loc[midday, GPP].isna().all()
+
+
+def test_hh_default_rules_mask_outliers_within_the_hour():
+    site = three_hourly_site()
+    night = np.flatnonzero(site.index.hour == 0)[10]
+    site.iloc[night, site.columns.get_loc("GPP_DT_VUT_REF")] = 8.0
+
+    cleaned, counts = clean_flux_sites({"site": site}, "HH", default_rules(timedelta="HH"))
+    assert np.isnan(cleaned["site"][GPP].iloc[night])
+    assert counts.loc[counts["rule"].str.startswith("iqr"), "n_masked"].sum() >= 1
@@ -0,0 +1,196 @@
+# Declarative FLUXNET cleaning pipeline: unit conversion, QC and outlier rules
+#
+# The cleaned variables are named columns of the FLUXNET files (FLUX_VARIABLES)
+# converted to MiCASA units, and the cleaning is a list of rules applied in
+# order, each a dict:
+#   {"rule": "qc", "columns": [...], "qc_column": "NEE_VUT_REF_QC", "min": 1}
+#   {"rule": "range", "columns": [...], "min": -1e-6, "max": 1e-6}
+#   {"rule": "iqr", "columns": [...], "factor": 1.5}
+#   {"rule": "iqr", "columns": [...], "factor": 1.5, "by": "hour"}  (quartiles per hour of day)
+#   {"rule": "mad", "columns": [...], "factor": 3.5}
+#   {"rule": "rolling", "columns": [...], "window": 15, "factor": 3.5}
+# All sites and variables are stacked into one (site, time, variable) array,
+# written once in MiCASA units, and every rule masks it in place with NumPy
+# operations over all sites at once. The values each rule removes are counted.
+
+import warnings
+import numpy as np
+import pandas as pd
+
+# Cleaned column: FLUXNET source column
+FLUX_VARIABLES = {
+    "NEE (kgC m-2 s-1)": "NEE_VUT_REF",
+    "GPP_DT (kgC m-2 s-1)": "GPP_DT_VUT_REF",
+}
+
+# FLUXNET units to kgC m-2 s-1: DD gC m-2 d-1, HH umolCO2 m-2 s-1 (12.011 gC/mol)
+UNIT_FACTORS = {
+    "DD": 1e-3 / 86400,
+    "HH": 1e-6 * 12.011 * 1e-3,
+}
+
+# Scale of the MAD to a normal standard deviation
+MAD_SCALE = 1.4826
+
+
+def default_rules(qc_min=1, iqr_factor=1.5, timedelta="DD"):
+    """ Cleaning rules of the original pipeline: NEE QC mask on both variables,
+    then IQR outlier removal on GPP
+
+    Sub-daily (HH) GPP has a strong diurnal cycle, so its quartiles are taken
+    per hour of day: global quartiles would flag the midday peaks.
+    """
+    iqr_rule = {"rule": "iqr", "columns": ["GPP_DT (kgC m-2 s-1)"], "factor": iqr_factor}
+    if timedelta == "HH":
+        iqr_rule["by"] = "hour"
+    return [
+        {"rule": "qc", "columns": list(FLUX_VARIABLES), "qc_column": "NEE_VUT_REF_QC", "min": qc_min},
+        iqr_rule,
+    ]
+
+
+def rule_name(rule):
+    """ Short label of a rule for the mask counts, e.g. iqr(factor=1.5) """
+    params = {key: value for key, value in rule.items() if key not in ("rule", "columns")}
+    return f"{rule['rule']}(" + ",".join(f"{key}={value}" for key, value in params.items()) + ")"
+
+
+def _mask_outside(values, low, high):
+    """ Mask (in place) values outside [low, high], bounds broadcast per site/variable """
+    with np.errstate(invalid="ignore"):
+        values[(values < low) | (values > high)] = np.nan
+
+
+def _rolling_median(values, window):
+    """ Centered rolling median along time (axis 1), NaN-aware """
+    half = window // 2
+    padded = np.pad(values, ((0, 0), (half, window - 1 - half), (0, 0)), constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)
+    return np.nanmedian(windows, axis=-1)
+
+
+def _iqr_bounds(block, factor):
+    """ Per-site/variable IQR outlier bounds along time """
+    with warnings.catch_warnings():
+        # All-NaN sites/windows (e.g. padding) give NaN bounds and mask nothing
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1, q3 = np.nanquantile(block, [0.25, 0.75], axis=1, keepdims=True)
+    iqr = q3 - q1
+    return q1 - factor * iqr, q3 + factor * iqr
+
+
+def apply_rule(rule, values, qc, var_index, hours=None):
+    """ Apply one rule in place to the (site, time, variable) array
+
+    Args:
+        rule (dict): rule, see the module header
+        values (np.ndarray): (site, time, variable) values, masked in place
+        qc (dict): {QC column: (site, time) array}
+        var_index (dict): {cleaned column: index along the variable axis}
+        hours (np.ndarray, optional): (site, time) hour of day of each value
+            (-1 for padding), needed by rules with "by": "hour"
+    """
+    cols = [var_index[col] for col in rule["columns"]]
+    # Contiguous variables are masked through a view, others on a copy written back
+    contiguous = cols == list(range(cols[0], cols[0] + len(cols)))
+    block = values[:, :, cols[0]:cols[0] + len(cols)] if contiguous else values[:, :, cols]
+
+    kind = rule["rule"]
+    if kind == "qc":
+        # Missing QC flags are kept, as with a pandas mask
+        with np.errstate(invalid="ignore"):
+            bad = qc[rule["qc_column"]] < rule["min"]
+        block[bad] = np.nan
+    elif kind == "range":
+        _mask_outside(block, rule.get("min", -np.inf), rule.get("max", np.inf))
+    elif kind == "iqr" and rule.get("by") == "hour":
+        # Quartiles of each hour of day, computed on that hour's values only
+        for hour in np.unique(hours[hours >= 0]):
+            at_hour = (hours == hour)[:, :, None]
+            low, high = _iqr_bounds(np.where(at_hour, block, np.nan), rule["factor"])
+            with np.errstate(invalid="ignore"):
+                block[at_hour & ((block < low) | (block > high))] = np.nan
+    elif kind == "iqr":
+        _mask_outside(block, *_iqr_bounds(block, rule["factor"]))
+    elif kind == "mad":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(block, axis=1, keepdims=True)
+            mad = MAD_SCALE * np.nanmedian(np.abs(block - median), axis=1, keepdims=True)
+        _mask_outside(block, median - rule["factor"] * mad, median + rule["factor"] * mad)
+    elif kind == "rolling":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = _rolling_median(block, rule["window"])
+            mad = MAD_SCALE * np.nanmedian(np.abs(block - median), axis=1, keepdims=True)
+        _mask_outside(block, median - rule["factor"] * mad, median + rule["factor"] * mad)
+    else:
+        raise ValueError(f"Cleaning rule {kind} invalid")
+
+    if not contiguous:
+        values[:, :, cols] = block
+
+
+def clean_flux_sites(site_frames, timedelta="DD", rules=None, variables=FLUX_VARIABLES):
+    """ Convert and clean the FLUXNET data of many sites at once
+
+    Args:
+        site_frames (dict): {site ID: output of import_flux_site_data}
+        timedelta (str): measurement frequency (HH or DD), selects the unit factor
+        rules (list of dict, optional): cleaning rules (default:
+            default_rules(timedelta=timedelta))
+        variables (dict): {cleaned column: FLUXNET column}
+
+    Returns:
+        tuple: ({site ID: DataFrame with the cleaned columns added}, mask
+            counts DataFrame with site, rule, column, n_valid (values before
+            the rule) and n_masked (values the rule removed))
+    """
+    rules = default_rules(timedelta=timedelta) if rules is None else rules
+    sites = list(site_frames)
+    columns = list(variables)
+    var_index = {col: i for i, col in enumerate(columns)}
+    lengths = [len(site_frames[site]) for site in sites]
+    n_time = max(lengths, default=0)
+
+    # One (site, time, variable) array in MiCASA units, NaN padded past each site's record
+    values = np.full((len(sites), n_time, len(columns)), np.nan)
+    qc_columns = {rule["qc_column"] for rule in rules if rule["rule"] == "qc"}
+    qc = {col: np.full((len(sites), n_time), np.nan) for col in qc_columns}
+    by_hour = any(rule.get("by") == "hour" for rule in rules)
+    hours = np.full((len(sites), n_time), -1, dtype=np.int8) if by_hour else None
+    for i, site in enumerate(sites):
+        df = site_frames[site]
+        values[i, :lengths[i]] = df[[variables[col] for col in columns]].to_numpy(dtype=np.float64)
+        for col in qc_columns:
+            qc[col][i, :lengths[i]] = df[col].to_numpy(dtype=np.float64)
+        if by_hour:
+            hours[i, :lengths[i]] = df.index.hour
+    values *= UNIT_FACTORS[timedelta]
+
+    counts = []
+    valid = ~np.isnan(values)
+    for rule in rules:
+        apply_rule(rule, values, qc, var_index, hours)
+        still_valid = ~np.isnan(values)
+        n_valid, n_kept = valid.sum(axis=1), still_valid.sum(axis=1)
+        for col in rule["columns"]:
+            j = var_index[col]
+            counts.append(pd.DataFrame({
+                "site": sites,
+                "rule": rule_name(rule),
+                "column": col,
+                "n_valid": n_valid[:, j],
+                "n_masked": n_valid[:, j] - n_kept[:, j],
+            }))
+        valid = still_valid
+
+    cleaned = {}
+    for i, site in enumerate(sites):
+        cleaned[site] = site_frames[site].assign(**{
+            col: values[i, :lengths[i], j] for col, j in var_index.items()
+        })
+    counts = pd.concat(counts, ignore_index=True) if counts else pd.DataFrame(
+        columns=["site", "rule", "column", "n_valid", "n_masked"]
+    )
+    return cleaned, counts
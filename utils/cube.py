@@ -0,0 +1,166 @@
+# Memory-mapped site x day x variable cube of the MiCASA and FluxNet series
+#
+# A cube is a directory with:
+#   values.npy   float32 (site, time, variable), NaN where there is no data
+#   coords.json  sites (+ lat/lon), first day, number of days, variables, units
+# values.npy is opened memory-mapped and read-only, so many processes can share
+# one copy. open_comparison_cube wraps it as an xarray DataArray with a "cube"
+# accessor for the usual selections and statistics.
+
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from analysis.metrics import COMPARISONS
+
+CUBE_UNITS = "kgC m-2 s-1"
+
+
+def cube_variables(comparisons=COMPARISONS):
+    """ Cube variable names: "MiCASA {var}" and "FluxNet {var}" for each comparison """
+    return [f"{source} {var}" for var in comparisons for source in ("MiCASA", "FluxNet")]
+
+
+def build_comparison_cube(cube_path, micasa_wide, flux_sites, site_meta=None, comparisons=COMPARISONS):
+    """ Write the daily MiCASA and FluxNet series of all sites to a cube
+
+    Args:
+        cube_path (Path object): cube directory (replaced atomically)
+        micasa_wide (pd.DataFrame): MiCASA intermediates indexed by (site, time),
+            e.g. read_intermediates(..., wide=True)
+        flux_sites (dict): {site ID: cleaned FluxNet DataFrame indexed by time}
+        site_meta (pd.DataFrame, optional): metadata with Site ID, Latitude
+            (degrees) and Longitude (degrees), stored as site coordinates
+        comparisons (dict): compared variables, see analysis.metrics.COMPARISONS
+            (FluxNet scale factors are applied, e.g. NPP = GPP_DT/2)
+
+    Returns:
+        Path object: cube directory
+    """
+    cube_path = Path(cube_path)
+    micasa_sites = micasa_wide.index.get_level_values("site").astype(str)
+    sites = sorted(set(micasa_sites) | set(flux_sites))
+    variables = cube_variables(comparisons)
+
+    # Daily axis covering every site
+    times = [micasa_wide.index.get_level_values("time")]
+    times += [df.index for df in flux_sites.values() if len(df)]
+    start = min(t.min() for t in times).normalize()
+    end = max(t.max() for t in times).normalize()
+    n_days = (end - start).days + 1
+
+    cube_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cube_path.parent, prefix=f".{cube_path.name}."))
+    values = np.lib.format.open_memmap(
+        tmp_dir / "values.npy", mode="w+", dtype=np.float32, shape=(len(sites), n_days, len(variables))
+    )
+    values[:] = np.nan
+
+    def fill(i_site, column, series):
+        series = series.dropna()
+        days = ((series.index.normalize() - start) // pd.Timedelta("1D")).to_numpy()
+        values[i_site, days, variables.index(column)] = series.to_numpy(dtype=np.float32)
+
+    micasa_groups = dict(list(micasa_wide.groupby(micasa_sites)))
+    for i_site, site_ID in enumerate(sites):
+        micasa = micasa_groups.get(site_ID)
+        flux = flux_sites.get(site_ID)
+        for var, (micasa_col, flux_col, scale) in comparisons.items():
+            if micasa is not None:
+                fill(i_site, f"MiCASA {var}", micasa[micasa_col].droplevel("site"))
+            if flux is not None:
+                fill(i_site, f"FluxNet {var}", flux[flux_col] * scale)
+    values.flush()
+    del values
+
+    coords = {
+        "sites": sites,
+        "start": start.strftime("%Y-%m-%d"),
+        "n_days": n_days,
+        "variables": variables,
+        "units": CUBE_UNITS,
+    }
+    if site_meta is not None:
+        meta = site_meta.set_index("Site ID").reindex(sites)
+        coords["lat"] = meta["Latitude (degrees)"].astype(float).tolist()
+        coords["lon"] = meta["Longitude (degrees)"].astype(float).tolist()
+    with open(tmp_dir / "coords.json", "w") as f:
+        json.dump(coords, f, indent=1)
+
+    if cube_path.exists():
+        shutil.rmtree(cube_path)
+    os.replace(tmp_dir, cube_path)
+    return cube_path
+
+
+def open_comparison_cube(cube_path):
+    """ Open a cube as a read-only, memory-mapped DataArray
+
+    Args:
+        cube_path (Path object): cube directory written by build_comparison_cube
+
+    Returns:
+        xr.DataArray: dims (site, time, variable); lat/lon site coordinates
+            when available
+    """
+    cube_path = Path(cube_path)
+    with open(cube_path / "coords.json") as f:
+        coords = json.load(f)
+    values = np.load(cube_path / "values.npy", mmap_mode="r")
+
+    da = xr.DataArray(
+        values,
+        dims=("site", "time", "variable"),
+        coords={
+            "site": coords["sites"],
+            "time": pd.date_range(coords["start"], periods=coords["n_days"], freq="D"),
+            "variable": coords["variables"],
+        },
+        name="flux",
+        attrs={"units": coords["units"]},
+    )
+    if "lat" in coords:
+        da = da.assign_coords(lat=("site", coords["lat"]), lon=("site", coords["lon"]))
+    return da
+
+
+@xr.register_dataarray_accessor("cube")
+class ComparisonCubeAccessor:
+    """ Selections and statistics on a comparison cube (open_comparison_cube)
+
+        cube = open_comparison_cube(path)
+        cube.cube.pair("NEE")                  # (MiCASA, FluxNet) site x time
+        cube.cube.months([6, 7, 8]).cube.rmse("NEE")
+    """
+
+    def __init__(self, da):
+        self._da = da
+
+    def pair(self, var):
+        """ MiCASA and FluxNet (site x time) arrays of a compared variable """
+        return (
+            self._da.sel(variable=f"MiCASA {var}", drop=True),
+            self._da.sel(variable=f"FluxNet {var}", drop=True),
+        )
+
+    def months(self, months):
+        """ Days in the given months (e.g. PERIODS["GRW"]) """
+        return self._da.isel(time=self._da["time"].dt.month.isin(months).values)
+
+    def sites(self, site_IDs):
+        return self._da.sel(site=list(site_IDs))
+
+    def rmse(self, var, dim="time"):
+        """ RMSE of MiCASA vs FluxNet over dim, where both are present """
+        model, obs = self.pair(var)
+        diff = (model - obs).astype(np.float64)
+        return np.sqrt((diff**2).mean(dim, skipna=True)).rename(f"{var}_RMSE")
+
+    def site_frame(self, site_ID):
+        """ One site as a DataFrame (time x variable) """
+        return self._da.sel(site=site_ID).to_pandas()
@@ -0,0 +1,282 @@
+# Cache of cleaned FLUXNET site data, built once from the raw AmeriFlux CSVs
+#
+# Each entry is a directory {site}_{timedelta}_{key}/ with index.npy (timestamps),
+# values.npy (float64, time x column, memory-mapped on read) and meta.json.
+# The key hashes the source CSV contents, the cleaning parameters and
+# FLUX_CACHE_VERSION, so entries are rebuilt automatically when any changes.
+# load_flux_sites cleans all the cache misses of a batch of sites in one
+# utils.cleaning.clean_flux_sites call.
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from utils.functions import flux_site_file, import_flux_site_data
+from utils.cleaning import clean_flux_sites, default_rules
+from utils.instrument import count, instrumented, stage
+
+# Bump when the cleaning code changes so old cache entries are rebuilt
+FLUX_CACHE_VERSION = 2
+
+
+def prep_flux_sites(site_frames, timedelta="DD", qc_min=1, iqr_factor=1.5, rules=None):
+    """ Convert the FLUXNET data of many sites to MiCASA units, QC mask and remove outliers
+
+    All sites are cleaned in one clean_flux_sites call.
+
+    Args:
+        site_frames (dict): {site ID: output of import_flux_site_data}
+        timedelta (str): measurement frequency (HH or DD)
+        qc_min (float): minimum NEE QC value to keep
+        iqr_factor (float): IQR multiple used for GPP outlier removal
+        rules (list of dict, optional): cleaning rules (see utils.cleaning),
+            overriding qc_min and iqr_factor
+
+    Returns:
+        dict: {site ID: DataFrame with "NEE (kgC m-2 s-1)" and
+            "GPP_DT (kgC m-2 s-1)" columns added, and the values masked by
+            each rule in attrs["mask_counts"]}
+    """
+    rules = default_rules(qc_min, iqr_factor, timedelta) if rules is None else rules
+    cleaned, counts = clean_flux_sites(site_frames, timedelta, rules)
+    for rule, n_masked in counts.groupby("rule", sort=False)["n_masked"].sum().items():
+        count(f"masked_{rule.split('(', 1)[0]}", int(n_masked))
+
+    for site_ID, site_counts in counts.groupby("site", sort=False):
+        cleaned[site_ID].attrs["mask_counts"] = site_counts.drop(columns="site").to_dict("records")
+    return cleaned
+
+
+def prep_flux_site_data(fluxnet_sel, timedelta="DD", qc_min=1, iqr_factor=1.5, rules=None):
+    """ Convert FLUXNET site data to MiCASA units, QC mask and remove outliers
+
+    Args:
+        fluxnet_sel (pd.DataFrame): output of import_flux_site_data
+        timedelta, qc_min, iqr_factor, rules: see prep_flux_sites
+
+    Returns:
+        pd.DataFrame: fluxnet_sel cleaned, see prep_flux_sites
+    """
+    return prep_flux_sites({"site": fluxnet_sel}, timedelta, qc_min, iqr_factor, rules)["site"]
+
+
+def source_file_hash(site_file, cache_dir):
+    """ SHA-256 of a source CSV, re-hashed only if its size or mtime changed
+
+    Args:
+        site_file (Path object): source CSV
+        cache_dir (Path object): cache directory holding the hash sidecars
+
+    Returns:
+        str: hex digest of the file contents
+    """
+    st = os.stat(site_file)
+    sidecar = Path(cache_dir) / f"{Path(site_file).name}.hash.json"
+    if sidecar.exists():
+        with open(sidecar) as f:
+            known = json.load(f)
+        if known["size"] == st.st_size and known["mtime"] == st.st_mtime:
+            return known["sha256"]
+
+    digest = hashlib.sha256()
+    with open(site_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    known = {"size": st.st_size, "mtime": st.st_mtime, "sha256": digest.hexdigest()}
+
+    tmp_path = sidecar.with_name("." + sidecar.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(known, f)
+    os.replace(tmp_path, sidecar)
+    return known["sha256"]
+
+
+def write_cache_entry(entry_path, df, meta):
+    """ Atomically write a DataFrame to a cache entry directory """
+    entry_path = Path(entry_path)
+    tmp_dir = tempfile.mkdtemp(dir=entry_path.parent, prefix=".tmp-")
+    np.save(os.path.join(tmp_dir, "index.npy"), df.index.values.astype("datetime64[ns]"))
+    np.save(os.path.join(tmp_dir, "values.npy"), df.to_numpy(dtype=np.float64))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({
+            **meta,
+            "columns": df.columns.tolist(),
+            "index_name": df.index.name,
+            "mask_counts": df.attrs.get("mask_counts", []),
+        }, f)
+    try:
+        os.rename(tmp_dir, entry_path)
+    except OSError:
+        # Another worker wrote the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_cache_entry(entry_path):
+    """ Read a cache entry, memory-mapping the values (read-only) """
+    entry_path = Path(entry_path)
+    with open(entry_path / "meta.json") as f:
+        meta = json.load(f)
+    index = pd.DatetimeIndex(np.load(entry_path / "index.npy"), name=meta["index_name"])
+    values = np.load(entry_path / "values.npy", mmap_mode="r")
+    df = pd.DataFrame(values, index=index, columns=meta["columns"], copy=False)
+    df.attrs["mask_counts"] = meta.get("mask_counts", [])
+    return df
+
+
+def flux_cache_key(flux_data_path, site_ID, timedelta, cache_dir=None,
+                   site_lat=None, site_lon=None, qc_min=1, iqr_factor=1.5, rules=None):
+    """ Cache key of a site's cleaned data: source CSV contents, cleaning rules and version
+
+    Downstream stages (RMSE, plots) include it in their run manifest key, so a
+    change to the source data or the cleaning invalidates them.
+
+    Args:
+        see load_flux_site_data
+
+    Returns:
+        tuple: (key, meta) with meta the hashed parameters
+    """
+    if site_lat is not None and site_lon is not None:
+        site_lat, site_lon = float(np.squeeze(site_lat)), float(np.squeeze(site_lon))
+    site_file = flux_site_file(flux_data_path, site_ID, timedelta)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        source_sha256 = source_file_hash(site_file, cache_dir)
+    else:
+        with open(site_file, "rb") as f:
+            source_sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    meta = {
+        "version": FLUX_CACHE_VERSION,
+        "source": str(site_file),
+        "source_sha256": source_sha256,
+        "timedelta": timedelta,
+        "site_lat": site_lat,
+        "site_lon": site_lon,
+        "rules": default_rules(qc_min, iqr_factor, timedelta) if rules is None else rules,
+    }
+    return hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:16], meta
+
+
+def _load_flux_sites(flux_data_path, site_IDs, timedelta, cache_dir=None, locations=None,
+                     qc_min=1, iqr_factor=1.5, rules=None, manifest_path=None, on_error=None):
+    locations = locations or {}
+    flux_sites, site_frames, entries = {}, {}, {}
+    for site_ID in site_IDs:
+        site_lat, site_lon = locations.get(site_ID, (None, None))
+        try:
+            if cache_dir is None:
+                site_frames[site_ID] = import_flux_site_data(flux_data_path, site_ID, timedelta, site_lat, site_lon)
+                continue
+            key, meta = flux_cache_key(
+                flux_data_path, site_ID, timedelta, cache_dir, site_lat, site_lon, qc_min, iqr_factor, rules,
+            )
+            entry_path = Path(cache_dir) / f"{site_ID}_{timedelta}_{key}"
+            count("cache_hits" if entry_path.is_dir() else "cache_misses")
+            if entry_path.is_dir():
+                flux_sites[site_ID] = read_cache_entry(entry_path)
+                continue
+            entries[site_ID] = (entry_path, meta)
+            site_frames[site_ID] = import_flux_site_data(
+                flux_data_path, site_ID, timedelta, meta["site_lat"], meta["site_lon"],
+            )
+        except ValueError as e:
+            if on_error is None:
+                raise
+            on_error(site_ID, e)
+
+    if site_frames:
+        # All cache misses are cleaned at once
+        cleaned = prep_flux_sites(site_frames, timedelta, qc_min, iqr_factor, rules)
+        if cache_dir is None:
+            flux_sites.update(cleaned)
+        else:
+            flux_sites.update(_cache_cleaned_sites(cleaned, entries, cache_dir, timedelta, manifest_path))
+    return {site_ID: flux_sites[site_ID] for site_ID in site_IDs if site_ID in flux_sites}
+
+
+def _cache_cleaned_sites(cleaned, entries, cache_dir, timedelta, manifest_path=None):
+    """ Write cleaned sites to their cache entries and read them back (memory-mapped) """
+    with contextlib.ExitStack() as stack:
+        con = None
+        if manifest_path is not None:
+            from utils.manifest import open_manifest, stage_key, record_stage
+            con = stack.enter_context(open_manifest(manifest_path))
+
+        flux_sites = {}
+        for site_ID, fluxnet_sel in cleaned.items():
+            entry_path, meta = entries[site_ID]
+            write_cache_entry(entry_path, fluxnet_sel, meta)
+
+            if con is not None:
+                # The active rule set (default or custom) is part of the stage parameters
+                params = {k: v for k, v in meta.items() if k not in ("source", "source_sha256", "rules")}
+                params["rules"] = json.dumps(meta["rules"], sort_keys=True)
+                key, record = stage_key(con, "clean", [Path(meta["source"])], params)
+                record_stage(con, site_ID, "clean", key, record, [entry_path])
+
+            # Remove stale entries for this site
+            for stale in Path(cache_dir).glob(f"{site_ID}_{timedelta}_*"):
+                if stale != entry_path:
+                    shutil.rmtree(stale, ignore_errors=True)
+            flux_sites[site_ID] = read_cache_entry(entry_path)
+    return flux_sites
+
+
+def load_flux_sites(flux_data_path, site_IDs, timedelta, cache_dir=None, locations=None,
+                    qc_min=1, iqr_factor=1.5, rules=None, manifest_path=None, on_error=None):
+    """ Import cleaned FLUXNET data for many sites, cleaning all cache misses at once
+
+    Sites found in the cache are read from it, the others are imported and
+    cleaned together in one clean_flux_sites call, then cached.
+
+    Args:
+        flux_data_path (Path object): path to flux data CSVs
+        site_IDs (list of str): FluxNet Site IDs
+        timedelta (str): measurement frequency (HH or DD)
+        cache_dir (Path object, optional): cache directory (no caching if None)
+        locations (dict, optional): {site ID: (lat, lon)}, required for HH
+        qc_min, iqr_factor, rules: cleaning parameters, see prep_flux_sites
+        manifest_path (Path object, optional): run manifest recording the "clean"
+            stage whenever a cache entry is (re)built
+        on_error (callable, optional): called as on_error(site ID, error) for
+            sites whose data cannot be imported (ValueError), which are then
+            left out; the error is raised if None
+
+    Returns:
+        dict: {site ID: cleaned site data (read-only when cached)}, in site_IDs order
+    """
+    with stage("clean", n_sites=len(site_IDs)):
+        return _load_flux_sites(
+            flux_data_path, site_IDs, timedelta, cache_dir, locations,
+            qc_min, iqr_factor, rules, manifest_path, on_error,
+        )
+
+
+@instrumented("clean")
+def load_flux_site_data(flux_data_path, site_ID, timedelta, cache_dir=None,
+                        site_lat=None, site_lon=None, qc_min=1, iqr_factor=1.5, rules=None, manifest_path=None):
+    """ Import cleaned FLUXNET data for a site, from the cache when up to date
+
+    Args:
+        flux_data_path (Path object): path to flux data CSVs
+        site_ID (str): FluxNet Site ID of interest
+        timedelta (str): measurement frequency (HH or DD)
+        cache_dir (Path object, optional): cache directory (no caching if None)
+        site_lat, site_lon (float): site location, required for HH
+        qc_min, iqr_factor, rules: cleaning parameters, see prep_flux_sites
+        manifest_path (Path object, optional): run manifest recording the "clean"
+            stage whenever a cache entry is (re)built
+
+    Returns:
+        pd.DataFrame: cleaned site data (read-only when loaded from the cache)
+    """
+    return _load_flux_sites(
+        flux_data_path, [site_ID], timedelta, cache_dir, {site_ID: (site_lat, site_lon)},
+        qc_min, iqr_factor, rules, manifest_path,
+    )[site_ID]
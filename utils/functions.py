@@ -1,31 +1,36 @@
 # Functions used in this project
 
 from pathlib import Path
+from datetime import datetime
+import functools
 import glob
+import os
+import sqlite3
 import numpy as np
 import pandas as pd
-import pytz
-from timezonefinder import TimezoneFinder
 
+from utils.instrument import stage, count, instrumented
+from utils.cleaning import UNIT_FACTORS, apply_rule
 
-def import_flux_metadata(flux_metadata_path):
+
+def import_flux_metadata(flux_metadata_path, cache_dir=None):
     """ Import FLUXNET only Ameriflux metadata information
 
+    The TSV is parsed once per process (see utils.site_metadata); use
+    load_site_metadata directly for site lookups and filters.
+
     Args: 
         flux_metadata_path (Path object): Path to Ameriflux metadata CSV
+        cache_dir (Path object, optional): parsed metadata cache directory
 
 
     Returns:
-        fluxnet_sel_sub (pd.DataFrame): clean dataframe of 
+        fluxnet_sel_sub (pd.DataFrame): clean dataframe of FLUXNET sites, with
+            the parsed years of data in a "years" column
     """
+    from utils.site_metadata import load_site_metadata
 
-    # Import site metadata csv
-    ameriflux_meta = pd.read_csv(flux_metadata_path, sep="\t")
-    fluxnet_meta = ameriflux_meta.loc[
-            ameriflux_meta["AmeriFlux FLUXNET Data"] == "Yes"
-            ]  # use FLUXNET only
-    fluxnet_meta = fluxnet_meta.reset_index(drop=True)
-    return fluxnet_meta
+    return load_site_metadata(flux_metadata_path, cache_dir).frame()
 
 def import_site_RMSE_data(flux_metadata_path,RMSE_results_path):
     fluxnet_meta = import_flux_metadata(flux_metadata_path)
@@ -42,6 +47,33 @@ def import_site_RMSE_data(flux_metadata_path,RMSE_results_path):
     RMSE_results = pd.read_csv(RMSE_results_path, index_col='SiteID')
     return df_meta.join(RMSE_results, on='Site ID', how="inner")
 
+@functools.lru_cache(maxsize=1)
+def timezone_finder():
+    """ Shared TimezoneFinder instance (slow to construct, only needed for HH data) """
+    from timezonefinder import TimezoneFinder
+    return TimezoneFinder()
+
+@functools.lru_cache(maxsize=None)
+def site_utc_offset(lat, lon):
+    """ Fixed standard-time (no DLS) UTC offset at a site location
+
+    Args:
+        lat: latitude
+        lon: longitude
+
+    Returns:
+        pd.Timedelta: local standard time minus UTC
+    """
+    import pytz
+
+    timezone_str = timezone_finder().timezone_at(lat=float(lat), lng=float(lon))
+    if timezone_str is None:
+        raise ValueError("Cannot determine site time zone")
+    timezone = pytz.timezone(timezone_str)
+    local_time = timezone.localize(datetime(2000, 1, 1), is_dst=False)
+    # Remove any DLS (e.g. southern hemisphere summer)
+    return pd.Timedelta(local_time.utcoffset() - local_time.dst())
+
 def local_std_to_utc_std(df, col, lat, lon):
     """ Convert local standard time (no DLS) to UTC
 
@@ -54,22 +86,8 @@ def local_std_to_utc_std(df, col, lat, lon):
     Returns:
         pd.Dataframe: A dataframe with an additional column in UTC time 
     """
-    def convert_row(row):
-        # Find the timezone for the given lat/lon
-        tf = TimezoneFinder()
-        timezone_str = tf.timezone_at(lat=lat, lng=lon)
-        if timezone_str is not None:
-            timezone = pytz.timezone(timezone_str)
-            # Localize datetime without DST
-            standard_time = timezone.normalize(
-                timezone.localize(row[col], is_dst=False)
-            )
-            # Convert to UTC
-            return standard_time.astimezone(pytz.utc)
-        else:
-            raise ValueError("Cannot determine site time zone")
-
-    df["utc_time"] = df.apply(convert_row, axis=1)
+    utc_offset = site_utc_offset(float(np.squeeze(lat)), float(np.squeeze(lon)))
+    df["utc_time"] = (df[col] - utc_offset).dt.tz_localize("UTC")
     return df
 
 def get_single_match(base_path, pattern):
@@ -88,6 +106,8 @@ def get_single_match(base_path, pattern):
     # Use glob.glob for complex patterns with subdirectories
     full_pattern = str(base_path / pattern)
     matches = glob.glob(full_pattern)
+    count("glob_calls")
+    count("glob_matches", len(matches))
 
     # Convert back to Path objects
     matches = [Path(m) for m in matches]
@@ -99,16 +119,157 @@ def get_single_match(base_path, pattern):
     else:
         raise ValueError(f"Multiple matches found for pattern '{pattern}': {matches}")
 
-def import_flux_site_data(flux_data_path, site_ID, timedelta):
-    """ Import site data for selected site ID and timedelta
+# MiCASA file index: one row per file, keyed by cadence (daily/3hrly) and date
+MICASA_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    cadence TEXT NOT NULL,
+    date TEXT NOT NULL,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (cadence, date, path)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    dir TEXT PRIMARY KEY,
+    mtime REAL
+);
+"""
+
+@instrumented("micasa_index")
+def build_micasa_index(micasa_data_path, index_path, cadences=("daily", "3hrly")):
+    """ Build or incrementally refresh the SQLite index of MiCASA files
+
+    Only YYYY/MM directories whose mtime changed since the last refresh are
+    listed again, so refreshing after a new year of data lands is cheap.
 
-    Args: 
+    Args:
+        micasa_data_path (Path object): MiCASA data root (contains daily/, 3hrly/)
+        index_path (Path object): SQLite index file to create/update
+        cadences (tuple of str): cadence subdirectories to index
+
+    Returns:
+        int: number of month directories (re)scanned
+    """
+    n_scanned = 0
+    with sqlite3.connect(index_path) as con:
+        con.executescript(MICASA_INDEX_SCHEMA)
+        known = dict(con.execute("SELECT dir, mtime FROM dirs"))
+        seen = set()
+
+        for cadence in cadences:
+            cadence_path = Path(micasa_data_path) / cadence
+            if not cadence_path.is_dir():
+                continue
+            month_dirs = [
+                Path(month.path)
+                for year in os.scandir(cadence_path) if year.is_dir()
+                for month in os.scandir(year.path) if month.is_dir()
+            ]
+            for month_dir in month_dirs:
+                month_key = str(month_dir)
+                seen.add(month_key)
+                dir_mtime = month_dir.stat().st_mtime
+                if known.get(month_key) == dir_mtime:
+                    continue  # Unchanged since last refresh
+
+                rows = []
+                for entry in os.scandir(month_dir):
+                    if not (entry.name.startswith("MiCASA_v1_flux_") and entry.name.endswith(".nc4")):
+                        continue
+                    stamp = entry.name[-12:-4]  # ..._YYYYMMDD.nc4
+                    date = f"{stamp[:4]}-{stamp[4:6]}-{stamp[6:]}"
+                    st = entry.stat()
+                    rows.append((cadence, date, entry.path, month_key, st.st_size, st.st_mtime))
+
+                con.execute("DELETE FROM files WHERE dir = ?", (month_key,))
+                con.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+                con.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (month_key, dir_mtime))
+                n_scanned += 1
+                count("dirs_scanned")
+                count("files_indexed", len(rows))
+
+        # Drop directories that have been removed from the archive (of the indexed cadences only)
+        cadence_roots = tuple(str(Path(micasa_data_path) / cadence) + os.sep for cadence in cadences)
+        for month_key in {key for key in known if key.startswith(cadence_roots)} - seen:
+            con.execute("DELETE FROM files WHERE dir = ?", (month_key,))
+            con.execute("DELETE FROM dirs WHERE dir = ?", (month_key,))
+
+    return n_scanned
+
+
+def micasa_index_has_cadence(index_path, cadence):
+    """ Whether the MiCASA file index exists and lists files of a cadence """
+    if not Path(index_path).exists():
+        return False
+    with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as con:
+        try:
+            return con.execute("SELECT 1 FROM files WHERE cadence = ? LIMIT 1", (cadence,)).fetchone() is not None
+        except sqlite3.OperationalError:
+            return False  # Index created but never filled
+
+
+def micasa_file_list(index_path, cadence, dates):
+    """ Look up the MiCASA file for each date in the file index
+
+    Dates with no file (or more than one matching file) are skipped.
+
+    Args:
+        index_path (Path object): SQLite index built by build_micasa_index
+        cadence (str): MiCASA cadence ("daily" or "3hrly")
+        dates (iterable of datetime.date): dates to look up
+
+    Returns:
+        list of Path objects: one MiCASA file per available date, sorted by date
+    """
+    dates = {date.isoformat() for date in dates}
+    if not dates:
+        return []
+
+    # Single indexed range query over the site's dates
+    with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as con:
+        rows = con.execute(
+            "SELECT date, path FROM files WHERE cadence = ? AND date BETWEEN ? AND ? ORDER BY date",
+            (cadence, min(dates), max(dates)),
+        ).fetchall()
+
+    matches = {}
+    for date, path in rows:
+        if date in dates:
+            matches.setdefault(date, []).append(Path(path))
+    path_list = [paths[0] for date, paths in matches.items() if len(paths) == 1]
+    count("micasa_files", len(path_list))
+    return path_list
+
+# FLUXNET daily columns used in this project and their dtypes
+FLUX_DD_COLUMNS = {
+    "TIMESTAMP": str,
+    "NEE_VUT_REF": np.float64,
+    "NEE_VUT_REF_QC": np.float64,
+    "GPP_NT_VUT_REF": np.float64,
+    "GPP_DT_VUT_REF": np.float64,
+}
+
+# FLUXNET half-hourly columns used in this project, and the MiCASA window they are averaged to
+FLUX_HH_COLUMNS = {
+    "TIMESTAMP_START": str,
+    "NEE_VUT_REF": np.float64,
+    "NEE_VUT_REF_QC": np.float64,
+    "GPP_NT_VUT_REF": np.float64,
+    "GPP_DT_VUT_REF": np.float64,
+}
+FLUX_HH_WINDOW = "3h"
+
+def flux_site_file(flux_data_path, site_ID, timedelta):
+    """ Find the AmeriFlux FLUXNET CSV for a site ID and timedelta
+
+    Args:
         flux_data_path (Path object): path to flux data CSVs
         site_ID (str): FluxNet Site ID of interest
         timedelta (str): measurement frequency (HH or DD)
 
     Returns:
-        fluxnet_sel_sub (pd.DataFrame): A cleaned DataFrame with all sites metadata
+        Path (Path object): site CSV file
     """
     pattern = (
         "AMF_"
@@ -119,13 +280,34 @@ def import_flux_site_data(flux_data_path, site_ID, timedelta):
         + timedelta
         + "*.csv"
     )
-    site_file = get_single_match(flux_data_path, pattern)
-    fluxnet_sel = pd.read_csv(site_file)
+    return get_single_match(flux_data_path, pattern)
+
+@instrumented("load_flux")
+def import_flux_site_data(flux_data_path, site_ID, timedelta, site_lat=None, site_lon=None, chunksize=500_000):
+    """ Import site data for selected site ID and timedelta
+
+    Half-hourly (HH) data are read in chunks, converted from local standard
+    time to UTC and averaged to the 3-hourly MiCASA windows (labelled by
+    window start, UTC).
+
+    Args: 
+        flux_data_path (Path object): path to flux data CSVs
+        site_ID (str): FluxNet Site ID of interest
+        timedelta (str): measurement frequency (HH or DD)
+        site_lat, site_lon (float): site location, required for HH
+        chunksize (int): rows read at a time for HH
+
+    Returns:
+        fluxnet_sel_sub (pd.DataFrame): A cleaned DataFrame with all sites metadata
+    """
+    site_file = flux_site_file(flux_data_path, site_ID, timedelta)
 
     if timedelta == "DD":
-        fluxnet_sel_sub = fluxnet_sel.loc[:,
-        ["TIMESTAMP", "NEE_VUT_REF", "NEE_VUT_REF_QC", "GPP_NT_VUT_REF", "GPP_DT_VUT_REF"],
-        ].copy()
+        # Only parse the columns that are used
+        fluxnet_sel_sub = pd.read_csv(
+            site_file, usecols=list(FLUX_DD_COLUMNS), dtype=FLUX_DD_COLUMNS
+        )
+        fluxnet_sel_sub = fluxnet_sel_sub[list(FLUX_DD_COLUMNS)]
         fluxnet_sel_sub["TIMESTAMP"] = pd.to_datetime(
                 fluxnet_sel_sub["TIMESTAMP"], format="%Y%m%d"
             )
@@ -133,77 +315,101 @@ def import_flux_site_data(flux_data_path, site_ID, timedelta):
         return fluxnet_sel_sub
 
     elif timedelta == "HH":
-        raise ValueError("Half-hourly data parsing incomplete, refer to utils/functions.py")
-        #TODO: Fix this so that the formatting works similar to DD but then need to pass function
-        """
-        fluxnet_sel_dates = fluxnet_sel.loc[:, ["TIMESTAMP_START", "TIMESTAMP_END"]].copy()
-        fluxnet_sel_dates["TIMESTAMP_START"] = pd.to_datetime(
-            fluxnet_sel_dates["TIMESTAMP_START"], format="%Y%m%d%H%M"
-        )
-        fluxnet_sel_dates["TIMESTAMP_END"] = pd.to_datetime(
-            fluxnet_sel_dates["TIMESTAMP_END"], format="%Y%m%d%H%M"
+        if site_lat is None or site_lon is None:
+            raise ValueError("Site lat/lon required to convert half-hourly data to UTC")
+        utc_offset = site_utc_offset(float(np.squeeze(site_lat)), float(np.squeeze(site_lon)))
+        value_cols = [col for col in FLUX_HH_COLUMNS if col != "TIMESTAMP_START"]
+
+        # Stream the file, reducing each chunk to per-window sums and counts
+        window_sums = []
+        reader = pd.read_csv(
+            site_file, usecols=list(FLUX_HH_COLUMNS), dtype=FLUX_HH_COLUMNS,
+            na_values=[-9999], chunksize=chunksize,
         )
+        for chunk in reader:
+            # Local standard time to UTC as one array operation
+            utc_time = pd.to_datetime(chunk["TIMESTAMP_START"], format="%Y%m%d%H%M") - utc_offset
+            window = utc_time.dt.floor(FLUX_HH_WINDOW)
+
+            values = chunk[value_cols]
+            # QC 0 (measured) and 1 (good gapfill) count as good, as in the DD QC fraction
+            values = values.assign(NEE_VUT_REF_QC=(chunk["NEE_VUT_REF_QC"] <= 1).astype(np.float64))
+            counts = values.notna().add_suffix("_count")
+            window_sums.append(
+                pd.concat([values, counts], axis=1).groupby(window.values).sum()
+            )
+
+        # Windows split across chunks are combined here
+        sums = pd.concat(window_sums).groupby(level=0).sum()
+        counts = sums[[col + "_count" for col in value_cols]].set_axis(value_cols, axis=1)
+        fluxnet_sel_sub = sums[value_cols] / counts.replace(0, np.nan)
+        # QC: fraction of good half-hours in the window (missing count as bad)
+        n_steps = pd.Timedelta(FLUX_HH_WINDOW) / pd.Timedelta("30min")
+        fluxnet_sel_sub["NEE_VUT_REF_QC"] = sums["NEE_VUT_REF_QC"] / n_steps
+        fluxnet_sel_sub.index.name = "TIMESTAMP"
+        return fluxnet_sel_sub
 
-        # Convert time to UTC
-        fluxnet_sel_dates = local_std_to_utc_std(
-            fluxnet_sel_dates, "TIMESTAMP_START", site_lat, site_lon
-        )
-        fluxnet_sel_dates = fluxnet_sel_dates.set_index("utc_time")
-        """
     else:
         raise ValueError(f"Timedelta {timedelta} invalid")
 
 
-def convert_flux_to_micasa_units(df_in, column, new_column):
-    """ Convert Flux daily data units (gC m-2 d-1) to MiCASA (kgC m-2 s-1)
+def _apply_column_rule(df, column, rule, qc=None):
+    """ Apply one utils.cleaning rule in place to a single DataFrame column """
+    values = df[[column]].to_numpy(dtype=np.float64)[None]
+    apply_rule({**rule, "columns": [column]}, values, qc or {}, {column: 0})
+    df[column] = values[0, :, 0]
+    return df
+
+
+def convert_flux_to_micasa_units(df_in, column, new_column, timedelta="DD"):
+    """ Convert Flux data units to MiCASA (kgC m-2 s-1)
+
+    Daily (DD) data are in gC m-2 d-1, half-hourly (HH) data in umolCO2 m-2 s-1
+    (factors in utils.cleaning.UNIT_FACTORS).
+
     Args:
         df_in (pd.Dataframe): The input DataFrame.
         column (str): The column name to be converted.
         new_column (str): The new name for the converted column.
+        timedelta (str): measurement frequency (HH or DD)
 
     Returns:
         pd.Dataframe: The DataFrame with an added column of converted values.
 
     """
     df = df_in.copy()
-    df[new_column] = df[column] * 1e-3 / 86400
-
+    df[new_column] = df[column] * UNIT_FACTORS[timedelta]
     return df
 
 
-def replace_outliers_with_nan(df, column):
+def replace_outliers_with_nan(df, column, iqr_factor=1.5):
     """Replace outliers (1.5 IQR above/below) in a DataFrame column with NaN.
 
+    Single-column form of the utils.cleaning "iqr" rule.
+
     Args:
         df (pd.DataFrame): The DataFrame.
         column (str): The column name to check for outliers.
+        iqr_factor (float): Number of IQRs beyond the quartiles to keep.
 
     Returns:
         pd.DataFrame: The DataFrame with outliers replaced by NaN.
     """
-    Q1 = df[column].quantile(0.25)
-    Q3 = df[column].quantile(0.75)
-    IQR = Q3 - Q1
+    return _apply_column_rule(df, column, {"rule": "iqr", "factor": iqr_factor})
 
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-
-    df[column] = df[column].mask(
-        (df[column] < lower_bound) | (df[column] > upper_bound), np.nan
-    )
-    return df
-
-def clean_flux_datasets(df, column, QC_column):
+def clean_flux_datasets(df, column, QC_column, qc_min=1):
     """ Set values to nan where FluxNet QC < 1
 
+    Single-column form of the utils.cleaning "qc" rule.
+
     Args:
         df (pd.DataFrame): The DataFrame.
         column (str): The column name to clean.
         QC_column (str): The column name to obtain QC values
+        qc_min (float): Minimum QC value to keep.
 
     Returns:
         pd.DataFrame: The DataFrame with poor QC readings as nan.
     """
-    df[column] = df[column].mask(df[QC_column] < 1, np.nan)
-
-    return df
+    qc = {QC_column: df[QC_column].to_numpy(dtype=np.float64)[None]}
+    return _apply_column_rule(df, column, {"rule": "qc", "qc_column": QC_column, "min": qc_min}, qc)
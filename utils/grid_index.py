@@ -0,0 +1,196 @@
+# Precomputed site -> grid cell index of a model grid (MiCASA, MERRA-2, ...)
+#
+# For every site the index holds the nearest cell and the k x k neighbourhood
+# around it as integer (lat, lon) indices, with the distance of each cell to
+# the tower and its area weight. Extraction is then plain integer indexing
+# (isel / NumPy fancy indexing) and a footprint mean (e.g. 3 x 3 around the
+# tower) comes from the same read as the nearest cell. Indexes are cached on
+# disk as .npz files keyed by the grid coordinates, the sites and k, so each
+# grid is only indexed once.
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import xarray as xr
+
+EARTH_RADIUS_KM = 6371.0
+
+# Arrays stored for every index (one row per site)
+INDEX_ARRAYS = ["site_IDs", "ilat", "ilon", "nbr_ilat", "nbr_ilon", "center", "distance_km", "area_weight"]
+
+
+def _circular_diff(a, b):
+    """ Absolute longitude difference (degrees), wrapping at the date line """
+    return np.abs((a - b + 180.0) % 360.0 - 180.0)
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def is_global_lon(lon):
+    """ True if a regular longitude axis wraps around the globe """
+    step = np.abs(np.diff(lon)).mean() if len(lon) > 1 else 360.0
+    return abs(len(lon) * step - 360.0) < step / 2
+
+
+def grid_key(grid_lat, grid_lon, site_IDs, site_lats, site_lons, k):
+    """ Cache key of an index: hash of the grid coordinates, the sites and k """
+    digest = hashlib.sha256()
+    for array in (grid_lat, grid_lon, site_lats, site_lons):
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    digest.update("\n".join(map(str, site_IDs)).encode())
+    digest.update(str(k).encode())
+    return digest.hexdigest()[:16]
+
+
+class SiteGridIndex:
+    """ Nearest cell and k x k neighbourhood of each site on one grid
+
+        index = load_site_grid_index(cache_dir, "micasa", ds["lat"], ds["lon"], site_IDs, lats, lons, k=3)
+        nearest = index.nearest(ds)            # dims (..., points)
+        footprint = index.footprint_mean(ds)   # area-weighted 3 x 3 mean
+
+    Attributes:
+        site_IDs (np.ndarray): site IDs, one per point
+        ilat, ilon (np.ndarray): (site,) nearest cell indices
+        nbr_ilat, nbr_ilon (np.ndarray): (site, k*k) neighbourhood cell indices,
+            shifted inside the grid at its edges (longitudes wrap on global grids)
+        center (np.ndarray): (site,) position of the nearest cell in the neighbourhood
+        distance_km (np.ndarray): (site, k*k) great-circle distance of each
+            cell center to the site
+        area_weight (np.ndarray): (site, k*k) cell area weights (cos(lat)),
+            normalized to sum to 1 per site
+    """
+
+    def __init__(self, site_IDs, ilat, ilon, nbr_ilat, nbr_ilon, center, distance_km, area_weight):
+        self.site_IDs = np.asarray(site_IDs).astype(str)
+        self.ilat, self.ilon = np.asarray(ilat), np.asarray(ilon)
+        self.nbr_ilat, self.nbr_ilon = np.asarray(nbr_ilat), np.asarray(nbr_ilon)
+        self.center = np.asarray(center)
+        self.distance_km = np.asarray(distance_km)
+        self.area_weight = np.asarray(area_weight)
+
+    @property
+    def k(self):
+        return int(round(np.sqrt(self.nbr_ilat.shape[1])))
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in INDEX_ARRAYS}
+
+    def nearest(self, ds):
+        """ Nearest cell of each site, on a "points" dimension labelled by site ID """
+        out = ds.isel(
+            lat=xr.DataArray(self.ilat, dims="points"),
+            lon=xr.DataArray(self.ilon, dims="points"),
+        )
+        return out.drop_vars(["lat", "lon"], errors="ignore").assign_coords(points=self.site_IDs)
+
+    def neighbourhood(self, ds):
+        """ k x k cells of each site, on ("points", "cell") dimensions """
+        out = ds.isel(
+            lat=xr.DataArray(self.nbr_ilat, dims=("points", "cell")),
+            lon=xr.DataArray(self.nbr_ilon, dims=("points", "cell")),
+        )
+        return out.drop_vars(["lat", "lon"], errors="ignore").assign_coords(points=self.site_IDs)
+
+    def footprint_mean(self, neighbourhood):
+        """ Area-weighted mean over the cells of a neighbourhood, skipping missing cells
+
+        Args:
+            neighbourhood (xr.Dataset or xr.DataArray): output of neighbourhood()
+
+        Returns:
+            same type, without the "cell" dimension
+        """
+        weights = xr.DataArray(self.area_weight, dims=("points", "cell"))
+        valid = neighbourhood.notnull()
+        total = (neighbourhood.fillna(0) * weights).sum("cell")
+        return total / (valid * weights).sum("cell").where(lambda w: w > 0)
+
+    def center_cell(self, neighbourhood):
+        """ Nearest cell of each site, taken from an already read neighbourhood """
+        return neighbourhood.isel(cell=xr.DataArray(self.center, dims="points"))
+
+
+def build_site_grid_index(grid_lat, grid_lon, site_IDs, site_lats, site_lons, k=3):
+    """ Index the nearest cell and k x k neighbourhood of every site on a grid
+
+    Args:
+        grid_lat, grid_lon (array-like): 1-D cell center coordinates (degrees)
+        site_IDs (list of str): site IDs
+        site_lats, site_lons (array-like): site locations (degrees)
+        k (int): neighbourhood width in cells (odd, 1 for the nearest cell only)
+
+    Returns:
+        SiteGridIndex
+    """
+    if k < 1 or k % 2 == 0:
+        raise ValueError(f"Neighbourhood width {k} must be a positive odd number")
+    grid_lat = np.asarray(grid_lat, dtype=np.float64)
+    grid_lon = np.asarray(grid_lon, dtype=np.float64)
+    site_lats = np.asarray(site_lats, dtype=np.float64)
+    site_lons = np.asarray(site_lons, dtype=np.float64)
+    wrap = is_global_lon(grid_lon)
+
+    # (site x cell) distances along each axis, small for 1-D axes
+    ilat = np.abs(site_lats[:, None] - grid_lat[None, :]).argmin(axis=1)
+    lon_diff = _circular_diff(site_lons[:, None], grid_lon[None, :]) if wrap else np.abs(site_lons[:, None] - grid_lon[None, :])
+    ilon = lon_diff.argmin(axis=1)
+
+    # Neighbourhood offsets, shifted to stay inside the grid (lat, and lon unless global)
+    half = k // 2
+    offsets = np.arange(-half, half + 1)
+    lat0 = np.clip(ilat - half, 0, max(len(grid_lat) - k, 0))
+    nbr_ilat = np.clip(lat0[:, None] + offsets + half, 0, len(grid_lat) - 1)
+    if wrap:
+        nbr_ilon = (ilon[:, None] + offsets) % len(grid_lon)
+    else:
+        lon0 = np.clip(ilon - half, 0, max(len(grid_lon) - k, 0))
+        nbr_ilon = np.clip(lon0[:, None] + offsets + half, 0, len(grid_lon) - 1)
+
+    # k x k cells, row-major (lat, lon)
+    nbr_ilat = np.repeat(nbr_ilat, k, axis=1)
+    nbr_ilon = np.tile(nbr_ilon, (1, k))
+    center = np.argmax((nbr_ilat == ilat[:, None]) & (nbr_ilon == ilon[:, None]), axis=1)
+
+    distance_km = _haversine_km(site_lats[:, None], site_lons[:, None], grid_lat[nbr_ilat], grid_lon[nbr_ilon])
+    area = np.cos(np.radians(grid_lat[nbr_ilat]))
+    area_weight = area / area.sum(axis=1, keepdims=True)
+
+    return SiteGridIndex(site_IDs, ilat, ilon, nbr_ilat, nbr_ilon, center, distance_km, area_weight)
+
+
+def load_site_grid_index(cache_dir, grid_name, grid_lat, grid_lon, site_IDs, site_lats, site_lons, k=3):
+    """ Site grid index from the on-disk cache, built and cached if missing
+
+    Args:
+        cache_dir (Path object, optional): cache directory (no caching if None)
+        grid_name (str): grid label used in the file name (e.g. micasa, merra2)
+        grid_lat, grid_lon, site_IDs, site_lats, site_lons, k: see build_site_grid_index
+
+    Returns:
+        SiteGridIndex
+    """
+    site_IDs = [str(site_ID) for site_ID in site_IDs]
+    if cache_dir is None:
+        return build_site_grid_index(grid_lat, grid_lon, site_IDs, site_lats, site_lons, k)
+
+    key = grid_key(grid_lat, grid_lon, site_IDs, site_lats, site_lons, k)
+    index_path = Path(cache_dir) / f"{grid_name}_k{k}_{key}.npz"
+    if index_path.exists():
+        with np.load(index_path) as arrays:
+            return SiteGridIndex(**{name: arrays[name] for name in INDEX_ARRAYS})
+
+    index = build_site_grid_index(grid_lat, grid_lon, site_IDs, site_lats, site_lons, k)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temporary file first so concurrent workers never read a partial index
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{index_path.name}.", suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **index.arrays())
+    os.replace(tmp_path, index_path)
+    return index
@@ -0,0 +1,213 @@
+# Stage-level timing and I/O instrumentation
+#
+# Disabled unless a log is configured (configure() or the FLUXNET_PROFILE_LOG
+# environment variable), in which case every instrumented stage appends one
+# JSON line: stage, site, wall/CPU time, bytes read, files opened and any
+# counters (e.g. glob matches). Settings are passed through the environment so
+# pool workers, dask workers and subprocesses log to the same file.
+#
+#   with stage("extract", site=site_ID):
+#       ...
+#       count("micasa_files", len(path_list))
+#
+#   @instrumented("load_flux")   # site taken from the site_ID argument
+#   def import_flux_site_data(flux_data_path, site_ID, ...):
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import inspect
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+PROFILE_LOG_ENV = "FLUXNET_PROFILE_LOG"
+CPROFILE_DIR_ENV = "FLUXNET_CPROFILE_DIR"
+
+# Records of the stages currently running in this context (innermost last)
+_active = contextvars.ContextVar("active_stages", default=())
+_files_opened = [0]
+_audit_installed = [False]
+
+
+def configure(log_path=None, cprofile_dir=None):
+    """ Enable instrumentation for this process and its children
+
+    Args:
+        log_path (Path object): JSONL log appended to by every process
+        cprofile_dir (Path object, optional): also dump a cProfile (pstats)
+            file per outermost stage run, viewable with snakeviz or pstats
+    """
+    if log_path is not None:
+        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+        os.environ[PROFILE_LOG_ENV] = str(Path(log_path).resolve())
+    if cprofile_dir is not None:
+        Path(cprofile_dir).mkdir(parents=True, exist_ok=True)
+        os.environ[CPROFILE_DIR_ENV] = str(Path(cprofile_dir).resolve())
+
+
+def add_profiling_arguments(parser):
+    """ Add the --profile-log/--cprofile-dir options shared by the drivers """
+    parser.add_argument(
+        "--profile-log", type=Path, default=None,
+        help="Append per-site/per-stage timings and I/O to this JSONL log and print a summary",
+    )
+    parser.add_argument(
+        "--cprofile-dir", type=Path, default=None,
+        help="Also dump a cProfile file per stage run to this directory",
+    )
+
+
+def enabled():
+    return PROFILE_LOG_ENV in os.environ
+
+
+def _count_opens(event, args):
+    if event == "open":
+        _files_opened[0] += 1
+
+
+def _read_bytes():
+    """ Bytes read by this process, including reads from C libraries (Linux only) """
+    try:
+        with open("/proc/self/io") as f:
+            return int(next(line for line in f if line.startswith("rchar:")).split()[1])
+    except OSError:
+        return 0
+
+
+def count(name, n=1):
+    """ Add n to a counter of the innermost running stage (no-op when disabled) """
+    records = _active.get()
+    if records:
+        counters = records[-1]["counters"]
+        counters[name] = counters.get(name, 0) + n
+
+
+def write_record(record):
+    """ Append one record to the JSONL log (single write, safe across processes) """
+    line = json.dumps(record, default=str) + "\n"
+    with open(os.environ[PROFILE_LOG_ENV], "a") as f:
+        f.write(line)
+
+
+@contextlib.contextmanager
+def stage(name, site=None, **fields):
+    """ Time a pipeline stage and log it (no-op when instrumentation is disabled)
+
+    Args:
+        name (str): stage name
+        site (str, optional): FluxNet Site ID the stage runs for
+        **fields: extra JSON-serializable fields for the record
+    """
+    if not enabled():
+        yield
+        return
+
+    if not _audit_installed[0]:
+        # Audit hooks cannot be removed, so one hook counts for all stages
+        sys.addaudithook(_count_opens)
+        _audit_installed[0] = True
+
+    record = {
+        "stage": name, "site": site, **fields,
+        "pid": os.getpid(), "host": socket.gethostname(), "counters": {},
+    }
+    # Only the outermost stage is profiled (profilers cannot be nested)
+    profiler = None
+    cprofile_dir = os.environ.get(CPROFILE_DIR_ENV)
+    if cprofile_dir and not _active.get():
+        profiler = cProfile.Profile()
+    token = _active.set(_active.get() + (record,))
+
+    bytes_before = _read_bytes()
+    opened_before = _files_opened[0]
+    start, cpu_start = time.time(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = repr(e)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            label = "-".join(str(part) for part in (name, site, os.getpid()) if part is not None)
+            profile_path = Path(cprofile_dir) / f"{label}-{int(start)}.prof"
+            profiler.dump_stats(profile_path)
+            record["cprofile"] = str(profile_path)
+        _active.reset(token)
+        record.update({
+            "start": start,
+            "wall_time_s": round(time.time() - start, 6),
+            "cpu_time_s": round(time.process_time() - cpu_start, 6),
+            "files_opened": _files_opened[0] - opened_before,
+            "read_bytes": _read_bytes() - bytes_before,
+        })
+        write_record(record)
+
+
+def instrumented(name, site_arg="site_ID"):
+    """ Decorator running a function as a stage, labelled by its site_arg argument """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            site = signature.bind_partial(*args, **kwargs).arguments.get(site_arg)
+            with stage(name, site=site):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_log(log_path):
+    """ Read a JSONL instrumentation log into a DataFrame (counters as columns) """
+    import pandas as pd
+
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    df = pd.DataFrame(records)
+    if "counters" in df:
+        counters = pd.json_normalize(df.pop("counters").tolist()).add_prefix("count_")
+        df = pd.concat([df, counters], axis=1)
+    return df
+
+
+def summary_report(log_path, top=5):
+    """ Per-stage totals and the slowest sites of an instrumentation log
+
+    Args:
+        log_path (Path object): JSONL log
+        top (int): number of slowest sites listed per stage
+
+    Returns:
+        str: printable report
+    """
+    df = read_log(log_path)
+    numeric = ["wall_time_s", "cpu_time_s", "read_bytes", "files_opened"]
+    numeric += [col for col in df.columns if col.startswith("count_")]
+    totals = df.groupby("stage").agg(
+        runs=("wall_time_s", "size"),
+        errors=("status", lambda status: int((status == "error").sum())),
+        **{f"total_{col}": (col, "sum") for col in numeric},
+        max_wall_time_s=("wall_time_s", "max"),
+    ).sort_values("total_wall_time_s", ascending=False)
+
+    lines = ["Stage totals:", totals.to_string(), ""]
+    per_site = df.dropna(subset=["site"])
+    for stage_name, group in per_site.groupby("stage"):
+        slowest = group.groupby("site")["wall_time_s"].sum().nlargest(top)
+        lines.append(f"Slowest sites for {stage_name}: " + ", ".join(
+            f"{site} ({seconds:.2f} s)" for site, seconds in slowest.items()
+        ))
+    return "\n".join(lines)
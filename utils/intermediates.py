@@ -0,0 +1,107 @@
+# Read/write the preprocessed MiCASA intermediates as a partitioned Parquet dataset
+#
+# Layout: {dataset_path}/site={Site ID}/variable={var}/part-0.parquet
+# Each file holds a "time" (timestamp) and "value" (float32) column, with the
+# variable units stored in the Parquet schema metadata.
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+
+
+def intermediates_path(preprocessed_path, timedelta):
+    """ Path to the intermediates dataset for a timedelta (HH or DD) """
+    return preprocessed_path / f"micasa_{timedelta}"
+
+
+def site_intermediates_exist(dataset_path, site_ID):
+    """ Check if any intermediates have been written for a site """
+    return os.path.isdir(os.path.join(dataset_path, f"site={site_ID}"))
+
+
+def write_site_intermediates(dataset_path, site_ID, df):
+    """ Write one site's extracted variables to the intermediates dataset
+
+    Args:
+        dataset_path (Path object): root of the partitioned Parquet dataset
+        site_ID (str): FluxNet Site ID
+        df (pd.DataFrame): one column per variable, DatetimeIndex, with
+            units in df.attrs["units"] ({variable: units})
+    """
+    units = df.attrs.get("units", {})
+    time = pa.array(df.index.values.astype("datetime64[ns]"))
+
+    for var in df.columns:
+        table = pa.table({
+            "time": time,
+            "value": pa.array(df[var].to_numpy(dtype=np.float32)),
+        })
+        table = table.replace_schema_metadata({"units": units.get(var, "")})
+
+        part_dir = os.path.join(dataset_path, f"site={site_ID}", f"variable={var}")
+        os.makedirs(part_dir, exist_ok=True)
+        # Write to a temporary name first so readers never see partial files
+        # (hidden name, so dataset discovery skips leftovers from killed jobs)
+        tmp_path = os.path.join(part_dir, ".part-0.parquet.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(part_dir, "part-0.parquet"))
+
+
+def read_intermediates(dataset_path, sites=None, variables=None, wide=False):
+    """ Read intermediates for selected sites/variables from the Parquet dataset
+
+    Only the partitions (files) for the requested sites and variables are read.
+
+    Args:
+        dataset_path (Path object): root of the partitioned Parquet dataset
+        sites (list of str, optional): FluxNet Site IDs (default all)
+        variables (list of str, optional): variables to read (default all)
+        wide (bool): pivot to one "MiCASA {var} ({units})" column per variable,
+            indexed by (site, time), matching the old per-site CSV columns
+
+    Returns:
+        pd.DataFrame: long (site, variable, time, value) table, or wide table,
+            with units in df.attrs["units"]
+    """
+    dataset = pads.dataset(dataset_path, format="parquet", partitioning="hive")
+
+    filt = None
+    if sites is not None:
+        filt = pc.field("site").isin(list(sites))
+    if variables is not None:
+        var_filt = pc.field("variable").isin(list(variables))
+        filt = var_filt if filt is None else filt & var_filt
+
+    frames = []
+    units = {}
+    for fragment in dataset.get_fragments(filter=filt):
+        keys = pads.get_partition_keys(fragment.partition_expression)
+        table = fragment.to_table(columns=["time", "value"])
+        units[keys["variable"]] = fragment.physical_schema.metadata[b"units"].decode()
+
+        df = table.to_pandas()
+        df.insert(0, "variable", keys["variable"])
+        df.insert(0, "site", keys["site"])
+        frames.append(df)
+
+    if frames:
+        df_out = pd.concat(frames, ignore_index=True)
+    else:
+        df_out = pd.DataFrame({
+            "site": pd.Series(dtype=str),
+            "variable": pd.Series(dtype=str),
+            "time": pd.Series(dtype="datetime64[ns]"),
+            "value": pd.Series(dtype=np.float32),
+        })
+    df_out["site"] = df_out["site"].astype("category")
+    df_out["variable"] = df_out["variable"].astype("category")
+
+    if wide:
+        df_out = df_out.pivot(index=["site", "time"], columns="variable", values="value")
+        df_out.columns = [f"MiCASA {var} ({units[var]})" for var in df_out.columns]
+    df_out.attrs["units"] = units
+    return df_out
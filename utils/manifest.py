@@ -0,0 +1,180 @@
+# Run manifest: what each pipeline stage last produced for each site, and from what
+#
+# For every (site, stage) the manifest stores a key hashing the stage's input
+# files, parameters and code version, plus its outputs. A stage is up to date
+# when the recomputed key matches and all recorded outputs still exist, which
+# lets the drivers recompute only what changed (--changed-only).
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Source files defining each stage's results (their contents are the code version)
+STAGE_CODE = {
+    "extract": ["preprocessing/tasks.py", "utils/micasa.py", "utils/grid_index.py", "utils/intermediates.py"],
+    "clean": ["utils/functions.py", "utils/flux_cache.py", "utils/cleaning.py"],
+    "RMSE": ["analysis/RMSE_calc.py", "analysis/metrics.py", "analysis/bootstrap.py"],
+    "plot": ["plotting/site_plots.py"],
+}
+
+# Stages whose results each stage consumes; their code is part of its code version
+STAGE_UPSTREAM = {
+    "extract": [],
+    "clean": [],
+    "RMSE": ["extract", "clean"],
+    "plot": ["extract", "clean"],
+}
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    site TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    inputs TEXT,
+    params TEXT,
+    code_version TEXT,
+    outputs TEXT,
+    completed REAL,
+    PRIMARY KEY (site, stage)
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT
+);
+"""
+
+
+@contextlib.contextmanager
+def open_manifest(manifest_path):
+    """ Open (creating if needed) the SQLite run manifest """
+    con = sqlite3.connect(manifest_path, timeout=60)
+    try:
+        con.executescript(MANIFEST_SCHEMA)
+        yield con
+        con.commit()
+    finally:
+        con.close()
+
+
+def hash_file(con, path):
+    """ SHA-256 of a file's contents, re-hashed only if its size or mtime changed """
+    path = str(path)
+    st = os.stat(path)
+    row = con.execute("SELECT size, mtime, sha256 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+    if row and row[0] == st.st_size and row[1] == st.st_mtime:
+        return row[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    con.execute(
+        "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+        (path, st.st_size, st.st_mtime, digest.hexdigest()),
+    )
+    return digest.hexdigest()
+
+
+def file_fingerprint(path):
+    """ Cheap fingerprint (path, size, mtime) for large archives not worth hashing """
+    st = os.stat(path)
+    return f"{path}:{st.st_size}:{st.st_mtime}"
+
+
+def stage_code_files(stage):
+    """ Source files of a stage and of all the stages upstream of it """
+    files = []
+    for upstream in STAGE_UPSTREAM.get(stage, []):
+        files += [path for path in stage_code_files(upstream) if path not in files]
+    return files + [path for path in STAGE_CODE[stage] if path not in files]
+
+
+def code_version(stage):
+    """ Hash of the source files that define a stage and its upstream stages """
+    digest = hashlib.sha256()
+    for rel_path in stage_code_files(stage):
+        with open(REPO_ROOT / rel_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def stage_key(con, stage, inputs, params, fingerprints=()):
+    """ Key identifying a stage run from its inputs, parameters and code
+
+    Args:
+        con (sqlite3.Connection): open manifest
+        stage (str): stage name (see STAGE_CODE)
+        inputs (list of Path objects): files hashed by content
+        params (dict): JSON-serializable stage parameters
+        fingerprints (list of str): extra input identifiers (e.g. file_fingerprint)
+
+    Returns:
+        tuple: (key, record) where record holds the inputs/params/code version
+    """
+    record = {
+        "inputs": {str(path): hash_file(con, path) for path in inputs},
+        "fingerprints": hashlib.sha256("\n".join(fingerprints).encode()).hexdigest(),
+        "params": params,
+        "code_version": code_version(stage),
+    }
+    key = hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+    return key, record
+
+
+def outputs_exist(outputs):
+    return all(os.path.exists(path) for path in outputs)
+
+
+def is_up_to_date(con, site, stage, key):
+    """ True if the stage last completed with the same key and its outputs exist """
+    row = con.execute(
+        "SELECT key, outputs FROM stages WHERE site = ? AND stage = ?", (site, stage)
+    ).fetchone()
+    return row is not None and row[0] == key and outputs_exist(json.loads(row[1]))
+
+
+def record_stage(con, site, stage, key, record, outputs):
+    """ Record a completed stage (call only after its outputs are fully written) """
+    con.execute(
+        "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            site, stage, key,
+            json.dumps(record["inputs"]),
+            json.dumps(record["params"], default=str),
+            record["code_version"],
+            json.dumps([str(path) for path in outputs]),
+            time.time(),
+        ),
+    )
+    con.commit()
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """ Write to a hidden temporary file, renamed over path only on success
+
+    Yields the temporary path, so any writer (to_csv, savefig, ...) can be used:
+
+        with atomic_write("out.csv") as tmp_path:
+            df.to_csv(tmp_path)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=path.suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,264 @@
+# Build MERRA-2 virtual stores and sample them at FLUXNET sites
+#
+# The MERRA-2 virtual stores (see data/MERRA_data/make_virtual_dataset.py) are
+# opened lazily; only the grid cells nearest to the sites are selected before
+# anything is computed, so adding a covariate never loads global fields.
+
+import concurrent.futures
+import glob
+import json
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from utils.grid_index import load_site_grid_index
+from utils.site_metadata import parse_years
+
+# Missing value of the MERRA-2 collections, declared as _FillValue in the stores
+MERRA2_FILL_VALUE = 999999986991104
+
+# Collection (freq1, freq2, group) holding each supported variable, e.g. tavgM_2d_slv
+MERRA2_COLLECTIONS = {
+    "T2M": ("tavg", "M", "slv"),
+    "PRECTOTCORR": ("tavg", "M", "flx"),
+}
+
+# Dimensions kept alongside the selected variables
+MERRA2_COORDS = ("time", "lat", "lon")
+
+
+def file_references(path, checkpoint_dir):
+    """ Kerchunk references of one MERRA-2 file, checkpointed to checkpoint_dir
+
+    Args:
+        path (Path object): MERRA-2 netCDF4 (HDF5) file
+        checkpoint_dir (Path object): directory of the per-file references
+
+    Returns:
+        Path object: per-file reference JSON (reused if already built)
+    """
+    import fsspec
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    ref_path = Path(checkpoint_dir) / f"{Path(path).name}.json"
+    if ref_path.exists():
+        return ref_path
+
+    with fsspec.open(str(path), "rb") as f:
+        refs = SingleHdf5ToZarr(f, str(path), inline_threshold=300).translate()
+
+    # Written atomically, so an interrupted build never leaves a partial checkpoint
+    fd, tmp_path = tempfile.mkstemp(dir=checkpoint_dir, prefix=f".{ref_path.name}.")
+    with os.fdopen(fd, "w") as f:
+        json.dump(refs, f)
+    os.replace(tmp_path, ref_path)
+    return ref_path
+
+
+def build_file_references(path_list, checkpoint_dir, n_workers=None):
+    """ Build the per-file references in parallel, one task per file
+
+    Files with a reference in checkpoint_dir are skipped, so an interrupted
+    build resumes where it stopped.
+
+    Args:
+        path_list (list of Path objects): MERRA-2 files
+        checkpoint_dir (Path object): directory of the per-file references
+        n_workers (int, optional): number of worker processes (default: all cores)
+
+    Returns:
+        list of Path objects: per-file references, in the order of path_list
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    done = {path: Path(checkpoint_dir) / f"{Path(path).name}.json" for path in path_list}
+    todo = [path for path, ref_path in done.items() if not ref_path.exists()]
+    print(f"{len(path_list) - len(todo)} of {len(path_list)} file references already built")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(file_references, path, checkpoint_dir): path for path in todo}
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            future.result()
+            if i % 100 == 0 or i == len(todo):
+                print(f"[{i}/{len(todo)}] file references built")
+
+    return [done[path] for path in path_list]
+
+
+def select_reference_vars(refs, var_list):
+    """ Keep only the keys of var_list and the coordinates in a reference set """
+    keep = set(var_list) | set(MERRA2_COORDS)
+    refs = dict(refs)
+    refs["refs"] = {
+        key: value for key, value in refs["refs"].items()
+        if "/" not in key or key.split("/")[0] in keep
+    }
+    return refs
+
+
+def declare_fill_value(refs, var_list, fill_value=MERRA2_FILL_VALUE):
+    """ Declare fill_value as the _FillValue of each variable in a reference set """
+    for var in var_list:
+        zarray = refs["refs"][f"{var}/.zarray"]
+        zarray = json.loads(zarray) if isinstance(zarray, str) else zarray
+        zarray["fill_value"] = fill_value
+        refs["refs"][f"{var}/.zarray"] = json.dumps(zarray)
+
+        zattrs = refs["refs"].get(f"{var}/.zattrs", "{}")
+        zattrs = json.loads(zattrs) if isinstance(zattrs, str) else zattrs
+        zattrs.pop("_FillValue", None)
+        zattrs["missing_value"] = fill_value
+        refs["refs"][f"{var}/.zattrs"] = json.dumps(zattrs)
+    return refs
+
+
+def combine_merra2_references(ref_lists):
+    """ Combine per-file references into one store over all collections
+
+    Args:
+        ref_lists (dict): {tuple of variables: list of per-file reference
+            paths} with one entry per collection
+
+    Returns:
+        dict: kerchunk references concatenated along time and merged across
+            collections, with the MERRA-2 fill value declared
+    """
+    from kerchunk.combine import MultiZarrToZarr, merge_vars
+
+    combined = []
+    for var_list, ref_paths in ref_lists.items():
+        refs_list = []
+        for ref_path in ref_paths:
+            with open(ref_path) as f:
+                refs_list.append(select_reference_vars(json.load(f), var_list))
+        mzz = MultiZarrToZarr(
+            refs_list,
+            concat_dims=["time"],
+            identical_dims=["lat", "lon"],
+            coo_map={"time": "cf:time"},  # each file has its own time units
+        )
+        combined.append(declare_fill_value(mzz.translate(), var_list))
+
+    return combined[0] if len(combined) == 1 else merge_vars(combined)
+
+
+def write_reference_store(refs, store_path):
+    """ Write references to a single Parquet reference store (replaced atomically) """
+    import shutil
+    from kerchunk.df import refs_to_dataframe
+
+    store_path = Path(store_path)
+    tmp_path = store_path.with_name(f".{store_path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    refs_to_dataframe(refs, str(tmp_path))
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def open_reference_store(ref_path):
+    """ Open a kerchunk reference (JSON or Parquet) or a Zarr store lazily """
+    ref_path = str(ref_path)
+    if ref_path.endswith((".json", ".parquet")):
+        return xr.open_dataset(f"reference::{ref_path}", engine="zarr", consolidated=False, chunks={})
+    return xr.open_zarr(ref_path, chunks={})
+
+
+def open_merra2_store(store_path, var_list=None):
+    """ Open a MERRA-2 store lazily, with fill values masked
+
+    Args:
+        store_path (Path object): reference file/Zarr store, or a directory of
+            vstore*.parquet references (older stores, concatenated along time)
+        var_list (list of str, optional): variables to keep
+
+    Returns:
+        xr.Dataset: lazy (dask-backed) dataset
+    """
+    parts = sorted(glob.glob(os.path.join(store_path, "vstore*.parquet"))) if os.path.isdir(store_path) else []
+    if parts:
+        # Older stores do not declare the fill value
+        ds = xr.concat([open_reference_store(part) for part in parts], dim="time")
+        ds = ds.where(ds != MERRA2_FILL_VALUE)
+    else:
+        ds = open_reference_store(store_path)
+    if var_list is not None:
+        ds = ds[list(var_list)]
+    return ds
+
+
+def nearest_site_cells(ds, lats, lons, index_cache=None):
+    """ Lazily select the grid cells nearest to each site
+
+    Sites sharing a cell are only read once.
+
+    Args:
+        ds (xr.Dataset): MERRA-2 dataset with lat/lon dimensions
+        lats, lons (array-like): site locations
+        index_cache (Path object, optional): site grid index cache directory
+            (see utils.grid_index)
+
+    Returns:
+        tuple: (cells, inverse) where cells is ds indexed on a "cell" dimension
+            and cells.isel(cell=inverse) gives one entry per site
+    """
+    index = load_site_grid_index(
+        index_cache, "merra2", ds["lat"].values, ds["lon"].values,
+        [str(i) for i in range(len(lats))], lats, lons, k=1,
+    )
+    ilat, ilon = index.ilat, index.ilon
+    unique, inverse = np.unique(np.stack([ilat, ilon], axis=1), axis=0, return_inverse=True)
+    cells = ds.isel(
+        lat=xr.DataArray(unique[:, 0], dims="cell"),
+        lon=xr.DataArray(unique[:, 1], dims="cell"),
+    )
+    return cells, inverse.ravel()
+
+
+def sample_merra2_sites(ds, site_df, var_list, years_column="Years of AmeriFlux FLUXNET Data", index_cache=None):
+    """ Per-site MERRA-2 climatologies at FLUXNET sites
+
+    For every variable, returns the mean of the annual means over the whole
+    record ("{var}_tot") and over the years the site has FLUXNET data
+    ("{var}_avg", NaN if the site has no listed years). Annual means are
+    computed once for the cells nearest the sites; the per-site year windows
+    are then applied as a single (year x site) mask.
+
+    Args:
+        ds (xr.Dataset): output of open_merra2_store (xr.merge several
+            collections to sample e.g. T2M and PRECTOTCORR together)
+        site_df (pd.DataFrame): site table from import_site_RMSE_data (lat, lon,
+            years_column), indexed by Site ID
+        var_list (list of str): MERRA-2 variables
+        years_column (str): column holding the comma-separated site years
+        index_cache (Path object, optional): site grid index cache directory
+
+    Returns:
+        pd.DataFrame: site_df with the climatology columns appended
+    """
+    var_list = [var_list] if isinstance(var_list, str) else list(var_list)
+    cells, inverse = nearest_site_cells(ds[var_list], site_df["lat"].values, site_df["lon"].values, index_cache)
+
+    # Only the selected cells are read, chunk by chunk
+    annual = cells.groupby("time.year").mean("time").compute()
+    years = annual["year"].values
+
+    # (year x site) mask of each site's years of FLUXNET data
+    # Already parsed in tables from utils.site_metadata
+    site_years = site_df["years"] if "years" in site_df else site_df[years_column].apply(parse_years)
+    mask = np.zeros((len(years), len(site_df)), dtype=bool)
+    for i, yrs in enumerate(site_years):
+        mask[:, i] = np.isin(years, yrs)
+    n_years = mask.sum(axis=0)
+
+    df_out = site_df.copy()
+    for var in var_list:
+        values = annual[var].transpose("year", "cell").values[:, inverse]
+        df_out[f"{var}_tot"] = np.nanmean(values, axis=0)
+        with np.errstate(invalid="ignore"):
+            sums = np.nansum(np.where(mask, values, 0.0), axis=0)
+            counts = np.sum(mask & ~np.isnan(values), axis=0)
+            df_out[f"{var}_avg"] = np.where((n_years > 0) & (counts > 0), sums / counts, np.nan)
+    return df_out
@@ -0,0 +1,215 @@
+# Functions for extracting MiCASA data at FLUXNET site locations
+
+import pandas as pd
+import xarray as xr
+
+from utils.grid_index import load_site_grid_index
+
+
+def site_points(index, ds, var_list, footprint=1):
+    """ Read the site cells of a dataset through a site grid index
+
+    Args:
+        index (SiteGridIndex): index of the dataset grid (see utils.grid_index)
+        ds (xr.Dataset): MiCASA dataset
+        var_list (list of str): MiCASA variables to extract
+        footprint (int): also add the area-weighted footprint x footprint mean
+            of each variable as "{var}_{footprint}x{footprint}" (read together
+            with the nearest cell, no extra I/O)
+
+    Returns:
+        xr.Dataset: var_list (and footprint means) with dims (time, points)
+    """
+    ds = ds[var_list]
+    if footprint == 1:
+        return index.nearest(ds).load()
+
+    ds_cells = index.neighbourhood(ds).load()
+    ds_out = index.center_cell(ds_cells).drop_vars("cell", errors="ignore")
+    ds_mean = index.footprint_mean(ds_cells)
+    for var in var_list:
+        ds_out[f"{var}_{footprint}x{footprint}"] = ds_mean[var].assign_attrs(ds[var].attrs)
+    return ds_out
+
+
+def micasa_grid_index(ds, site_IDs, site_lats, site_lons, footprint=1, cache_dir=None):
+    """ Site grid index of the MiCASA grid (cached in cache_dir, see utils.grid_index) """
+    return load_site_grid_index(
+        cache_dir, "micasa", ds["lat"].values, ds["lon"].values, site_IDs, site_lats, site_lons, k=footprint,
+    )
+
+
+def extract_micasa_points(path_list, site_IDs, site_lats, site_lons, var_list, footprint=1, index_cache=None):
+    """ Extract MiCASA variables at many sites, opening each file only once
+
+    Every file is opened a single time and all sites are read together by
+    integer indexing with a precomputed site grid index, instead of one
+    open_mfdataset and nearest-neighbour search per site.
+
+    Args:
+        path_list (list of Path objects): MiCASA files to read (any order)
+        site_IDs (list of str): FluxNet Site IDs, one per point
+        site_lats, site_lons (array-like): site latitudes/longitudes
+        var_list (list of str): MiCASA variables to extract
+        footprint (int): footprint width in cells, see site_points
+        index_cache (Path object, optional): site grid index cache directory
+
+    Returns:
+        xr.Dataset: var_list with dims (time, points), "points" labelled by site ID
+    """
+    index = None
+    ds_list = []
+    for path in path_list:
+        with xr.open_dataset(path) as ds:
+            # All files share the MiCASA grid
+            if index is None:
+                index = micasa_grid_index(ds, site_IDs, site_lats, site_lons, footprint, index_cache)
+            # Load the (small) point subset so the file can be closed
+            ds_list.append(site_points(index, ds, var_list, footprint))
+
+    return xr.concat(ds_list, dim="time").sortby("time")
+
+
+def extract_micasa_store_points(ds, site_IDs, site_lats, site_lons, var_list, dates=None,
+                                footprint=1, index_cache=None, years_per_chunk=None):
+    """ Extract MiCASA variables at many sites from a single (virtual/Zarr) store
+
+    Args:
+        ds (xr.Dataset): MiCASA store opened with open_micasa_store
+        site_IDs (list of str): FluxNet Site IDs, one per point
+        site_lats, site_lons (array-like): site latitudes/longitudes
+        var_list (list of str): MiCASA variables to extract
+        dates (array-like, optional): restrict the read to this date range
+        footprint (int): footprint width in cells, see site_points
+        index_cache (Path object, optional): site grid index cache directory
+        years_per_chunk (int, optional): read this many years at a time, so
+            the dask graph and the memory held at once are bounded for long
+            records (default: the whole range at once)
+
+    Returns:
+        xr.Dataset: var_list with dims (time, points), "points" labelled by site ID
+    """
+    if dates is not None:
+        dates = pd.DatetimeIndex(dates)
+        ds = ds.sel(time=slice(dates.min(), dates.max() + pd.Timedelta(days=1) - pd.Timedelta("1ns")))
+
+    index = micasa_grid_index(ds, site_IDs, site_lats, site_lons, footprint, index_cache)
+    if years_per_chunk is None or not ds.sizes["time"]:
+        return site_points(index, ds, var_list, footprint)
+
+    years = ds.indexes["time"].year
+    ds_list = []
+    for first_year in range(years.min(), years.max() + 1, years_per_chunk):
+        in_chunk = (years >= first_year) & (years < first_year + years_per_chunk)
+        if in_chunk.any():
+            ds_list.append(site_points(index, ds.isel(time=in_chunk), var_list, footprint))
+    return xr.concat(ds_list, dim="time")
+
+
+def micasa_points_to_site_df(ds_points, site_ID, dates=None):
+    """ Format extracted MiCASA points for one site as a DataFrame
+
+    Args:
+        ds_points (xr.Dataset): output of extract_micasa_points
+        site_ID (str): FluxNet Site ID to select
+        dates (array-like, optional): only keep MiCASA days in this list
+
+    Returns:
+        pd.DataFrame: one column per MiCASA variable indexed by time, with
+            units in df.attrs["units"] (see utils.intermediates)
+    """
+    ds_site = ds_points.sel(points=site_ID, drop=True)
+    if dates is not None:
+        keep = ds_site.indexes["time"].normalize().isin(pd.DatetimeIndex(dates))
+        ds_site = ds_site.isel(time=keep)
+
+    df_out = pd.DataFrame(index=ds_site.indexes["time"])
+    for micasa_var in ds_site.data_vars:
+        df_out[micasa_var] = ds_site[micasa_var].values
+    df_out.attrs["units"] = {
+        micasa_var: ds_site[micasa_var].units for micasa_var in ds_site.data_vars
+    }
+    return df_out
+
+
+def build_micasa_references(path_list):
+    """ Build a single kerchunk reference set over many MiCASA files
+
+    Args:
+        path_list (list of Path objects): MiCASA netCDF4 (HDF5) files
+
+    Returns:
+        dict: combined kerchunk references, concatenated along time
+    """
+    import fsspec
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from kerchunk.combine import MultiZarrToZarr
+
+    refs_list = []
+    for path in path_list:
+        with fsspec.open(str(path), "rb") as f:
+            refs_list.append(SingleHdf5ToZarr(f, str(path), inline_threshold=300).translate())
+
+    mzz = MultiZarrToZarr(
+        refs_list,
+        concat_dims=["time"],
+        identical_dims=["lat", "lon"],
+        coo_map={"time": "cf:time"},  # each file has its own time units
+    )
+    return mzz.translate()
+
+
+def open_micasa_store(store_path):
+    """ Open a MiCASA store built by data/MiCASA_data/make_virtual_dataset.py
+
+    Args:
+        store_path (Path object): kerchunk reference JSON or rechunked Zarr store
+
+    Returns:
+        xr.Dataset: lazily loaded MiCASA dataset covering the whole archive
+    """
+    store_path = str(store_path)
+    if store_path.endswith(".json"):
+        return xr.open_dataset(
+            "reference://",
+            engine="zarr",
+            chunks={},
+            backend_kwargs={
+                "consolidated": False,
+                "storage_options": {"fo": store_path},
+            },
+        )
+    return xr.open_dataset(store_path, engine="zarr", chunks={})
+
+
+def rechunk_micasa_store(ds, out_path, time_chunk=-1, space_chunk=25, band_rows=None):
+    """ Write a copy of MiCASA with chunks long in time and small in lat/lon
+
+    The source files hold one (or a few) time steps each, so the copy is written
+    in latitude bands to keep memory bounded: each band is read across all times
+    and written to its own region of the output store.
+
+    Args:
+        ds (xr.Dataset): MiCASA dataset (e.g. from open_micasa_store)
+        out_path (Path object): Zarr store to create
+        time_chunk (int): output chunk length in time (-1 for the full record)
+        space_chunk (int): output chunk size in lat and lon
+        band_rows (int, optional): latitude rows per band (default: space_chunk)
+
+    Returns:
+        Path: out_path
+    """
+    band_rows = band_rows or space_chunk
+    target = {"time": time_chunk, "lat": space_chunk, "lon": space_chunk}
+    spatial_vars = [var for var in ds.data_vars if {"lat", "lon"} <= set(ds[var].dims)]
+    ds = ds[spatial_vars].drop_encoding()
+
+    # Write metadata and coordinates only, then fill in band by band
+    ds.chunk(target).to_zarr(out_path, mode="w", compute=False)
+    for start in range(0, ds.sizes["lat"], band_rows):
+        band = slice(start, min(start + band_rows, ds.sizes["lat"]))
+        ds_band = ds.isel(lat=band).chunk(target)
+        # Region writes may only contain variables along the region dimension
+        ds_band = ds_band.drop_vars(["time", "lon"])
+        ds_band.to_zarr(out_path, region={"lat": band})
+    return out_path
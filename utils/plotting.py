@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.metrics import r2_score
 
@@ -27,3 +28,48 @@ def polyfit1d_and_plot(df, var1, var2, xlabel, title):
     ax.legend(loc="upper left")
     return fig
 
+
+
+def plot_regressions(data, results, groups=("variable", "period"), terms=None, xlabels=None, ncols=4):
+    """ Scatter plots with the fitted lines of analysis.regression.regress_sites
+
+    Args:
+        data (pd.DataFrame): site table passed to regress_sites
+        results (pd.DataFrame): output of regress_sites
+        groups (tuple of str): group columns of the results
+        terms (list of str, optional): numeric covariates to plot (default all
+            univariate numeric fits, ordered by r2)
+        xlabels (dict, optional): {covariate: x-axis label}
+        ncols (int): subplot columns
+
+    Returns:
+        dict: {group key: fig}
+    """
+    xlabels = xlabels or {}
+    fits = results[(results["model"] == "univariate") & (results["predictors"] == results["term"])]
+    figs = {}
+    for key, group_fits in fits.groupby(list(groups), sort=True):
+        group_fits = group_fits[group_fits["r2"].notna()].sort_values("r2", ascending=False)
+        if terms is not None:
+            group_fits = group_fits[group_fits["term"].isin(terms)]
+        if group_fits.empty:
+            continue
+        df = data.loc[(data[list(groups)] == pd.Series(key, index=list(groups))).all(axis=1)]
+
+        nrows = -(-len(group_fits) // ncols)
+        fig, axes = plt.subplots(nrows, min(ncols, len(group_fits)), figsize=(4 * min(ncols, len(group_fits)), 3.5 * nrows), squeeze=False)
+        for ax, fit in zip(axes.flat, group_fits.itertuples()):
+            x = df[fit.term]
+            ax.scatter(x, df[fit.target], s=12)
+            xs = np.array([x.min(), x.max()])
+            ax.plot(xs, fit.intercept + fit.coef * xs, color="red",
+                    label=f"$R^2$: {fit.r2:.3f}, p: {fit.p_value:.3f}")
+            ax.set_xlabel(xlabels.get(fit.term, fit.term))
+            ax.set_ylabel(f"{fit.target} (FluxNet vs MiCASA)")
+            ax.legend(loc="upper left", fontsize="small")
+        for ax in axes.flat[len(group_fits):]:
+            ax.set_visible(False)
+        fig.suptitle(" ".join(map(str, key)))
+        fig.tight_layout()
+        figs[key] = fig
+    return figs
@@ -0,0 +1,200 @@
+# Parsed, site-indexed AmeriFlux FLUXNET site metadata
+#
+# The AmeriFlux site search TSV (FLUX_METADATA) is parsed once: FLUXNET
+# sites only, coordinates as float arrays, IGBP class as a categorical, and
+# the "Years of AmeriFlux FLUXNET Data" strings as integer year lists. The
+# parsed table is cached as Parquet next to the other preprocessing caches
+# (keyed by the TSV size and mtime), and memoized per process, so drivers and
+# workers share one parse. Lookups by site are dict -> row position, and the
+# filters (hemisphere, IGBP, year coverage) are NumPy masks over all sites.
+
+import functools
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Columns of the AmeriFlux site search results used here
+SITE_COLUMN = "Site ID"
+LAT_COLUMN = "Latitude (degrees)"
+LON_COLUMN = "Longitude (degrees)"
+IGBP_COLUMN = "Vegetation Abbreviation (IGBP)"
+YEARS_COLUMN = "Years of AmeriFlux FLUXNET Data"
+
+
+def parse_years(year_string):
+    """ Parse a "Years of AmeriFlux FLUXNET Data" entry ("2001, 2002, ...") to a list of ints """
+    if pd.isna(year_string):
+        return []
+    return [int(year.strip()) for year in str(year_string).split(",") if year.strip()]
+
+
+def parse_site_metadata(flux_metadata_path):
+    """ Read the AmeriFlux TSV and parse the FLUXNET sites
+
+    Args:
+        flux_metadata_path (Path object): AmeriFlux site search results TSV
+
+    Returns:
+        pd.DataFrame: FLUXNET sites (original columns, Site ID as a column)
+            with a "years" column of parsed year lists
+    """
+    ameriflux_meta = pd.read_csv(flux_metadata_path, sep="\t")
+    fluxnet_meta = ameriflux_meta.loc[ameriflux_meta["AmeriFlux FLUXNET Data"] == "Yes"].reset_index(drop=True)
+    years = fluxnet_meta[YEARS_COLUMN] if YEARS_COLUMN in fluxnet_meta else pd.Series(np.nan, index=fluxnet_meta.index)
+    fluxnet_meta["years"] = years.apply(parse_years)
+    return fluxnet_meta
+
+
+class SiteMetadata:
+    """ FLUXNET site metadata with O(1) lookups and vectorized filters
+
+        meta = load_site_metadata(FLUX_METADATA, SITE_METADATA_CACHE)
+        lat, lon = meta.location("US-Ha1")
+        nh_sites = meta.select(hemisphere="N")
+        forests = meta.select(igbp=["ENF", "DBF", "MF"], years=(2010, 2020), min_years=5)
+
+    Attributes:
+        site_IDs (np.ndarray): site IDs, in TSV order
+        lat, lon (np.ndarray): site coordinates (float64)
+        igbp (pd.Categorical): IGBP vegetation class
+        year_values (np.ndarray): years of FLUXNET data of all sites, concatenated
+        year_offsets (np.ndarray): (site + 1,) start of each site's years in year_values
+        first_year, last_year, n_years (np.ndarray): per-site year summaries
+            (first/last -1 for sites without listed years)
+    """
+
+    def __init__(self, table):
+        self._table = table.reset_index(drop=True)
+        self.site_IDs = self._table[SITE_COLUMN].astype(str).to_numpy()
+        self.lat = self._table[LAT_COLUMN].to_numpy(dtype=np.float64)
+        self.lon = self._table[LON_COLUMN].to_numpy(dtype=np.float64)
+        self.igbp = pd.Categorical(self._table[IGBP_COLUMN] if IGBP_COLUMN in self._table else [None] * len(self._table))
+
+        years = [np.asarray(yrs, dtype=np.int16) for yrs in self._table["years"]]
+        self.n_years = np.array([len(yrs) for yrs in years], dtype=np.int64)
+        self.year_offsets = np.concatenate([[0], np.cumsum(self.n_years)])
+        self.year_values = np.concatenate(years) if years else np.empty(0, dtype=np.int16)
+        self.first_year = np.array([yrs.min() if len(yrs) else -1 for yrs in years], dtype=np.int64)
+        self.last_year = np.array([yrs.max() if len(yrs) else -1 for yrs in years], dtype=np.int64)
+
+        self._position = {site_ID: i for i, site_ID in enumerate(self.site_IDs)}
+
+    def __len__(self):
+        return len(self.site_IDs)
+
+    def __contains__(self, site_ID):
+        return site_ID in self._position
+
+    def position(self, site_ID):
+        """ Row of a site (KeyError for unknown sites) """
+        try:
+            return self._position[site_ID]
+        except KeyError:
+            raise KeyError(f"Site {site_ID} not in the FLUXNET metadata") from None
+
+    def location(self, site_ID):
+        """ (lat, lon) of a site """
+        i = self.position(site_ID)
+        return float(self.lat[i]), float(self.lon[i])
+
+    def years(self, site_ID):
+        """ Years of FLUXNET data of a site """
+        i = self.position(site_ID)
+        return self.year_values[self.year_offsets[i]:self.year_offsets[i + 1]].tolist()
+
+    def site(self, site_ID):
+        """ All metadata of a site as a dict (original TSV columns and parsed years) """
+        return self._table.iloc[self.position(site_ID)].to_dict()
+
+    def mask(self, hemisphere=None, igbp=None, years=None, min_years=None, sites=None):
+        """ Boolean mask of the sites matching all the given filters
+
+        Args:
+            hemisphere (str, optional): "N" (lat > 0) or "S" (lat <= 0)
+            igbp (str or list of str, optional): IGBP classes to keep
+            years (tuple, optional): (first, last) year range; keeps sites with
+                at least min_years years of data in it
+            min_years (int, optional): years of data needed in the range
+                (default 1), or overall if years is None (default no minimum)
+            sites (list of str, optional): sites to keep
+
+        Returns:
+            np.ndarray: (site,) bool
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if hemisphere is not None:
+            if hemisphere not in ("N", "S"):
+                raise ValueError(f"Hemisphere {hemisphere} invalid, use N or S")
+            keep &= (self.lat > 0) if hemisphere == "N" else (self.lat <= 0)
+        if igbp is not None:
+            keep &= np.isin(np.asarray(self.igbp, dtype=object), [igbp] if isinstance(igbp, str) else list(igbp))
+        if years is not None:
+            in_range = (self.year_values >= years[0]) & (self.year_values <= years[1])
+            owner = np.repeat(np.arange(len(self)), self.n_years)
+            keep &= np.bincount(owner[in_range], minlength=len(self)) >= (1 if min_years is None else min_years)
+        elif min_years is not None:
+            keep &= self.n_years >= min_years
+        if sites is not None:
+            keep &= np.isin(self.site_IDs, list(sites))
+        return keep
+
+    def select(self, **filters):
+        """ Site IDs matching the filters of mask(), in TSV order """
+        return self.site_IDs[self.mask(**filters)].tolist()
+
+    def frame(self, sites=None):
+        """ Metadata as a DataFrame in the import_flux_metadata format (a copy)
+
+        Args:
+            sites (list of str, optional): sites to keep, in this order
+        """
+        if sites is None:
+            return self._table.copy()
+        return self._table.iloc[[self.position(site_ID) for site_ID in sites]].reset_index(drop=True)
+
+
+def _source_key(flux_metadata_path):
+    """ Cache key of the TSV: hash of its resolved path, size and mtime """
+    st = os.stat(flux_metadata_path)
+    text = f"{Path(flux_metadata_path).resolve()}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=8)
+def _load_site_metadata(flux_metadata_path, cache_dir, key):
+    if cache_dir is None:
+        return SiteMetadata(parse_site_metadata(flux_metadata_path))
+
+    cache_path = Path(cache_dir) / f"site-metadata-{key}.parquet"
+    if cache_path.exists():
+        table = pd.read_parquet(cache_path)
+        table["years"] = table["years"].apply(list)
+        return SiteMetadata(table)
+
+    table = parse_site_metadata(flux_metadata_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temporary file first so concurrent workers never read a partial cache
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{cache_path.name}.", suffix=".parquet")
+    os.close(fd)
+    table.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    return SiteMetadata(table)
+
+
+def load_site_metadata(flux_metadata_path, cache_dir=None):
+    """ Parsed FLUXNET site metadata, from the process memo or on-disk cache when up to date
+
+    Args:
+        flux_metadata_path (Path object): AmeriFlux site search results TSV
+        cache_dir (Path object, optional): Parquet cache directory (no
+            on-disk caching if None)
+
+    Returns:
+        SiteMetadata: shared instance, use frame() for a DataFrame to modify
+    """
+    return _load_site_metadata(
+        str(flux_metadata_path), None if cache_dir is None else str(cache_dir), _source_key(flux_metadata_path)
+    )